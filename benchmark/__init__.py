@@ -0,0 +1,161 @@
+import gc
+import importlib
+import itertools
+import json
+import pkgutil
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str, params: Optional[Dict[str, list]] = None, rounds: int = 20):
+    # 注册一个基准测试,被装饰函数的第一个参数是Bench对象,用法与pytest-benchmark的fixture一致
+    def decorator(func):
+        keys = sorted(params or {})
+        for values in itertools.product(*[params[k] for k in keys]):
+            kwargs = dict(zip(keys, values))
+            full_name = name + "".join(f"[{k}={v}]" for k, v in kwargs.items())
+            BENCHMARKS[full_name] = (func, kwargs, rounds)
+        return func
+
+    return decorator
+
+
+class Bench:
+    def __init__(self, rounds: int = 20, min_time: float = 0.01, warmup: int = 1):
+        self.rounds = rounds
+        self.min_time = min_time
+        self.warmup = warmup
+        self.stats = None
+        self.extra = {}
+
+    def _loops(self, func, args) -> int:
+        loops = 1
+        while True:
+            t0 = time.perf_counter()
+            for _ in range(loops):
+                func(*args)
+            if time.perf_counter() - t0 >= self.min_time or loops >= 1 << 20:
+                return loops
+            loops *= 2
+
+    def __call__(self, func: Callable, *args):
+        for _ in range(self.warmup):
+            result = func(*args)
+        loops = self._loops(func, args)
+        samples = []
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(self.rounds):
+                t0 = time.perf_counter()
+                for _ in range(loops):
+                    result = func(*args)
+                samples.append((time.perf_counter() - t0) / loops)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.stats = summarize(samples, loops)
+        return result
+
+    def pedantic(self, func: Callable, setup: Callable = None, rounds: int = None):
+        # 每轮调用一次setup,用于有状态的流程(如整段下载)
+        samples = []
+        for _ in range(rounds or self.rounds):
+            args = setup() if setup is not None else ()
+            t0 = time.perf_counter()
+            result = func(*args)
+            samples.append(time.perf_counter() - t0)
+        self.stats = summarize(samples, 1)
+        return result
+
+
+def summarize(samples: List[float], loops: int) -> dict:
+    mean = statistics.fmean(samples)
+    return {
+        "min": min(samples),
+        "max": max(samples),
+        "mean": mean,
+        "median": statistics.median(samples),
+        "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "rounds": len(samples),
+        "loops": loops,
+        "ops": 1.0 / mean if mean else 0.0,
+    }
+
+
+def load_benchmarks():
+    for module in pkgutil.iter_modules(__path__):
+        if module.name.startswith("bench_"):
+            importlib.import_module(f"{__name__}.{module.name}")
+    return BENCHMARKS
+
+
+def run(keyword: str = None, rounds: int = None, min_time: float = 0.01, log=print) -> dict:
+    results = {}
+    for name, (func, kwargs, default_rounds) in sorted(load_benchmarks().items()):
+        if keyword and keyword not in name:
+            continue
+        b = Bench(rounds or default_rounds, min_time)
+        try:
+            func(b, **kwargs)
+        except BenchmarkSkipped as e:
+            log(f"{name:<60} skipped: {e}")
+            continue
+        if b.stats is None:
+            continue
+        b.stats.update(b.extra)
+        results[name] = b.stats
+        log(f"{name:<60} mean {b.stats['mean'] * 1e6:12.2f} us  ops {b.stats['ops']:12.1f}/s")
+    return results
+
+
+class BenchmarkSkipped(Exception):
+    pass
+
+
+def skip(reason: str):
+    raise BenchmarkSkipped(reason)
+
+
+def machine_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "commit": commit,
+        "datetime": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def save(results: dict, path: str):
+    with open(path, "w") as f:
+        json.dump({"machine_info": machine_info(), "benchmarks": results}, f, indent=2)
+
+
+def compare(old_path: str, results: dict, threshold: float = 0.1, log=print) -> List[str]:
+    # 返回比基准结果慢threshold以上的测试项
+    with open(old_path, "r") as f:
+        old = json.load(f)["benchmarks"]
+    regressions = []
+    for name, stats in sorted(results.items()):
+        if name not in old:
+            continue
+        ratio = stats["median"] / old[name]["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        log(f"{name:<60} {old[name]['median'] * 1e6:12.2f} -> {stats['median'] * 1e6:12.2f} us  x{ratio:5.2f}{flag}")
+    return regressions
@@ -0,0 +1,27 @@
+import argparse
+import sys
+
+from benchmark import compare, run, save
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ECUSim benchmarks")
+    parser.add_argument("-k", "--keyword", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--rounds", type=int)
+    parser.add_argument("--min-time", type=float, default=0.01, help="minimum seconds per round")
+    parser.add_argument("--json", help="save results to this file")
+    parser.add_argument("--compare", help="compare against a previously saved json")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown ratio before failing")
+    args = parser.parse_args(argv)
+
+    results = run(args.keyword, args.rounds, args.min_time)
+    if args.json:
+        save(results, args.json)
+    if args.compare:
+        if compare(args.compare, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
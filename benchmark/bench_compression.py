@@ -0,0 +1,48 @@
+import random
+
+from benchmark import benchmark, skip
+from compression import compress
+from loadgen import download_sequence, loopback_sessions, virtual_can_sessions
+
+
+def firmware_image(size: int, seed: int = 0) -> bytes:
+    # 近似真实镜像: 由少量"指令"重复组成的代码段, 夹杂擦除后未写入的0xFF区域
+    rng = random.Random(seed)
+    words = [bytes(rng.randrange(256) for _ in range(4)) for _ in range(512)]
+    out = bytearray()
+    while len(out) < size:
+        if rng.random() < 0.1:
+            out += b"\xff" * rng.randrange(64, 1024)
+        else:
+            out += b"".join(rng.choice(words) for _ in range(16))
+    return bytes(out[:size])
+
+
+@benchmark("compression.download", params={"transport": ["loopback", "can"], "compression": [0, 1, 2]}, rounds=3)
+def bench_download(b, transport, compression):
+    image = firmware_image(256 * 1024 if transport == "loopback" else 32 * 1024)
+    if transport == "loopback":
+        session = loopback_sessions(1, timeout=30)[0]
+    else:
+        try:
+            import can
+            import isotp
+        except ImportError:
+            skip("python-can/isotp not installed")
+        session = virtual_can_sessions(1, timeout=30)[0]
+    sequence = download_sequence(len(image), compression=compression, image=image)
+    wire = len(compress(image, compression))
+
+    def run():
+        for req in sequence:
+            r = session.request(req)
+            if r is None or r[0] == 0x7f:
+                raise RuntimeError(f"download failed at {req[:2]}: {r}")
+
+    try:
+        b.pedantic(run)
+        b.extra["ratio"] = wire / len(image)
+        b.extra["effective_bytes_per_second"] = len(image) / b.stats["median"]
+        b.extra["wire_bytes_per_second"] = wire / b.stats["median"]
+    finally:
+        session.close()
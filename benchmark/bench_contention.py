@@ -0,0 +1,92 @@
+import threading
+import time
+
+from benchmark import benchmark
+from benchmark.bench_compression import firmware_image
+from ecustate import ECUState
+from loadgen import download_sequence
+from uds import ServiceDispatcher
+
+READ = [0x22, 0xf1, 0x91, 0x00, 0x21, 0x00, 0x41, 0x00, 0x51, 0x00, 0x61]
+
+
+class _GlobalLock:
+    # 对照组: 所有诊断仪的请求都经过同一把锁, 相当于一把大锁保护全部状态
+    def __init__(self, dispatcher: ServiceDispatcher, lock: threading.Lock):
+        self.dispatcher = dispatcher
+        self.lock = lock
+
+    def handle(self, data):
+        with self.lock:
+            return self.dispatcher.handle(data)
+
+
+@benchmark("contention.read_during_download", params={"readers": [1, 4], "locking": ["resource", "global"],
+                                                    "flashing": [False, True]}, rounds=3)
+def bench_read_during_download(b, readers, locking, flashing):
+    # 同一ECU上: readers个诊断仪像数据记录仪一样每1ms读一次5个DID, 另一个诊断仪循环做lzma压缩刷写,
+    # 每个诊断仪有自己的会话. 解压时释放GIL, 只有锁会让读请求等在刷写后面
+    state = ECUState()
+    lock = threading.Lock()
+
+    def tester():
+        d = ServiceDispatcher(state)
+        return d if locking == "resource" else _GlobalLock(d, lock)
+
+    image = firmware_image(256 * 1024)
+    sequence = [[0x10, 0x02]] + download_sequence(len(image), compression=2, image=image)
+    done = threading.Event()
+    downloads = [0]
+
+    def flash():
+        flasher = tester()
+        while not done.is_set():
+            for req in sequence:
+                r = flasher.handle(req)
+                if r is None or r[0] == 0x7f:
+                    raise RuntimeError(f"download failed at {req[:2]}: {r}")
+            downloads[0] += 1
+
+    latencies = []
+    reads = []
+
+    def read(out):
+        logger = tester()
+        next_t = time.perf_counter()
+        t_end = next_t + 0.5
+        while next_t < t_end:
+            t0 = time.perf_counter()
+            logger.handle(READ)
+            out.append(time.perf_counter() - t0)
+            next_t += 0.001
+            time.sleep(max(0.0, next_t - time.perf_counter()))
+
+    def run():
+        per_reader = [[] for _ in range(readers)]
+        threads = [threading.Thread(target=read, args=(out,)) for out in per_reader]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        for out in per_reader:
+            latencies.extend(out)
+        reads.append(sum(len(out) for out in per_reader) / elapsed)
+
+    flasher = threading.Thread(target=flash, daemon=True)
+    if flashing:
+        flasher.start()
+    t0 = time.perf_counter()
+    try:
+        b.pedantic(run)
+    finally:
+        done.set()
+        if flashing:
+            flasher.join()
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    b.extra["read_p50"] = latencies[len(latencies) // 2]
+    b.extra["read_p99"] = latencies[int(len(latencies) * 0.99)]
+    b.extra["reads_per_second"] = min(reads)
+    b.extra["download_bytes_per_second"] = downloads[0] * len(image) / elapsed
@@ -0,0 +1,17 @@
+from benchmark import benchmark
+from did import DIDList
+
+DIDS = ["0x%04X" % d for d in sorted(DIDList.dict)]
+
+
+@benchmark("did.encode", params={"did": DIDS})
+def bench_encode(b, did):
+    did = int(did, 16)
+    b(DIDList.dict[did].encode, DIDList.value[did])
+
+
+@benchmark("did.decode", params={"did": DIDS})
+def bench_decode(b, did):
+    did = int(did, 16)
+    codec = DIDList.dict[did]
+    b(codec.decode, list(codec.encode(DIDList.value[did])))
@@ -0,0 +1,20 @@
+from benchmark import benchmark
+from uds import ServiceDispatcher
+
+REQUESTS = {
+    "valid.tester_present": [0x3e, 0x00],
+    "valid.read_did": [0x22, 0x00, 0x21],
+    "malformed.short_frame": [0x31, 0x01],
+    "malformed.odd_did_length": [0x22, 0xf1, 0x91, 0x00],
+    "malformed.sub_function": [0x10, 0x7a],
+    "malformed.wrong_session": [0x34, 0x00, 0x44, 0, 0, 0, 0, 0, 0, 0x10, 0],
+    "malformed.unsupported_sid": [0xba, 0x00],
+}
+
+
+@benchmark("dispatch.handle", params={"request": sorted(REQUESTS)})
+def bench_handle(b, request):
+    dispatcher = ServiceDispatcher()
+    if request == "malformed.short_frame":
+        dispatcher.session = 3
+    b(dispatcher.handle, REQUESTS[request])
@@ -0,0 +1,35 @@
+from benchmark import benchmark, skip
+from loadgen import doip_sessions, download_sequence, virtual_can_sessions
+
+IMAGE = 256 * 1024
+
+
+@benchmark("doip.download", params={"transport": ["doip", "can", "canfd"]}, rounds=3)
+def bench_download(b, transport):
+    # 同一个镜像分别经DoIP和ISO-TP(经典CAN/CAN FD)刷写, 块长都由ECU的maxNumberOfBlockLength决定
+    if transport == "doip":
+        session = doip_sessions(1, timeout=30)[0]
+        image = IMAGE
+    else:
+        try:
+            import can
+            import isotp
+        except ImportError:
+            skip("python-can/isotp not installed")
+        fd = transport == "canfd"
+        params = {"tx_data_length": 64 if fd else 8, "can_fd": fd, "bitrate_switch": fd}
+        session = virtual_can_sessions(1, params=params, timeout=30)[0]
+        image = IMAGE // 16
+    sequence = download_sequence(image)
+
+    def run():
+        for req in sequence:
+            r = session.request(req)
+            if r is None or r[0] == 0x7f:
+                raise RuntimeError(f"download failed at {req[:2]}: {r}")
+
+    try:
+        b.pedantic(run)
+        b.extra["bytes_per_second"] = image / b.stats["median"]
+    finally:
+        session.close()
@@ -0,0 +1,45 @@
+from benchmark import benchmark
+from did import DIDSnapshot, DIDStore, UShortLinearCoding, did_source
+from ecustate import ECUState
+from uds import ReadDataByIdentifier
+
+SIGNALS = 50
+DYNAMIC = 0xf200
+
+
+def _state() -> ECUState:
+    codec = UShortLinearCoding(1, 0)
+    dids = DIDStore(DIDSnapshot({0x1000 + i: codec for i in range(SIGNALS)}, {0x1000 + i: i for i in range(SIGNALS)}))
+    dids.define(DYNAMIC, [did_source(dids.snapshot, 0x1000 + i, 1, 2) for i in range(SIGNALS)])
+    return ECUState(dids)
+
+
+@benchmark("dynamic_did.read", params={"mode": ["dynamic", "dynamic_uncached", "multi_did", "single_reads"]})
+def bench_read(b, mode):
+    # 同样50个信号: 一个动态DID / 同一快照下重新取数 / 一次请求50个DID / 50次单DID请求
+    state = _state()
+    rdbi = ReadDataByIdentifier()
+    if mode == "dynamic":
+        b(rdbi.process, [0x22, DYNAMIC >> 8, DYNAMIC & 0xff], state)
+    elif mode == "dynamic_uncached":
+        plan = state.dids.dynamic[DYNAMIC]
+        snapshot = state.dids.snapshot
+
+        def read():
+            plan._cache = (None, None)
+            return plan.read(snapshot)
+
+        b(read)
+    elif mode == "multi_did":
+        req = [0x22]
+        for i in range(SIGNALS):
+            req += [0x10, i]
+        b(rdbi.process, req, state)
+    else:
+        reqs = [[0x22, 0x10, i] for i in range(SIGNALS)]
+
+        def reads():
+            for req in reqs:
+                rdbi.process(req, state)
+
+        b(reads)
@@ -0,0 +1,48 @@
+import itertools
+
+from benchmark import benchmark, skip
+from main import ECUSim
+from transport import IsoTpCanTransport, LoopbackTransport
+
+_channels = itertools.count()
+
+REQUESTS = {
+    "tester_present": [0x3e, 0x00],
+    "read_vin": [0x22, 0xf1, 0x91],
+}
+
+
+@benchmark("e2e.loopback", params={"request": sorted(REQUESTS)})
+def bench_loopback(b, request):
+    ecu = ECUSim(LoopbackTransport())
+    ecu.start()
+    try:
+        b(ecu.transport.tester.request, REQUESTS[request])
+    finally:
+        ecu.stop()
+
+
+@benchmark("e2e.virtual_can", params={"request": sorted(REQUESTS)}, rounds=5)
+def bench_virtual_can(b, request):
+    try:
+        import can
+        import isotp
+    except ImportError:
+        skip("python-can/isotp not installed")
+    channel = "bench_e2e_%d" % next(_channels)
+    ecu = ECUSim(IsoTpCanTransport("virtual", channel, rxid=0x7e0, txid=0x7e8))
+    ecu.start()
+    bus = can.Bus(interface="virtual", channel=channel)
+    stack = isotp.CanStack(bus, address=isotp.Address(rxid=0x7e8, txid=0x7e0), params={'blocking_send': True})
+    stack.start()
+
+    def roundtrip():
+        stack.send(bytes(REQUESTS[request]), send_timeout=1)
+        return stack.recv(block=True, timeout=2)
+
+    try:
+        b(roundtrip)
+    finally:
+        stack.stop()
+        bus.shutdown()
+        ecu.stop()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+from benchmark import benchmark
+from benchmark.bench_compression import firmware_image
+from flashimage import ReferenceImage, write_ihex, write_srec
+
+_WRITERS = {"bin": lambda f, segments: f.write(segments[0][1]), "hex": write_ihex, "s19": write_srec}
+BLOCK = 0x0fff - 2
+
+
+def _reference_file(directory: str, fmt: str, image: bytes) -> str:
+    path = os.path.join(directory, "ref." + fmt)
+    with open(path, "wb") as f:
+        _WRITERS[fmt](f, [(0, image)])
+    return path
+
+
+def _verify(reference: ReferenceImage, image: bytes) -> dict:
+    # 按TransferData的块大小喂入, 和下载时一样
+    verifier = reference.verifier(0, len(image))
+    view = memoryview(image)
+    for offset in range(0, len(image), BLOCK):
+        verifier.feed(view[offset:offset + BLOCK])
+    return verifier.finish()
+
+
+def _peak(func) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark("flashimage.index", params={"fmt": ["bin", "hex", "s19"], "image_mb": [1, 16]}, rounds=3)
+def bench_index(b, fmt, image_mb):
+    # 打开参考文件: 十六进制格式要扫描全部记录建段表
+    directory = tempfile.mkdtemp()
+    try:
+        path = _reference_file(directory, fmt, firmware_image(image_mb << 20))
+        b.pedantic(lambda: ReferenceImage(path).close())
+        b.extra["file_bytes_per_second"] = os.path.getsize(path) / b.stats["median"]
+        b.extra["peak_bytes"] = _peak(lambda: ReferenceImage(path).close())
+    finally:
+        shutil.rmtree(directory)
+
+
+@benchmark("flashimage.verify", params={"fmt": ["bin", "hex", "s19"], "image_mb": [1, 16]}, rounds=3)
+def bench_verify(b, fmt, image_mb):
+    # 下载的数据与参考文件流式比较; peak_bytes与镜像大小无关, 256MB镜像的内存占用和这里一样
+    directory = tempfile.mkdtemp()
+    try:
+        image = firmware_image(image_mb << 20)
+        with ReferenceImage(_reference_file(directory, fmt, image)) as reference:
+            result = b.pedantic(lambda: _verify(reference, image))
+            assert result["ok"], result
+            b.extra["image_bytes_per_second"] = len(image) / b.stats["median"]
+            b.extra["peak_bytes"] = _peak(lambda: _verify(reference, image))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,28 @@
+from benchmark import benchmark, skip
+from loadgen import download_sequence, virtual_can_sessions
+
+IMAGE = 16 * 1024
+
+
+@benchmark("isotp.download", params={"dlc": [8, 64], "bs": [0, 8], "stmin": [0, 1]}, rounds=2)
+def bench_download(b, dlc, bs, stmin):
+    try:
+        import can
+        import isotp
+    except ImportError:
+        skip("python-can/isotp not installed")
+    params = {"blocksize": bs, "stmin": stmin, "tx_data_length": dlc, "can_fd": dlc > 8, "bitrate_switch": dlc > 8}
+    session = virtual_can_sessions(1, params=params, timeout=30)[0]
+    sequence = download_sequence(IMAGE)
+
+    def run():
+        for req in sequence:
+            r = session.request(req)
+            if r is None or r[0] == 0x7f:
+                raise RuntimeError(f"download failed at {req[:2]}: {r}")
+
+    try:
+        b.pedantic(run)
+        b.extra["bytes_per_second"] = IMAGE / b.stats["median"]
+    finally:
+        session.close()
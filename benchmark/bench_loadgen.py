@@ -0,0 +1,19 @@
+from benchmark import benchmark
+from loadgen import DEFAULT_MIX, LoadGenerator, loopback_sessions
+
+
+@benchmark("loadgen.loopback_mix", params={"sessions": [1, 4, 16]}, rounds=3)
+def bench_mix(b, sessions):
+    clients = loopback_sessions(sessions)
+    reports = []
+
+    def run():
+        reports.append(LoadGenerator(clients, DEFAULT_MIX).run(duration=1.0))
+
+    try:
+        b.pedantic(run)
+        b.extra["requests_per_second"] = max(r["throughput"] for r in reports)
+        b.extra["p99"] = min(r["latency"]["p99"] for r in reports)
+    finally:
+        for c in clients:
+            c.close()
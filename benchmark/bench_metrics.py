@@ -0,0 +1,23 @@
+from benchmark import benchmark
+from metrics import MetricsRegistry
+
+RESPONSES = {
+    "positive": [0x62, 0xf1, 0x91],
+    "negative": [0x7f, 0x22, 0x31],
+    "suppressed": None,
+}
+
+
+@benchmark("metrics.observe", params={"response": sorted(RESPONSES)})
+def bench_observe(b, response):
+    registry = MetricsRegistry()
+    b(registry.observe, "ecu", 0x22, RESPONSES[response], 0.00003)
+
+
+@benchmark("metrics.render_prometheus")
+def bench_render(b):
+    registry = MetricsRegistry()
+    for ecu in range(4):
+        for sid in (0x10, 0x22, 0x2e, 0x19, 0x31, 0x34, 0x36, 0x37):
+            registry.observe("ecu%d" % ecu, sid, [0x7f, sid, 0x31], 0.0001)
+    b(registry.render_prometheus)
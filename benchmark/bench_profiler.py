@@ -0,0 +1,25 @@
+import logging
+import os
+
+from benchmark import benchmark
+from profiler import Profiler
+from uds import TesterPresent
+from uds_addtion import log_exception
+
+logger = logging.getLogger("app")
+
+
+@benchmark("profiler.dispatch", params={"mode": ["undecorated", "disabled", "deterministic", "sampling"]})
+def bench_dispatch(b, mode):
+    service = TesterPresent()
+    func = service.process
+    if mode != "undecorated":
+        func = log_exception(logger, label=lambda data: "TesterPresent")(func)
+    profiler = Profiler()
+    if mode in ("deterministic", "sampling"):
+        profiler.start(mode=mode)
+    try:
+        b(func, [0x3e, 0x00])
+    finally:
+        if profiler.active:
+            profiler.stop(os.devnull)
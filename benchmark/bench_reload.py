@@ -0,0 +1,78 @@
+import threading
+import time
+
+from benchmark import benchmark
+from did import DIDList, DIDSnapshot, UShortLinearCoding
+from ecustate import ECUState
+from uds import ReadDataByIdentifier
+
+
+def _snapshot(dids: int, value: int) -> DIDSnapshot:
+    codec = UShortLinearCoding(1, 0)
+    return DIDSnapshot({0x1000 + i: codec for i in range(dids)}, {0x1000 + i: value for i in range(dids)})
+
+
+@benchmark("reload.compile", params={"dids": [5, 1000, 10000]})
+def bench_compile(b, dids):
+    codec = UShortLinearCoding(1, 0)
+    codecs = {0x1000 + i: codec for i in range(dids)}
+    values = {0x1000 + i: i for i in range(dids)}
+    b(DIDSnapshot, codecs, values)
+
+
+@benchmark("reload.swap", params={"dids": [5, 10000]})
+def bench_swap(b, dids):
+    saved = DIDList.snapshot
+    a, c = _snapshot(dids, 1), _snapshot(dids, 2)
+
+    def swap():
+        DIDList.swap(a)
+        DIDList.swap(c)
+
+    try:
+        b(swap)
+    finally:
+        DIDList.swap(saved)
+
+
+@benchmark("reload.read_during_reload", params={"reloads_per_second": [0, 10, 1000]}, rounds=5)
+def bench_read_during_reload(b, reloads_per_second):
+    # 读线程持续做10个DID的RDBI, 另一线程按频率重新编译并换表
+    saved = DIDList.snapshot
+    DIDList.swap(_snapshot(1000, 1))
+    rdbi = ReadDataByIdentifier()
+    state = ECUState.default()
+    req = [0x22]
+    for i in range(10):
+        req += [0x10, i * 7]
+    done = threading.Event()
+
+    def reload():
+        n = 0
+        while not done.is_set():
+            DIDList.swap(_snapshot(1000, n & 0xff))
+            n += 1
+            done.wait(1.0 / reloads_per_second)
+
+    t = threading.Thread(target=reload, daemon=True)
+    if reloads_per_second:
+        t.start()
+    reads = []
+
+    def run():
+        n = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < 0.2:
+            for _ in range(100):
+                rdbi.process(req, state)
+            n += 100
+        reads.append(n / (time.perf_counter() - t0))
+
+    try:
+        b.pedantic(run)
+        b.extra["reads_per_second"] = max(reads)
+    finally:
+        done.set()
+        if reloads_per_second:
+            t.join()
+        DIDList.swap(saved)
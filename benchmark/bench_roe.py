@@ -0,0 +1,95 @@
+import queue
+import random
+import threading
+import time
+
+from benchmark import benchmark
+from did import DIDList, DIDSnapshot, UShortLinearCoding
+from uds import ServiceDispatcher
+
+DIDS = 1000
+BASE = 0x1000
+
+
+def _setup(subscriptions: int, min_interval: float, sink):
+    codec = UShortLinearCoding(1, 0)
+    saved = DIDList.swap(DIDSnapshot({BASE + i: codec for i in range(DIDS)}, {BASE + i: 0 for i in range(DIDS)}))
+    d = ServiceDispatcher(sink=sink)
+    d.events.min_interval = min_interval
+    for i in range(subscriptions):
+        did = BASE + i % (DIDS - 1)
+        d.events.define(0x03, 0x02, bytes([did >> 8, did & 0xff]), bytes([0x22, did >> 8, did & 0xff]))
+    if subscriptions:
+        d.events.start()
+    return d, saved
+
+
+@benchmark("roe.write", params={"subscriptions": [0, 1000, 10000]})
+def bench_write(b, subscriptions):
+    # 写一个没有订阅者的DID: 开销不应随订阅数增长
+    d, saved = _setup(subscriptions, 0.02, None)
+    values = iter(range(1 << 30))
+    try:
+        b(lambda: DIDList.write(BASE + DIDS - 1, next(values) & 0xffff))
+    finally:
+        d.close()
+        DIDList.swap(saved)
+
+
+@benchmark("roe.notify", params={"subscriptions": [1000, 10000], "writes_per_second": [1000, 20000]}, rounds=2)
+def bench_notify(b, subscriptions, writes_per_second):
+    # 后台线程按给定频率随机写DID; 探测线程写一个专用DID并等它的推送, 得到通知延迟
+    pushed = queue.SimpleQueue()
+    probe = BASE + DIDS - 1
+    sends = [0]
+
+    def sink(r):
+        sends[0] += 1
+        if (r[1] << 8) | r[2] == probe:
+            pushed.put(time.perf_counter())
+
+    d, saved = _setup(subscriptions, 0.02, sink)
+    d.events.define(0x03, 0x02, bytes([probe >> 8, probe & 0xff]), bytes([0x22, probe >> 8, probe & 0xff]))
+    d.events.min_interval = 0.0
+    done = threading.Event()
+    writes = [0]
+
+    def load():
+        rng = random.Random(0)
+        interval = 1.0 / writes_per_second
+        next_t = time.perf_counter()
+        while not done.is_set():
+            DIDList.write(BASE + rng.randrange(DIDS - 1), rng.randrange(0x10000))
+            writes[0] += 1
+            next_t += interval
+            delay = next_t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    latencies = []
+
+    def run():
+        # 0.5秒内每5ms探测一次
+        for i in range(100):
+            t0 = time.perf_counter()
+            DIDList.write(probe, i + 1)
+            latencies.append(pushed.get(timeout=5) - t0)
+            time.sleep(max(0.0, 0.005 - (time.perf_counter() - t0)))
+
+    t = threading.Thread(target=load, daemon=True)
+    t.start()
+    t0 = time.perf_counter()
+    try:
+        b.pedantic(run)
+    finally:
+        done.set()
+        t.join()
+        elapsed = time.perf_counter() - t0
+        d.close()
+        DIDList.swap(saved)
+    latencies.sort()
+    b.extra["latency_p50"] = latencies[len(latencies) // 2]
+    b.extra["latency_p99"] = latencies[int(len(latencies) * 0.99)]
+    b.extra["writes_per_second"] = writes[0] / elapsed
+    b.extra["notifications_per_second"] = sends[0] / elapsed
+    b.extra["coalesced"] = d.events.stats["coalesced"]
@@ -0,0 +1,69 @@
+from benchmark import benchmark, skip
+from ecustate import ECUState
+from uds import ServiceDispatcher
+
+KEY = bytes(range(16))
+MESSAGES = 1000
+BLOCK = 0x0fff - 2
+_ALGORITHMS = {"cmac": 0x00, "gcm": 0x01}
+
+
+def _requests(request: str) -> list:
+    if request == "read_did":
+        return [bytes([0x22, 0xf1, 0x91])] * MESSAGES
+    return [bytes([0x36, (i + 1) & 0xff]) + bytes([i & 0xff]) * BLOCK for i in range(MESSAGES)]
+
+
+def _channel():
+    try:
+        from secured import SecureChannel
+    except ImportError:
+        skip("cryptography not installed")
+    return SecureChannel(KEY)
+
+
+def _start_download(d: ServiceDispatcher):
+    d.handle([0x10, 0x02])
+    d.handle([0x31, 0x01, 0xff, 0x00, 0, 0, 0, 0, 0, 0, 0, 0])
+    size = MESSAGES * BLOCK
+    assert d.handle([0x34, 0x00, 0x44, 0, 0, 0, 0] + list(size.to_bytes(4, "big")))[0] == 0x74
+
+
+@benchmark("secured.request", params={"mode": ["plain", "cmac", "gcm"], "request": ["read_did", "transfer_data"]},
+           rounds=5)
+def bench_request(b, mode, request):
+    # ECU一侧处理一条请求的时间(诊断仪的签名/加密在setup里做好); 防重放计数器不随恢复快照回退, 每轮接着往上数
+    d = ServiceDispatcher(ECUState(secure_key=KEY))
+    inner = _requests(request)
+    tester = _channel() if mode != "plain" else None
+    counter = [0]
+
+    def setup():
+        d.restore(snapshot)
+        if request == "transfer_data":
+            _start_download(d)
+        if tester is None:
+            return (inner,)
+        first = counter[0] + 1
+        counter[0] += len(inner)
+        return ([tester.protect(req, i & 0xffff, _ALGORITHMS[mode]) for i, req in enumerate(inner, first)],)
+
+    def run(requests):
+        for req in requests:
+            r = d.handle(req)
+        assert r[0] != 0x7f, r
+
+    snapshot = d.snapshot()
+    b.pedantic(run, setup)
+    b.extra["requests_per_second"] = MESSAGES / b.stats["median"]
+    b.extra["payload_bytes_per_second"] = MESSAGES * len(inner[0]) / b.stats["median"]
+
+
+@benchmark("secured.key_context")
+def bench_key_context(b):
+    # 每条消息都重建密钥上下文的代价, 对比缓存后每条消息只复制CMAC状态
+    channel = _channel()
+    b(type(channel), KEY)
+    per_message = b.stats["median"]
+    b(channel._mac, b"\x22\xf1\x91")
+    b.extra["rebuild_seconds"] = per_message
@@ -0,0 +1,122 @@
+from benchmark import benchmark
+from dtc import DTC, DTCBuffer
+from ecustate import ECUState, PagedMemory
+from uds import (DiagnosticSessionControl, ECUReset, SecurityAccess, CommunicationControl, ReadDataByIdentifier,
+                 WriteDataByIdentifier, ClearDiagnosticInformation, ReadDTCInformation, TesterPresent,
+                 ControlDTCSetting, RoutineControl, RequestDownload, TransferData, RequestTransferExit)
+
+
+@benchmark("service.0x10.DiagnosticSessionControl")
+def bench_session_control(b):
+    b(DiagnosticSessionControl().process, [0x10, 0x03])
+
+
+@benchmark("service.0x11.ECUReset")
+def bench_ecu_reset(b):
+    b(ECUReset().process, [0x11, 0x01])
+
+
+@benchmark("service.0x27.SecurityAccess", params={"step": ["seed", "key"]})
+def bench_security_access(b, step):
+    req = [0x27, 0x01] if step == "seed" else [0x27, 0x02, 1, 2, 3, 4]
+    b(SecurityAccess().process, req)
+
+
+@benchmark("service.0x28.CommunicationControl")
+def bench_communication_control(b):
+    b(CommunicationControl().process, [0x28, 0x03, 0x01])
+
+
+@benchmark("service.0x85.ControlDTCSetting")
+def bench_control_dtc_setting(b):
+    b(ControlDTCSetting().process, [0x85, 0x02])
+
+
+@benchmark("service.0x3E.TesterPresent")
+def bench_tester_present(b):
+    b(TesterPresent().process, [0x3e, 0x00])
+
+
+@benchmark("service.0x22.ReadDataByIdentifier", params={"dids": [1, 10, 100]})
+def bench_read_did(b, dids):
+    state = ECUState()
+    keys = list(state.dids.dict)
+    req = [0x22]
+    for i in range(dids):
+        d = keys[i % len(keys)]
+        req += [d >> 8, d & 0xff]
+    b(ReadDataByIdentifier().process, req, state)
+
+
+@benchmark("service.0x2E.WriteDataByIdentifier", params={"did": ["0x0021", "0xF191"]})
+def bench_write_did(b, did):
+    # 写时复制: 每次写都换一份DID快照, 只重新编码被写的DID
+    state = ECUState()
+    did = int(did, 0)
+    data = [0x10] if did == 0x0021 else list(b"FVB30FKA034ALDFA1")
+    b(WriteDataByIdentifier().process, [0x2e, did >> 8, did & 0xff] + data, state)
+
+
+@benchmark("service.0x14.ClearDiagnosticInformation", params={"dtcs": [3, 1000]})
+def bench_clear_dtc(b, dtcs):
+    state = ECUState()
+    buffer = tuple(DTC(i & 0xffff, i & 0xff, 0x09) for i in range(dtcs))
+    service = ClearDiagnosticInformation()
+
+    def clear():
+        state.dtcs.dtc_buffer = buffer
+        return service.process([0x14, 0xff, 0xff, 0xff], state)
+
+    b(clear)
+
+
+@benchmark("service.0x19.ReadDTCInformation", params={"dtcs": [3, 100, 1000, 10000]})
+def bench_read_dtc(b, dtcs):
+    state = ECUState(dtcs=DTCBuffer(DTC(i & 0xffff, i & 0xff, (0x09, 0x2e, 0x00)[i % 3]) for i in range(dtcs)))
+    b(ReadDTCInformation().process, [0x19, 0x02, 0x09], state)
+
+
+@benchmark("service.0x31.RoutineControl", params={"routine": ["erase", "check_memory"]})
+def bench_routine_control(b, routine):
+    req = [0x31, 0x01, 0x11, 0x22, 0, 0, 0, 0, 0, 0x10, 0, 0] if routine == "erase" else [0x31, 0x01, 0x33, 0x44]
+    b(RoutineControl().process, req, ECUState())
+
+
+@benchmark("service.0x36.TransferData.block", params={"size": [256, 4093]})
+def bench_transfer_block(b, size):
+    state = ECUState()
+    eol = state.eol
+    block = [0x36, 0x01] + [0x5a] * size
+    service = TransferData()
+
+    def transfer():
+        eol.eol_active_status = False
+        eol.rev_buffer = PagedMemory()
+        return service.process(block, state)
+
+    b(transfer)
+
+
+def download(image_size: int, block_size: int = 4093):
+    erase = [0x31, 0x01, 0x11, 0x22, 0, 0, 0, 0, 0, 0x10, 0, 0]
+    request = [0x34, 0x00, 0x44, 0, 0, 0, 0] + list(image_size.to_bytes(4, "big"))
+    blocks = []
+    counter = 1
+    for offset in range(0, image_size, block_size):
+        blocks.append([0x36, counter] + [offset & 0xff] * min(block_size, image_size - offset))
+        counter = (counter + 1) & 0xff
+    return [erase, request] + blocks + [[0x37]]
+
+
+@benchmark("service.0x34-0x37.download", params={"kib": [64, 1024]}, rounds=5)
+def bench_download(b, kib):
+    services = {0x31: RoutineControl(), 0x34: RequestDownload(), 0x36: TransferData(), 0x37: RequestTransferExit()}
+    sequence = download(kib * 1024)
+    state = ECUState()
+
+    def run():
+        for req in sequence:
+            services[req[0]].process(req, state)
+
+    b.pedantic(run)
+    b.extra["bytes_per_second"] = kib * 1024 / b.stats["median"]
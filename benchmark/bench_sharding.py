@@ -0,0 +1,31 @@
+import multiprocessing
+
+from benchmark import benchmark
+from sharding import ShardedSimulator
+
+ECUS = 8
+BATCH = 250
+# 读10个DID, 让服务处理本身占主要开销
+REQUEST = [0x22] + [0x00, 0x21, 0x00, 0x41, 0x00, 0x51, 0x00, 0x61, 0xf1, 0x91] * 2
+
+
+@benchmark("sharding.throughput", params={"workers": [1, 2, 4, 8]}, rounds=3)
+def bench_throughput(b, workers):
+    sim = ShardedSimulator([{"name": "ecu%d" % i} for i in range(ECUS)], workers=workers)
+    sim.start()
+
+    def run():
+        for _ in range(BATCH):
+            for ecu in range(ECUS):
+                sim.submit(ecu, REQUEST)
+        for _ in range(BATCH):
+            for ecu in range(ECUS):
+                sim.response(ecu, timeout=30)
+
+    try:
+        sim.request(0, REQUEST, timeout=30)
+        b.pedantic(run)
+        b.extra["requests_per_second"] = BATCH * ECUS / b.stats["median"]
+        b.extra["cpu_count"] = multiprocessing.cpu_count()
+    finally:
+        sim.stop()
@@ -0,0 +1,47 @@
+import tracemalloc
+
+from benchmark import benchmark
+from ecustate import ECUState, PagedMemory
+from uds import ServiceDispatcher
+
+
+def _dispatcher(image_mb: int) -> ServiceDispatcher:
+    # ECU里已经下载了image_mb的镜像, 处在编程会话
+    d = ServiceDispatcher(ECUState())
+    d.handle([0x10, 0x02])
+    d.state.eol.rev_buffer = PagedMemory(bytes(range(256)) * (image_mb * 4096))
+    return d
+
+
+def _allocated(func) -> int:
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = func()
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        del kept
+        tracemalloc.stop()
+
+
+@benchmark("snapshot.take", params={"image_mb": [0, 1, 64]})
+def bench_take(b, image_mb):
+    d = _dispatcher(image_mb)
+    b(d.snapshot)
+    b.extra["snapshot_bytes"] = _allocated(d.snapshot)
+    b.extra["full_copy_bytes"] = _allocated(lambda: bytes(d.state.eol.rev_buffer))
+
+
+@benchmark("snapshot.restore", params={"image_mb": [0, 1, 64]})
+def bench_restore(b, image_mb):
+    d = _dispatcher(image_mb)
+    snapshot = d.snapshot()
+
+    def restore():
+        # 模拟一个测试用例: 改了DID和镜像, 然后恢复
+        d.handle([0x2e, 0x00, 0x21, 0x10])
+        d.state.eol.rev_buffer += b"\xff"
+        d.restore(snapshot)
+
+    b(restore)
+    b.extra["restore_bytes"] = _allocated(lambda: d.restore(snapshot))
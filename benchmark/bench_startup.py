@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 冷启动: 新解释器 -> 解析参数/日志配置 -> 建ECU -> 第一条响应
+FIRST_RESPONSE = """
+import main
+ecus = main.main(["--interface", "loopback", "--log-config", {log_config!r}])
+print(ecus[0].transport.tester.request([0x22, 0xf1, 0x91]).hex(), flush=True)
+for ecu in ecus:
+    ecu.stop(0)
+"""
+
+
+def _first_response(log_config: str, cwd: str) -> float:
+    t0 = time.perf_counter()
+    p = subprocess.Popen([sys.executable, "-c", FIRST_RESPONSE.format(log_config=log_config)], cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         env=dict(os.environ, PYTHONPATH=ROOT))
+    line = p.stdout.readline()
+    while line and not line.startswith(b"62f191"):
+        # 日志的console handler也写stdout
+        line = p.stdout.readline()
+    elapsed = time.perf_counter() - t0
+    p.wait()
+    if not line.startswith(b"62f191"):
+        raise RuntimeError(f"unexpected first response {line!r}")
+    return elapsed
+
+
+@benchmark("startup.first_response", params={"logging": ["none", "logconfig"]}, rounds=10)
+def bench_first_response(b, logging):
+    log_config = os.path.join(ROOT, "logconfig.json") if logging == "logconfig" else "none"
+    # 统计的是整个进程的生命周期(含ECU线程退出), 到第一条响应的时间单独记在extra里
+    first = []
+    with tempfile.TemporaryDirectory() as cwd:
+        b.pedantic(lambda: first.append(_first_response(log_config, cwd)))
+    b.extra["first_response"] = sorted(first)[len(first) // 2]
+
+
+@benchmark("startup.interpreter", rounds=10)
+def bench_interpreter(b):
+    # 对照: 空解释器启动到退出
+    b.pedantic(lambda: subprocess.run([sys.executable, "-c", "pass"], check=True))
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+
+from benchmark import benchmark
+from trace_analysis import NpyWriter, decode_file
+from uds_response_code import UDSResponseCode
+
+# 一轮对话: 单帧请求/响应, 多帧VIN读取, 负响应
+CONVERSATION = [
+    "7E0#023E000000000000",
+    "7E8#027E000000000000",
+    "7E0#0322F19100000000",
+    "7E8#101462F191465642",
+    "7E0#3000000000000000",
+    "7E8#2133304B41303334",
+    "7E8#22414C4446413000",
+    "7E0#0322123400000000",
+    "7E8#037F223100000000",
+    "7E0#0319020900000000",
+    "7E8#075902FF00010209",
+]
+
+
+def write_trace(path: str, frames: int):
+    with open(path, "w") as f:
+        ts = 1000.0
+        for i in range(frames):
+            ts += 0.0005
+            f.write("(%.6f) vcan0 %s\n" % (ts, CONVERSATION[i % len(CONVERSATION)]))
+
+
+@benchmark("trace.decode_file", params={"frames": [200000]}, rounds=3)
+def bench_decode_file(b, frames):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "trace.log")
+        write_trace(path, frames)
+
+        def decode():
+            writer = NpyWriter(os.path.join(directory, "out"))
+            decode_file(path, writer, fmt="candump")
+            writer.close()
+
+        b.pedantic(decode)
+        b.extra["frames_per_minute"] = frames * 60 / b.stats["median"]
+    finally:
+        shutil.rmtree(directory)
+
+
+@benchmark("trace.UDSResponseCode.get_name")
+def bench_get_name(b):
+    b(UDSResponseCode.get_name, UDSResponseCode.RequestCorrectlyReceived_ResponsePending)
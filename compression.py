@@ -0,0 +1,91 @@
+import zlib
+
+# dataFormatIdentifier高4位(compressionMethod) -> 解压器, 0为不压缩
+# 1: zlib(RFC1950), 2: LZMA(.xz或.lzma), 3: LZ4 frame(需要安装lz4)
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSION_LZ4 = 3
+
+
+def _lzma():
+    import lzma
+
+    return lzma.LZMADecompressor(lzma.FORMAT_AUTO), lzma.LZMAError
+
+
+def _lz4():
+    import lz4.frame
+
+    return lz4.frame.LZ4FrameDecompressor(), RuntimeError
+
+
+# 工厂返回(解压器, 解压出错时抛出的异常类型); lzma/lz4在第一次用到时才导入
+_FACTORIES = {
+    COMPRESSION_ZLIB: lambda: (zlib.decompressobj(), zlib.error),
+    COMPRESSION_LZMA: _lzma,
+    COMPRESSION_LZ4: _lz4,
+}
+
+
+def compress(data: bytes, method: int) -> bytes:
+    # 诊断仪一侧: 按compressionMethod压缩整个镜像
+    if method == COMPRESSION_NONE:
+        return bytes(data)
+    if method == COMPRESSION_ZLIB:
+        return zlib.compress(data, 9)
+    if method == COMPRESSION_LZMA:
+        import lzma
+
+        return lzma.compress(data)
+    if method == COMPRESSION_LZ4:
+        import lz4.frame
+
+        return lz4.frame.compress(data)
+    raise ValueError(f"compression method {method} is not support.")
+
+
+def is_supported(method: int) -> bool:
+    if method == COMPRESSION_NONE:
+        return True
+    if method not in _FACTORIES:
+        return False
+    try:
+        _FACTORIES[method]()
+    except ImportError:
+        return False
+    return True
+
+
+class StreamDecompressor:
+    # 数据块到达时增量解压, 输出不会超过RequestDownload声明的memorySize
+    def __init__(self, method: int, size: int):
+        self.method = method
+        self.size = size
+        self.written = 0
+        self._d, self._error = _FACTORIES[method]()
+
+    @property
+    def eof(self) -> bool:
+        return self._d.eof
+
+    def feed(self, data) -> bytes:
+        # 解压失败或超出声明的长度抛ValueError, 由TransferData转成NRC
+        limit = self.size - self.written
+        if isinstance(data, list):
+            data = bytes(data)
+        if self._d.eof:
+            # 压缩流已经结束(lzma会抛EOFError), 多出来的数据块按解压错误处理
+            raise ValueError("data after the end of the compressed stream")
+        try:
+            out = self._d.decompress(data, limit + 1)
+        except self._error as e:
+            raise ValueError(f"compressed data error: {e}")
+        if self._d.unused_data:
+            # 同一块里流结束后还有数据, zlib不报错, 只是放进unused_data
+            raise ValueError("data after the end of the compressed stream")
+        if len(out) > limit:
+            raise ValueError(f"decompressed data exceeds memory size {self.size}")
+        self.written += len(out)
+        return out
+
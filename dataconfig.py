@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+from did import compile_dids
+from dtc import compile_dtcs
+from ecustate import ECUState
+
+logger = logging.getLogger("app")
+
+
+class DataReloader:
+    # 从文件重载DID/DTC配置: 解析和编译在调用线程(或监视线程)完成, 最后整体替换快照
+    # states: 要更新的ECU, 缺省是共用的ECUState.default(); 编译一次, 各ECU共用同一份快照
+    def __init__(self, path: str, interval: float = 1.0, states: Iterable[ECUState] = None):
+        self.path = path
+        self.interval = interval
+        self.states = tuple(states) if states is not None else (ECUState.default(),)
+        self.stats = {"reloads": 0, "errors": 0, "compile": None, "swap": None}
+        self._mtime = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def compile(self) -> dict:
+        with open(self.path, "r") as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("data config must be a JSON object")
+        compiled = {}
+        if "dids" in config:
+            compiled["dids"] = compile_dids(config["dids"])
+        if "dtcs" in config:
+            compiled["dtcs"] = compile_dtcs(config["dtcs"])
+        return compiled
+
+    def reload(self) -> dict:
+        t0 = time.perf_counter()
+        compiled = self.compile()
+        t1 = time.perf_counter()
+        for state in self.states:
+            if "dids" in compiled:
+                state.dids.swap(compiled["dids"])
+            if "dtcs" in compiled:
+                state.dtcs.swap(compiled["dtcs"])
+        t2 = time.perf_counter()
+        self.stats["reloads"] += 1
+        self.stats["compile"] = t1 - t0
+        self.stats["swap"] = t2 - t1
+        logger.info(f"data config {self.path} reloaded, compile {t1 - t0:.6f}s swap {t2 - t1:.6f}s")
+        return dict(self.stats)
+
+    def poll(self) -> bool:
+        # 文件修改时间变化时重载, 解析失败保留当前配置
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return self.try_reload()
+
+    def try_reload(self) -> bool:
+        try:
+            self.reload()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.stats["errors"] += 1
+            logger.error(f"data config {self.path} reload failed, keep the current one: {e}")
+            return False
+        return True
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="data-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 1.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _watch(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.interval)
+
+    def install_signal_handler(self, signum=None):
+        # 收到SIGHUP时立即重载
+        import signal
+
+        signum = signum if signum is not None else getattr(signal, "SIGHUP", None)
+        if signum is None:
+            return False
+        signal.signal(signum, lambda sig, frame: threading.Thread(target=self.try_reload, daemon=True).start())
+        return True
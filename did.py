@@ -1,5 +1,8 @@
+import math
 import struct
-from typing import Any
+import threading
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 
 class DIDCoding:
@@ -66,6 +69,7 @@ class AsciiCoding(DIDCoding):
 
 class UCharLinearCoding(DIDCoding):
     def __init__(self, factor: float, offset: float):
+        self._did_len = 1
         self._factor=float(factor)
         self._offset=float(offset)
 
@@ -83,13 +87,14 @@ class UCharLinearCoding(DIDCoding):
 
 class CharLinearCoding(DIDCoding):
     def __init__(self, factor: float, offset: float):
+        self._did_len = 1
         self._factor=float(factor)
         self._offset=float(offset)
 
     def decode(self, inr_value: list) -> float:
         if not len(inr_value) == self._did_len:
             raise Exception("CharLinearCoding function inr_value not equal the setting value" + str(self._did_len))
-        val = list(struct.unpack(">b", bytes(inr_value)))
+        val = list(struct.unpack(">b", bytes(inr_value)))[0]
         return val * self.factor + self.offset
 
     def encode(self, phy_value) -> list:
@@ -100,6 +105,7 @@ class CharLinearCoding(DIDCoding):
 
 class UShortLinearCoding(DIDCoding):
     def __init__(self, factor: float, offset: float):
+        self._did_len = 2
         self._factor=float(factor)
         self._offset=float(offset)
 
@@ -117,6 +123,7 @@ class UShortLinearCoding(DIDCoding):
 
 class ShortLinearCoding(DIDCoding):
     def __init__(self, factor: float, offset: float):
+        self._did_len = 2
         self._factor=float(factor)
         self._offset=float(offset)
 
@@ -132,18 +139,221 @@ class ShortLinearCoding(DIDCoding):
         return bt
 
 
-class DIDList():
-    dict = {
-        0xf191: AsciiCoding(17),  # 车架号
-        0x0021: UCharLinearCoding(0.5, 0),  # 油门开度%
-        0x0041: CharLinearCoding(0.2, 0),  # 电池电压V
-        0x0051: UShortLinearCoding(0.1, 0),  # 发动机转速rpm
-        0x0061: ShortLinearCoding(0.01, 0)  # 车速km/h
-    }
-    value = {
-        0xf191: "FVB30FKA034ALDFA0",
-        0x0021: 100,
-        0x0041: 24,
-        0x0051: 1220,
-        0x0061: 220,
-    }
+class DIDSnapshot:
+    # 不可变的DID表: 编解码器, 物理值, 以及预先编码好的响应片段(DID高低字节+数据)
+    __slots__ = "codecs", "values", "encoded"
+
+    def __init__(self, codecs: Mapping[int, DIDCoding], values: Mapping[int, Any], encoded: Dict[int, bytes] = None):
+        self.codecs = MappingProxyType(dict(codecs))
+        self.values = MappingProxyType(dict(values))
+        if encoded is None:
+            encoded = {}
+            for did, value in self.values.items():
+                if did in self.codecs:
+                    encoded[did] = _encode(did, self.codecs[did], value)
+        self.encoded = MappingProxyType(encoded)
+
+    def replace(self, did: int, value) -> "DIDSnapshot":
+        # 写时复制: 只重新编码被写的DID, 其余条目沿用; 编解码器表直接共用
+        values = self.values.copy()
+        values[did] = value
+        encoded = self.encoded.copy()
+        encoded[did] = _encode(did, self.codecs[did], value)
+        snapshot = DIDSnapshot.__new__(DIDSnapshot)
+        snapshot.codecs = self.codecs
+        snapshot.values = MappingProxyType(values)
+        snapshot.encoded = MappingProxyType(encoded)
+        return snapshot
+
+
+def _encode(did: int, codec: DIDCoding, value) -> bytes:
+    try:
+        return bytes([did >> 8, did & 0xff]) + bytes(codec.encode(value))
+    except struct.error as e:
+        # 超出编码范围的值(例如配置里uchar写了1000), 转成ValueError, 重载时按配置错误处理
+        raise ValueError(f"DID {did:#06x} value {value!r} can not be encoded: {e}") from e
+
+
+CODINGS = {
+    "ascii": lambda c: AsciiCoding(c["length"]),
+    "uchar": lambda c: UCharLinearCoding(c.get("factor", 1), c.get("offset", 0)),
+    "char": lambda c: CharLinearCoding(c.get("factor", 1), c.get("offset", 0)),
+    "ushort": lambda c: UShortLinearCoding(c.get("factor", 1), c.get("offset", 0)),
+    "short": lambda c: ShortLinearCoding(c.get("factor", 1), c.get("offset", 0)),
+}
+
+
+def compile_dids(config: Mapping[str, dict]) -> DIDSnapshot:
+    # {"0xF191": {"coding": "ascii", "length": 17, "value": "..."}, "0x0021": {"coding": "uchar", "factor": 0.5}}
+    # 配置有任何问题都抛ValueError, 重载时整张表不替换
+    if not isinstance(config, Mapping):
+        raise ValueError("dids must be an object of DID: definition")
+    codecs = {}
+    values = {}
+    for key, item in config.items():
+        did = int(key, 0) if isinstance(key, str) else int(key)
+        if not 0 <= did <= 0xffff:
+            raise ValueError(f"DID {key} is out of range")
+        if not isinstance(item, Mapping):
+            raise ValueError(f"DID {did:#06x} definition must be an object")
+        if item.get("coding") not in CODINGS:
+            raise ValueError(f"DID {did:#06x} coding {item.get('coding')} is not support.")
+        codec = codecs[did] = CODINGS[item["coding"]](item)
+        if codec.did_len < 1 or not math.isfinite(codec.factor) or codec.factor == 0 \
+                or not math.isfinite(codec.offset):
+            raise ValueError(f"DID {did:#06x} length/factor/offset is invalid")
+        if "value" in item:
+            values[did] = item["value"]
+    return DIDSnapshot(codecs, values)
+
+
+DYNAMIC_DID_RANGE = range(0xf200, 0xf400)
+
+
+class DynamicDID:
+    # 0x2C定义的动态DID, 定义时编译成取数计划:
+    # ("did", 源DID, 起始, 结束) 按源DID已编码好的字节切片; ("mem", 地址, 长度) 从内存读取
+    __slots__ = "did", "header", "plan", "cacheable", "_cache"
+
+    def __init__(self, did: int, plan: List[tuple] = ()):
+        self.did = did
+        self.header = bytes([did >> 8, did & 0xff])
+        self.plan = tuple(plan)
+        self.cacheable = all(p[0] == "did" for p in self.plan)
+        self._cache = (None, None)
+
+    def extend(self, sources: List[tuple]) -> "DynamicDID":
+        # 追加定义, 同一源里首尾相接的片段合并成一次切片
+        plan = list(self.plan)
+        for src in sources:
+            last = plan[-1] if plan else None
+            if last is not None and last[0] == src[0] == "did" and last[1] == src[1] and last[3] == src[2]:
+                plan[-1] = ("did", src[1], last[2], src[3])
+            elif last is not None and last[0] == src[0] == "mem" and last[1] + last[2] == src[1]:
+                plan[-1] = ("mem", last[1], last[2] + src[2])
+            else:
+                plan.append(src)
+        return DynamicDID(self.did, plan)
+
+    def read(self, snapshot: DIDSnapshot, memory: Callable[[int, int], Optional[bytes]] = None) -> Optional[bytes]:
+        # 返回DID高低字节+数据, 源数据不存在时返回None
+        # 只引用DID的计划随快照缓存, 表没有变化时直接返回上一次的结果
+        cache = self._cache
+        if self.cacheable and cache[0] is snapshot:
+            return cache[1]
+        encoded = snapshot.encoded
+        parts = [self.header]
+        for p in self.plan:
+            if p[0] == "did":
+                e = encoded.get(p[1])
+                if e is None:
+                    return None
+                parts.append(e[p[2]:p[3]])
+            else:
+                m = memory(p[1], p[2]) if memory is not None else None
+                if m is None:
+                    return None
+                parts.append(m)
+        value = b"".join(parts)
+        if self.cacheable:
+            self._cache = (snapshot, value)
+        return value
+
+
+def did_source(snapshot: DIDSnapshot, did: int, position: int, size: int) -> Optional[Tuple[str, int, int, int]]:
+    # position从1开始, 计数不含DID本身的两个字节
+    codec = snapshot.codecs.get(did)
+    if codec is None or position < 1 or size < 1 or position - 1 + size > codec.did_len:
+        return None
+    return "did", did, 1 + position, 1 + position + size
+
+
+class DIDStore:
+    # 一个ECU的DID表. 读服务只读取snapshot这一个属性, 换表是一次赋值, 不需要加锁;
+    # 写方之间用本表自己的锁, 不同ECU互不影响
+    def __init__(self, snapshot: DIDSnapshot):
+        self.snapshot = snapshot
+        # 动态DID同样整体替换: DID -> DynamicDID
+        self.dynamic: Mapping[int, DynamicDID] = MappingProxyType({})
+        # 值发生变化时的回调 listener(did), 由ResponseOnEvent使用; 同样是整体替换的tuple
+        self.listeners = ()
+        self._write_lock = threading.Lock()
+
+    @property
+    def dict(self) -> Mapping[int, DIDCoding]:
+        return self.snapshot.codecs
+
+    @property
+    def value(self) -> Mapping[int, Any]:
+        return self.snapshot.values
+
+    def swap(self, snapshot: DIDSnapshot, dynamic: Mapping[int, DynamicDID] = None) -> DIDSnapshot:
+        # dynamic不为None时同时替换动态DID定义(恢复快照时用)
+        with self._write_lock:
+            old = self.snapshot
+            self.snapshot = snapshot
+            if dynamic is not None:
+                self.dynamic = dynamic
+        if self.listeners:
+            old_encoded = old.encoded
+            self._notify([d for d, e in snapshot.encoded.items() if old_encoded.get(d) != e])
+        return old
+
+    def write(self, did: int, value):
+        with self._write_lock:
+            if did not in self.snapshot.codecs:
+                # 写请求处理期间配置被重载, 该DID已经不存在
+                return
+            old = self.snapshot.encoded.get(did)
+            snapshot = self.snapshot.replace(did, value)
+            self.snapshot = snapshot
+        if self.listeners and snapshot.encoded[did] != old:
+            self._notify((did,))
+
+    def add_listener(self, listener: Callable[[int], None]):
+        with self._write_lock:
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener: Callable[[int], None]):
+        with self._write_lock:
+            self.listeners = tuple(x for x in self.listeners if x != listener)
+
+    def _notify(self, dids):
+        listeners = self.listeners
+        for did in dids:
+            for listener in listeners:
+                listener(did)
+
+    def define(self, did: int, sources: List[tuple]):
+        with self._write_lock:
+            dynamic = dict(self.dynamic)
+            dynamic[did] = dynamic.get(did, DynamicDID(did)).extend(sources)
+            self.dynamic = MappingProxyType(dynamic)
+
+    def clear_dynamic(self, did: Optional[int] = None) -> bool:
+        with self._write_lock:
+            if did is None:
+                self.dynamic = MappingProxyType({})
+                return True
+            if did not in self.dynamic:
+                return False
+            dynamic = dict(self.dynamic)
+            del dynamic[did]
+            self.dynamic = MappingProxyType(dynamic)
+            return True
+
+
+# 缺省的DID表, 新建的ECU状态从它的快照开始(共用同一份不可变快照)
+DIDList = DIDStore(DIDSnapshot({
+    0xf191: AsciiCoding(17),  # 车架号
+    0x0021: UCharLinearCoding(0.5, 0),  # 油门开度%
+    0x0041: CharLinearCoding(0.2, 0),  # 电池电压V
+    0x0051: UShortLinearCoding(0.1, 0),  # 发动机转速rpm
+    0x0061: ShortLinearCoding(0.01, 0)  # 车速km/h
+}, {
+    0xf191: "FVB30FKA034ALDFA0",
+    0x0021: 100,
+    0x0041: 24,
+    0x0051: 1220,
+    0x0061: 220,
+}))
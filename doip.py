@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import socket
+import struct
+import threading
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger("app")
+
+DOIP_PORT = 13400
+PROTOCOL_VERSION = 0x02
+HEADER = struct.Struct(">BBHI")
+HEADER_SIZE = HEADER.size
+
+# 负载类型 ISO 13400-2 表17
+GENERIC_NACK = 0x0000
+VEHICLE_ID_REQUEST = 0x0001
+VEHICLE_ID_REQUEST_EID = 0x0002
+VEHICLE_ID_REQUEST_VIN = 0x0003
+VEHICLE_ANNOUNCEMENT = 0x0004
+ROUTING_ACTIVATION_REQUEST = 0x0005
+ROUTING_ACTIVATION_RESPONSE = 0x0006
+ALIVE_CHECK_REQUEST = 0x0007
+ALIVE_CHECK_RESPONSE = 0x0008
+ENTITY_STATUS_REQUEST = 0x4001
+ENTITY_STATUS_RESPONSE = 0x4002
+POWER_MODE_REQUEST = 0x4003
+POWER_MODE_RESPONSE = 0x4004
+DIAGNOSTIC_MESSAGE = 0x8001
+DIAGNOSTIC_ACK = 0x8002
+DIAGNOSTIC_NACK = 0x8003
+
+# 通用NACK码
+NACK_INCORRECT_PATTERN = 0x00
+NACK_UNKNOWN_PAYLOAD_TYPE = 0x01
+NACK_MESSAGE_TOO_LARGE = 0x02
+NACK_INVALID_PAYLOAD_LENGTH = 0x04
+
+# 诊断消息NACK码
+DIAG_NACK_INVALID_SOURCE = 0x02
+DIAG_NACK_UNKNOWN_TARGET = 0x03
+DIAG_NACK_MESSAGE_TOO_LARGE = 0x04
+
+ROUTING_SUCCESS = 0x10
+ROUTING_UNSUPPORTED_TYPE = 0x06
+
+TRANSFER_DATA = 0x36
+
+
+def pack_message(payload_type: int, payload=b"") -> bytes:
+    return HEADER.pack(PROTOCOL_VERSION, PROTOCOL_VERSION ^ 0xff, payload_type, len(payload)) + bytes(payload)
+
+
+class DoIPServer:
+    # ecus: ECU逻辑地址 -> 分发器工厂, 例如 lambda: ServiceDispatcher(ecu.state). 每条TCP连接第一次访问该ECU时调用一次,
+    # 得到这条连接自己的分发器(handle(data), close()), 诊断仪之间的会话和0x84密钥上下文互不影响
+    def __init__(self, ecus: Dict[int, Callable], vin: str = "ECUSIM00000000000", eid: bytes = b"\x00" * 6,
+                 gid: bytes = b"\x00" * 6, entity_address: Optional[int] = None, host: str = "127.0.0.1",
+                 port: int = DOIP_PORT, max_data_size: int = 0x4000, announce: tuple = None):
+        if len(vin) != 17:
+            raise ValueError(f"vin {vin} must be 17 characters.")
+        self.ecus = dict(ecus)
+        self.vin = vin.encode("ascii")
+        self.eid = bytes(eid)
+        self.gid = bytes(gid)
+        self.entity_address = entity_address if entity_address is not None else next(iter(self.ecus))
+        self.host = host
+        self.port = port
+        self.udp_port = port
+        self.max_data_size = max_data_size
+        self.announce = announce
+        self.connections = set()
+        self._loop = None
+        self._thread = None
+        self._tcp = None
+        self._udp = None
+
+    def start(self):
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="doip", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if isinstance(self._tcp, BaseException):
+            raise self._tcp
+
+    def _run(self, ready: threading.Event):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        try:
+            self._tcp = loop.run_until_complete(
+                loop.create_server(lambda: _DoIPConnection(self), self.host, self.port))
+            self.port = self._tcp.sockets[0].getsockname()[1]
+            self._udp, _ = loop.run_until_complete(
+                loop.create_datagram_endpoint(lambda: _DoIPDatagram(self), local_addr=(self.host, self.port),
+                                              allow_broadcast=True))
+            self.udp_port = self._udp.get_extra_info("sockname")[1]
+        except OSError as e:
+            self._tcp = e
+            ready.set()
+            return
+        ready.set()
+        if self.announce is not None:
+            # 上电后发三次车辆声明
+            for _ in range(3):
+                self._udp.sendto(pack_message(VEHICLE_ANNOUNCEMENT, self.vehicle_identification()), self.announce)
+        loop.run_forever()
+        self._tcp.close()
+        self._udp.close()
+        for conn in list(self.connections):
+            conn.transport.close()
+        loop.run_until_complete(self._tcp.wait_closed())
+        loop.close()
+
+    def stop(self, timeout: float = 1.0):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def vehicle_identification(self) -> bytes:
+        # VIN, 逻辑地址, EID, GID, 后续动作(0:无), VIN/GID同步状态(0:已同步)
+        return self.vin + self.entity_address.to_bytes(2, "big") + self.eid + self.gid + b"\x00\x00"
+
+    def entity_status(self) -> bytes:
+        # 节点类型(0x01:DoIP节点), 最大并发连接数, 当前连接数, 最大数据长度
+        return bytes([0x01, 0xff, min(len(self.connections), 0xff)]) + (HEADER_SIZE + self.max_data_size).to_bytes(
+            4, "big")
+
+
+class _DoIPDatagram(asyncio.DatagramProtocol):
+    def __init__(self, server: DoIPServer):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < HEADER_SIZE:
+            return
+        version, inverse, payload_type, length = HEADER.unpack_from(data)
+        server = self.server
+        if version ^ inverse != 0xff:
+            self.transport.sendto(pack_message(GENERIC_NACK, bytes([NACK_INCORRECT_PATTERN])), addr)
+            return
+        payload = data[HEADER_SIZE:HEADER_SIZE + length]
+        if payload_type == VEHICLE_ID_REQUEST or (payload_type == VEHICLE_ID_REQUEST_EID and payload == server.eid) \
+                or (payload_type == VEHICLE_ID_REQUEST_VIN and payload == server.vin):
+            self.transport.sendto(pack_message(VEHICLE_ANNOUNCEMENT, server.vehicle_identification()), addr)
+        elif payload_type == ENTITY_STATUS_REQUEST:
+            self.transport.sendto(pack_message(ENTITY_STATUS_RESPONSE, server.entity_status()), addr)
+        elif payload_type == POWER_MODE_REQUEST:
+            self.transport.sendto(pack_message(POWER_MODE_RESPONSE, b"\x01"), addr)
+        elif payload_type not in (VEHICLE_ID_REQUEST_EID, VEHICLE_ID_REQUEST_VIN):
+            self.transport.sendto(pack_message(GENERIC_NACK, bytes([NACK_UNKNOWN_PAYLOAD_TYPE])), addr)
+
+
+class _DoIPConnection(asyncio.BufferedProtocol):
+    # socket直接recv_into固定大小的接收缓冲区, 诊断数据以memoryview切片交给服务,不经过中间list
+    def __init__(self, server: DoIPServer):
+        self.server = server
+        self.transport = None
+        self.tester = None
+        # 目标逻辑地址 -> 本连接的分发器
+        self._dispatchers = {}
+        self._buffer = bytearray(HEADER_SIZE + server.max_data_size)
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+        self._discard = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        for dispatcher in self._dispatchers.values():
+            dispatcher.close()
+        self._dispatchers.clear()
+
+    def get_buffer(self, sizehint: int):
+        return self._view[self._filled:]
+
+    def buffer_updated(self, nbytes: int):
+        if self._discard:
+            # 丢弃超长消息剩下的部分
+            skip = min(nbytes, self._discard)
+            self._discard -= skip
+            if skip < nbytes:
+                self._buffer[:nbytes - skip] = bytes(self._view[self._filled + skip:self._filled + nbytes])
+            nbytes -= skip
+        self._filled += nbytes
+        start = 0
+        while self._filled - start >= HEADER_SIZE:
+            version, inverse, payload_type, length = HEADER.unpack_from(self._buffer, start)
+            if version ^ inverse != 0xff:
+                self._send(GENERIC_NACK, bytes([NACK_INCORRECT_PATTERN]))
+                self.transport.close()
+                self._filled = 0
+                return
+            if length > self.server.max_data_size:
+                self._send(GENERIC_NACK, bytes([NACK_MESSAGE_TOO_LARGE]))
+                available = self._filled - start - HEADER_SIZE
+                self._discard = length - available
+                start = self._filled
+                if self._discard < 0:
+                    start += self._discard
+                    self._discard = 0
+                continue
+            end = start + HEADER_SIZE + length
+            if end > self._filled:
+                break
+            self._dispatch(payload_type, self._view[start + HEADER_SIZE:end])
+            start = end
+        if start:
+            remain = self._filled - start
+            self._buffer[:remain] = bytes(self._view[start:self._filled])
+            self._filled = remain
+
+    def _send(self, payload_type: int, payload=b""):
+        self.transport.write(pack_message(payload_type, payload))
+
+    def _dispatch(self, payload_type: int, payload: memoryview):
+        if payload_type == DIAGNOSTIC_MESSAGE:
+            self._diagnostic_message(payload)
+        elif payload_type == ROUTING_ACTIVATION_REQUEST:
+            self._routing_activation(payload)
+        elif payload_type == ALIVE_CHECK_REQUEST:
+            self._send(ALIVE_CHECK_RESPONSE, (self.tester or 0).to_bytes(2, "big"))
+        elif payload_type == ALIVE_CHECK_RESPONSE:
+            pass
+        elif payload_type == ENTITY_STATUS_REQUEST:
+            self._send(ENTITY_STATUS_RESPONSE, self.server.entity_status())
+        elif payload_type == POWER_MODE_REQUEST:
+            self._send(POWER_MODE_RESPONSE, b"\x01")
+        else:
+            self._send(GENERIC_NACK, bytes([NACK_UNKNOWN_PAYLOAD_TYPE]))
+
+    def _routing_activation(self, payload: memoryview):
+        if len(payload) not in (7, 11):
+            self._send(GENERIC_NACK, bytes([NACK_INVALID_PAYLOAD_LENGTH]))
+            return
+        source = (payload[0] << 8) | payload[1]
+        code = ROUTING_SUCCESS if payload[2] in (0x00, 0x01) else ROUTING_UNSUPPORTED_TYPE
+        if code == ROUTING_SUCCESS:
+            self.tester = source
+        self._send(ROUTING_ACTIVATION_RESPONSE, bytes(payload[0:2]) +
+                   self.server.entity_address.to_bytes(2, "big") + bytes([code]) + b"\x00" * 4)
+
+    def _diagnostic_message(self, payload: memoryview):
+        if len(payload) < 5:
+            self._send(GENERIC_NACK, bytes([NACK_INVALID_PAYLOAD_LENGTH]))
+            return
+        addresses = bytes(payload[0:4])
+        source = (payload[0] << 8) | payload[1]
+        target = (payload[2] << 8) | payload[3]
+        reply = addresses[2:4] + addresses[0:2]
+        if source != self.tester:
+            self._send(DIAGNOSTIC_NACK, reply + bytes([DIAG_NACK_INVALID_SOURCE]))
+            return
+        dispatcher = self._dispatchers.get(target)
+        if dispatcher is None:
+            factory = self.server.ecus.get(target)
+            if factory is None:
+                self._send(DIAGNOSTIC_NACK, reply + bytes([DIAG_NACK_UNKNOWN_TARGET]))
+                return
+            dispatcher = self._dispatchers[target] = factory()
+        self._send(DIAGNOSTIC_ACK, reply + b"\x00")
+        data = payload[4:]
+        # TransferData只把数据块拷进下载缓冲区,可以直接用接收缓冲区的视图;其它服务可能保留请求,先复制一份
+        try:
+            r = dispatcher.handle(data if data[0] == TRANSFER_DATA else bytes(data))
+        except Exception:
+            logger.exception(f"DoIP request {bytes(data[:3]).hex()} failed.")
+            return
+        finally:
+            data.release()
+        if r is not None:
+            self._send(DIAGNOSTIC_MESSAGE, reply + bytes(r))
+
+
+class DoIPClient:
+    # 同步的DoIP诊断仪, 供测试/负载生成使用
+    def __init__(self, host: str = "127.0.0.1", port: int = DOIP_PORT, source_address: int = 0x0e00,
+                 timeout: float = 2.0):
+        self.host = host
+        self.port = port
+        self.source_address = source_address
+        self.timeout = timeout
+        self.entity_address = None
+        self._sock = None
+        self._rx = bytearray()
+
+    def connect(self) -> int:
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_message(ROUTING_ACTIVATION_REQUEST, self.source_address.to_bytes(2, "big") + b"\x00" + b"\x00" * 4)
+        payload_type, payload = self.recv_message()
+        if payload_type != ROUTING_ACTIVATION_RESPONSE or payload[4] != ROUTING_SUCCESS:
+            raise ConnectionError(f"DoIP routing activation failed: {payload_type:#06x} {payload.hex()}")
+        self.entity_address = int.from_bytes(payload[2:4], "big")
+        return self.entity_address
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def send_message(self, payload_type: int, payload=b""):
+        self._sock.sendall(pack_message(payload_type, payload))
+
+    def recv_message(self):
+        while True:
+            if len(self._rx) >= HEADER_SIZE:
+                _, _, payload_type, length = HEADER.unpack_from(self._rx)
+                if len(self._rx) >= HEADER_SIZE + length:
+                    payload = bytes(self._rx[HEADER_SIZE:HEADER_SIZE + length])
+                    del self._rx[:HEADER_SIZE + length]
+                    return payload_type, payload
+            chunk = self._sock.recv(1 << 16)
+            if not chunk:
+                raise ConnectionError("DoIP connection closed.")
+            self._rx += chunk
+
+    def request(self, data, target: Optional[int] = None, timeout: Optional[float] = None) -> Optional[bytes]:
+        # 返回UDS响应; 抑制正响应或超时返回None
+        target = self.entity_address if target is None else target
+        self._sock.settimeout(timeout or self.timeout)
+        self.send_message(DIAGNOSTIC_MESSAGE, self.source_address.to_bytes(2, "big") + target.to_bytes(2, "big")
+                          + bytes(data))
+        try:
+            payload_type, payload = self.recv_message()
+            if payload_type == DIAGNOSTIC_NACK:
+                raise ConnectionError(f"DoIP diagnostic message nack {payload[4]:#04x}")
+            if payload_type != DIAGNOSTIC_ACK:
+                raise ConnectionError(f"unexpected DoIP payload type {payload_type:#06x}")
+            payload_type, payload = self.recv_message()
+            return payload[4:]
+        except socket.timeout:
+            return None
+
+
+def identify(host: str = "127.0.0.1", port: int = DOIP_PORT, timeout: float = 1.0) -> Optional[bytes]:
+    # UDP车辆识别请求, 返回车辆声明的负载
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(timeout)
+        s.sendto(pack_message(VEHICLE_ID_REQUEST), (host, port))
+        try:
+            data, _ = s.recvfrom(1 << 12)
+        except socket.timeout:
+            return None
+    _, _, payload_type, length = HEADER.unpack_from(data)
+    return data[HEADER_SIZE:HEADER_SIZE + length] if payload_type == VEHICLE_ANNOUNCEMENT else None
@@ -1,4 +1,4 @@
-from uds_addtion import Singleton
+import threading
 
 
 class DTCValue:
@@ -118,23 +118,75 @@ class DTC():
         self.dtc_st = DTCStatus(status)
 
 
-@Singleton
+def compile_dtcs(config) -> tuple:
+    # [{"pcode": "0x0235", "ftb": 12, "status": "0xfe"}, ...]
+    # 范围在这里检查, 不然要到0x19组响应时才出错; 配置有问题时抛ValueError, 重载时整张表不替换
+    def _int(c, name, limit):
+        v = c[name]
+        v = int(v, 0) if isinstance(v, str) else int(v)
+        if not 0 <= v <= limit:
+            raise ValueError(f"DTC {name} {c[name]} is out of range")
+        return v
+
+    if not isinstance(config, list):
+        raise ValueError("dtcs must be a list of DTC definitions")
+    dtcs = []
+    for c in config:
+        if not isinstance(c, dict):
+            raise ValueError("DTC definition must be an object")
+        dtcs.append(DTC(_int(c, "pcode", 0xffff), _int(c, "ftb", 0xff), _int(c, "status", 0xff)))
+    return tuple(dtcs)
+
+
+DEFAULT_DTCS = (DTC(1, 2, 0xcd), DTC(0x235, 12, 0xfe), DTC(0xd982, 0xf, 0x2e))
+
+
 class DTCBuffer():
-    def __init__(self):
-        self.dtc_buffer = [DTC(1, 2, 0xcd), DTC(0x235, 12, 0xfe), DTC(0xd982, 0xf, 0x2e)]
+    # dtc_buffer是不可变的tuple, 修改时整体替换, 读的一方拿到的总是完整的一份;
+    # 写方之间用本缓冲区自己的锁, 每个ECU一个
+    def __init__(self, dtcs: tuple = None):
+        self.dtc_buffer = DEFAULT_DTCS if dtcs is None else tuple(dtcs)
+        # 状态变化回调 listener(dtc编号, 旧状态, 新状态), 由ResponseOnEvent使用
+        self.listeners = ()
+        self._write_lock = threading.Lock()
+
+    def swap(self, dtcs: tuple) -> tuple:
+        new = tuple(dtcs)
+        with self._write_lock:
+            old = self.dtc_buffer
+            self.dtc_buffer = new
+        self._changed(old, new)
+        return old
 
     def add_dtc(self, pcode, ftb, status):
-        self.dtc_buffer.append(DTC(pcode, ftb, status))
+        dtc = DTC(pcode, ftb, status)
+        with self._write_lock:
+            self.dtc_buffer = self.dtc_buffer + (dtc,)
+        self._notify(dtc, 0, status)
+
+    def set_status(self, pcode, ftb, status):
+        # 修改一个DTC的状态, 不存在时添加
+        dtc = DTC(pcode, ftb, status)
+        with self._write_lock:
+            old = self.dtc_buffer
+            for i, element in enumerate(old):
+                if element.dtc_val.pcode == pcode and element.dtc_val.ftb == ftb:
+                    self.dtc_buffer = old[:i] + (dtc,) + old[i + 1:]
+                    before = element.dtc_st.status
+                    break
+            else:
+                self.dtc_buffer = old + (dtc,)
+                before = 0
+        self._notify(dtc, before, status)
 
     def clear_alldtc(self):
-        self.dtc_buffer.clear()
+        self.swap(())
 
     def clear_dtc_by_msk(self, msk: int):
-        bu = []
-        for i, element in enumerate(self.dtc_buffer):
-            if not element.dtc_st.check_msk_is_match(msk):
-                bu.append(element)
-        self.dtc_buffer = bu
+        with self._write_lock:
+            old = self.dtc_buffer
+            new = self.dtc_buffer = tuple(e for e in old if not e.dtc_st.check_msk_is_match(msk))
+        self._changed(old, new)
 
     def get_dtc_by_msk(self, msk: int):
         rr = []
@@ -142,3 +194,26 @@ class DTCBuffer():
             if element.dtc_st.check_msk_is_match(msk):
                 rr.append(element)
         return rr
+
+    def add_listener(self, listener):
+        with self._write_lock:
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        with self._write_lock:
+            self.listeners = tuple(x for x in self.listeners if x != listener)
+
+    def _notify(self, dtc: DTC, old: int, new: int):
+        if old != new:
+            for listener in self.listeners:
+                listener((dtc.dtc_val.pcode << 8) + dtc.dtc_val.ftb, old, new)
+
+    def _changed(self, old: tuple, new: tuple):
+        if not self.listeners:
+            return
+        before = {(e.dtc_val.pcode, e.dtc_val.ftb): e for e in old}
+        for e in new:
+            prev = before.pop((e.dtc_val.pcode, e.dtc_val.ftb), None)
+            self._notify(e, 0 if prev is None else prev.dtc_st.status, e.dtc_st.status)
+        for e in before.values():
+            self._notify(e, e.dtc_st.status, 0)
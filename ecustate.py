@@ -0,0 +1,202 @@
+import threading
+from typing import Iterable, Mapping, Optional
+
+from did import DIDList, DIDSnapshot, DIDStore, DynamicDID
+from dtc import DTCBuffer
+
+
+class PagedMemory:
+    # 按页保存的下载镜像: 写满的页是不可变的bytes, 只有最后一页是可变的bytearray.
+    # copy()只复制页列表, 64MB的镜像做快照也只是1024个引用加最后一页; 改已写满的页时只替换那一页
+    PAGE_SIZE = 1 << 16
+
+    def __init__(self, data=b""):
+        self._pages = []
+        self._tail = bytearray()
+        self.extend(data)
+
+    def extend(self, data):
+        tail = self._tail
+        tail.extend(data)
+        while len(tail) >= self.PAGE_SIZE:
+            self._pages.append(bytes(tail[:self.PAGE_SIZE]))
+            del tail[:self.PAGE_SIZE]
+
+    def __iadd__(self, data):
+        self.extend(data)
+        return self
+
+    def copy(self) -> "PagedMemory":
+        memory = PagedMemory.__new__(PagedMemory)
+        memory._pages = list(self._pages)
+        memory._tail = bytearray(self._tail)
+        return memory
+
+    def __len__(self) -> int:
+        return len(self._pages) * self.PAGE_SIZE + len(self._tail)
+
+    def __bytes__(self) -> bytes:
+        return b"".join(self._pages) + self._tail
+
+    def __eq__(self, other):
+        if isinstance(other, PagedMemory):
+            return self._pages == other._pages and self._tail == other._tail
+        if isinstance(other, (bytes, bytearray, memoryview)):
+            return len(self) == len(other) and bytes(self) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return bytes(self)[index]
+            parts = []
+            while start < stop:
+                page, offset = divmod(start, self.PAGE_SIZE)
+                chunk = (self._pages[page] if page < len(self._pages) else self._tail)[offset:offset + stop - start]
+                parts.append(chunk)
+                start += len(chunk)
+            return b"".join(parts)
+        page, offset = divmod(range(len(self))[index], self.PAGE_SIZE)
+        return (self._pages[page] if page < len(self._pages) else self._tail)[offset]
+
+    def __setitem__(self, index: int, value: int):
+        page, offset = divmod(range(len(self))[index], self.PAGE_SIZE)
+        if page < len(self._pages):
+            # 写时复制: 只替换这一页, 共用旧页的快照不受影响
+            data = bytearray(self._pages[page])
+            data[offset] = value
+            self._pages[page] = bytes(data)
+        else:
+            self._tail[offset] = value
+
+
+class EOL():
+    # 刷写(下载)状态. 0x31擦除/0x34/0x36/0x37在lock里修改, 同一ECU的两个刷写诊断仪不会交错写坏状态;
+    # 读DID/DTC不碰这把锁
+    maxNumberOfBlockLength = 0x0fff
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 参考软件(flashimage.ReferenceImage), 设置后每次下载都边收边比较, 不随reset清除
+        self.reference = None
+        self.reset()
+
+    def reset(self):
+        self.eol_active_status = False
+        self.eol_start_address = 0
+        self.eol_size_of_data = 0
+        self.eol_transferred_size = 0
+        self.eol_rev_count = 0
+        self.eol_rev_block_count = 0
+        self.maxNumberOfBlockLength = 0x0fff
+        self.rev_buffer = PagedMemory()
+        self.erase_flash_start_address = 0
+        self.erase_flash_size = 0
+        self.decompressor = None
+        self.verifier = None
+        self.verify_result = None
+
+    def read_memory(self, address: int, size: int) -> Optional[bytes]:
+        # 仿真器的内存就是已下载的镜像, 从eol_start_address开始
+        # 不加锁: 缓冲区只取一次引用, 下载中读到的是已经写入的部分
+        buffer = self.rev_buffer
+        offset = address - self.eol_start_address
+        if offset < 0 or offset + size > len(buffer):
+            return None
+        return buffer[offset:offset + size]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            fields = {k: v for k, v in vars(self).items() if k != "lock"}
+            fields["rev_buffer"] = self.rev_buffer.copy()
+            fields["verifier"] = self.verifier.copy() if self.verifier is not None else None
+            if self.decompressor is not None:
+                # 解压器的内部状态不能复制: 压缩下载进行到一半时做的快照, 恢复后没有进行中的传输
+                fields["eol_active_status"] = False
+                fields["decompressor"] = None
+        return fields
+
+    def restore(self, fields: dict):
+        with self.lock:
+            vars(self).update(fields)
+            # 同一个快照可以恢复多次, 镜像再复制一次页列表
+            self.rev_buffer = fields["rev_buffer"].copy()
+            self.verifier = fields["verifier"].copy() if fields["verifier"] is not None else None
+
+
+class ReplayCounter:
+    # 0x84请求的16位防重放计数器: 整个ECU(所有诊断仪连接)共用, ECUReset和恢复快照都不回退, 换密钥时重新开始.
+    # 按序号算术(RFC 1982)比较: 比上一次接受的值往前1..WINDOW-1(模0x10000)才接受, 0xffff之后接着从0数,
+    # 超过65535条消息的刷写不会被计数器卡住.
+    # 诊断仪同步: 换密钥后的第一条请求计数器任意, 之后每条加1(模0x10000), 可以跳过但不能回退.
+    # 不知道ECU当前计数器时(例如诊断仪重启), 依次用c, c+0x4000, c+0x8000, c+0xC000发请求直到不再被拒(0x3A),
+    # 其中必有一个落在窗口里
+    WINDOW = 0x8000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = None
+
+    def accept(self, counter: int) -> bool:
+        with self.lock:
+            if self.last is not None and not 0 < (counter - self.last) & 0xffff < self.WINDOW:
+                return False
+            self.last = counter & 0xffff
+            return True
+
+
+class StateSnapshot:
+    # ECU状态的快照. DID表/DTC缓冲区本来就是不可变的, 这里只保存引用; 下载镜像和快照共用已写满的页
+    # session由ServiceDispatcher.snapshot()填入, 只对ECUState做的快照为None
+    __slots__ = "dids", "dynamic", "dtcs", "eol", "session"
+
+    def __init__(self, dids: DIDSnapshot, dynamic: Mapping[int, DynamicDID], dtcs: tuple, eol: dict,
+                 session: Optional[int] = None):
+        self.dids = dids
+        self.dynamic = dynamic
+        self.dtcs = dtcs
+        self.eol = eol
+        self.session = session
+
+
+class ECUState:
+    # 一个ECU的全部可变状态, 同一ECU的多个诊断仪(例如CAN上的刷写和DoIP上的数据记录)共用一份;
+    # 每个资源各自处理并发, 不用一把大锁: DID表/DTC缓冲区是不可变快照+原子替换, 读不加锁, 写方各有一把锁;
+    # 下载状态由EOL.lock串行
+    def __init__(self, dids: DIDStore = None, dtcs: DTCBuffer = None, eol: EOL = None, secure_key: bytes = None,
+                 secured_services: Iterable[int] = ()):
+        self.dids = DIDStore(DIDList.snapshot) if dids is None else dids
+        self.dtcs = DTCBuffer() if dtcs is None else dtcs
+        self.eol = EOL() if eol is None else eol
+        # SecuredDataTransmission(0x84)的预共享AES密钥; secured_services里的服务只能包在0x84里请求
+        self.secure_key = secure_key
+        self.secured_services = frozenset(secured_services)
+
+    @property
+    def secure_key(self) -> Optional[bytes]:
+        return self._secure_key
+
+    @secure_key.setter
+    def secure_key(self, key: Optional[bytes]):
+        # 防重放计数器跟着密钥走, 不属于快照
+        self._secure_key = key
+        self.replay = ReplayCounter()
+
+    def snapshot(self) -> StateSnapshot:
+        return StateSnapshot(self.dids.snapshot, self.dids.dynamic, self.dtcs.dtc_buffer, self.eol.snapshot())
+
+    def restore(self, snapshot: StateSnapshot):
+        self.dids.swap(snapshot.dids, snapshot.dynamic)
+        self.dtcs.swap(snapshot.dtcs)
+        self.eol.restore(snapshot.eol)
+
+    @classmethod
+    def default(cls) -> "ECUState":
+        # 没有指定状态的分发器共用这一份, 它的DID表就是did.DIDList
+        return _default_state
+
+
+_default_state = ECUState(DIDList)
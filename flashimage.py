@@ -0,0 +1,272 @@
+import logging
+import mmap
+import os
+from binascii import unhexlify
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("app")
+
+FORMAT_BINARY = "bin"
+FORMAT_IHEX = "ihex"
+FORMAT_SREC = "srec"
+
+_EXTENSIONS = {
+    ".hex": FORMAT_IHEX, ".ihex": FORMAT_IHEX, ".ihx": FORMAT_IHEX,
+    ".s19": FORMAT_SREC, ".s28": FORMAT_SREC, ".s37": FORMAT_SREC, ".srec": FORMAT_SREC, ".mot": FORMAT_SREC,
+    ".bin": FORMAT_BINARY,
+}
+# S1/S2/S3数据记录的地址字节数
+_SREC_ADDRESS_SIZE = {ord("1"): 2, ord("2"): 3, ord("3"): 4}
+CHUNK_SIZE = 1 << 16
+
+
+def detect_format(path: str) -> str:
+    fmt = _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is not None:
+        return fmt
+    with open(path, "rb") as f:
+        head = f.read(2)
+    if head[:1] == b":":
+        return FORMAT_IHEX
+    if head[:1] == b"S" and head[1:2].isdigit():
+        return FORMAT_SREC
+    return FORMAT_BINARY
+
+
+def _ihex_records(f, offset: int, base: int) -> Iterator[Tuple[int, int, int, bytes]]:
+    # 产生(行偏移, 该行生效的扩展地址, 地址, 数据); 从offset开始时需要给出当时生效的扩展地址
+    f.seek(offset)
+    pos = offset
+    for line in f:
+        start, pos = pos, pos + len(line)
+        line = line.strip()
+        if not line:
+            continue
+        if line[:1] != b":":
+            raise ValueError(f"Intel HEX line at offset {start} does not start with ':'.")
+        raw = unhexlify(line[1:])
+        if len(raw) < 5 or len(raw) != raw[0] + 5 or sum(raw) & 0xff:
+            raise ValueError(f"Intel HEX line at offset {start} has bad length or checksum.")
+        kind = raw[3]
+        if kind == 0x00:
+            yield start, base, base + ((raw[1] << 8) | raw[2]), raw[4:-1]
+        elif kind == 0x01:
+            return
+        elif kind == 0x02:
+            base = ((raw[4] << 8) | raw[5]) << 4
+        elif kind == 0x04:
+            base = ((raw[4] << 8) | raw[5]) << 16
+
+
+def _srec_records(f, offset: int, base: int = 0) -> Iterator[Tuple[int, int, int, bytes]]:
+    f.seek(offset)
+    pos = offset
+    for line in f:
+        start, pos = pos, pos + len(line)
+        line = line.strip()
+        if not line:
+            continue
+        if line[:1] != b"S":
+            raise ValueError(f"S-record line at offset {start} does not start with 'S'.")
+        raw = unhexlify(line[2:])
+        if len(raw) != raw[0] + 1 or sum(raw) & 0xff != 0xff:
+            raise ValueError(f"S-record line at offset {start} has bad length or checksum.")
+        size = _SREC_ADDRESS_SIZE.get(line[1])
+        if size is not None:
+            yield start, 0, int.from_bytes(raw[1:1 + size], "big"), raw[1 + size:-1]
+        elif line[1] in b"789":
+            return
+
+
+_RECORDS = {FORMAT_IHEX: _ihex_records, FORMAT_SREC: _srec_records}
+
+
+def _ihex_line(kind: int, address: int, data: bytes) -> bytes:
+    raw = bytes([len(data), address >> 8 & 0xff, address & 0xff, kind]) + data
+    return b":%s%02X\n" % (raw.hex().upper().encode(), -sum(raw) & 0xff)
+
+
+def write_ihex(f, segments, record_size: int = 32):
+    # segments: [(地址, 数据)], 生成参考文件用(测试/基准); 记录不跨64K边界
+    base = None
+    for address, data in segments:
+        offset = 0
+        while offset < len(data):
+            at = address + offset
+            size = min(record_size, len(data) - offset, 0x10000 - (at & 0xffff))
+            if at >> 16 != base:
+                base = at >> 16
+                f.write(_ihex_line(0x04, 0, base.to_bytes(2, "big")))
+            f.write(_ihex_line(0x00, at & 0xffff, bytes(data[offset:offset + size])))
+            offset += size
+    f.write(_ihex_line(0x01, 0, b""))
+
+
+def write_srec(f, segments, record_size: int = 32):
+    for address, data in segments:
+        for offset in range(0, len(data), record_size):
+            chunk = bytes(data[offset:offset + record_size])
+            raw = bytes([len(chunk) + 5]) + (address + offset).to_bytes(4, "big") + chunk
+            f.write(b"S3%s%02X\n" % (raw.hex().upper().encode(), ~sum(raw) & 0xff))
+    f.write(b"S70500000000FA\n")
+
+
+class ReferenceImage:
+    # 参考软件(编译产物). 打开时只扫描一遍建立稀疏的段表: (起始地址, 结束地址, 文件偏移, 扩展地址),
+    # 地址和文件里都连续的记录合并成一段; 数据本身不常驻内存, 比较时按段从文件流式解码(二进制直接mmap)
+    def __init__(self, path: str, fmt: str = None, base_address: int = 0):
+        self.path = path
+        self.format = fmt or detect_format(path)
+        self._mmap = None
+        if self.format == FORMAT_BINARY:
+            size = os.path.getsize(path)
+            self.segments: List[Tuple[int, int, int, int]] = [(base_address, base_address + size, 0, 0)]
+            if size:
+                with open(path, "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elif self.format in _RECORDS:
+            self.segments = self._index()
+        else:
+            raise ValueError(f"image format {self.format} is not support.")
+
+    def _index(self) -> List[Tuple[int, int, int, int]]:
+        segments = []
+        current = None
+        with open(self.path, "rb") as f:
+            for pos, base, address, data in _RECORDS[self.format](f, 0, 0):
+                if not data:
+                    continue
+                if current is not None and address == current[1]:
+                    current[1] += len(data)
+                else:
+                    if current is not None:
+                        segments.append(tuple(current))
+                    current = [address, address + len(data), pos, base]
+        if current is not None:
+            segments.append(tuple(current))
+        segments.sort()
+        for a, b in zip(segments, segments[1:]):
+            if b[0] < a[1]:
+                raise ValueError(f"{self.path} has overlapping data at {b[0]:#x}.")
+        return segments
+
+    @property
+    def size(self) -> int:
+        return sum(end - start for start, end, _, _ in self.segments)
+
+    def chunks(self, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+        # 按地址顺序产生[start, end)范围内的参考数据(地址, 数据), 每块最多CHUNK_SIZE, 段之间的空洞跳过
+        for seg_start, seg_end, offset, base in self.segments:
+            lo, hi = max(start, seg_start), seg_end if end is None else min(end, seg_end)
+            if lo >= hi:
+                if end is not None and seg_start >= end:
+                    return
+                continue
+            if self._mmap is not None:
+                view = memoryview(self._mmap)
+                for address in range(lo, hi, CHUNK_SIZE):
+                    yield address, view[address - seg_start:min(address + CHUNK_SIZE, hi) - seg_start]
+                continue
+            yield from self._decode(offset, base, lo, hi)
+
+    def _decode(self, offset: int, base: int, lo: int, hi: int) -> Iterator[Tuple[int, bytes]]:
+        # 从段的第一条记录开始解码, 记录不再接着上一条的地址时这一段就结束了
+        buffer = bytearray()
+        buffer_address = lo
+        expected = None
+        with open(self.path, "rb") as f:
+            for _, _, address, data in _RECORDS[self.format](f, offset, base):
+                if not data:
+                    continue
+                if expected is not None and address != expected:
+                    break
+                expected = address + len(data)
+                if expected <= lo:
+                    continue
+                if address < lo:
+                    data, address = data[lo - address:], lo
+                buffer += data[:hi - address]
+                if len(buffer) >= CHUNK_SIZE:
+                    yield buffer_address, bytes(buffer)
+                    buffer_address += len(buffer)
+                    buffer.clear()
+                if expected >= hi:
+                    break
+        if buffer:
+            yield buffer_address, bytes(buffer)
+
+    def verifier(self, address: int, size: int) -> "ImageVerifier":
+        return ImageVerifier(self, address, size)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ImageVerifier:
+    # 一次下载的流式校验: RequestDownload声明的[address, address+size)里, 收到的数据块按到达顺序
+    # 与参考镜像比较, 只记录第一个不一致的地址; 参考镜像的空洞不比较
+    def __init__(self, reference: ReferenceImage, address: int, size: int):
+        self.reference = reference
+        self.start = address
+        self.end = address + size
+        self.address = address
+        self.first_mismatch: Optional[int] = None
+        self.compared = 0
+        self._chunks = reference.chunks(address, self.end)
+        self._current = None
+
+    def copy(self) -> "ImageVerifier":
+        # 从当前地址重新开始一份, 给ECU状态快照用
+        verifier = ImageVerifier(self.reference, self.address, self.end - self.address)
+        verifier.start = self.start
+        verifier.first_mismatch = self.first_mismatch
+        verifier.compared = self.compared
+        return verifier
+
+    def feed(self, data):
+        if isinstance(data, list):
+            data = bytes(data)
+        data = memoryview(data)
+        lo, hi = self.address, self.address + len(data)
+        self.address = hi
+        while self.first_mismatch is None:
+            if self._current is None:
+                self._current = next(self._chunks, None)
+                if self._current is None:
+                    return
+            address, ref = self._current
+            if address >= hi:
+                return
+            a, b = max(lo, address), min(hi, address + len(ref))
+            if a < b:
+                got, want = data[a - lo:b - lo], ref[a - address:b - address]
+                if got != want:
+                    self.first_mismatch = a + next(i for i in range(b - a) if got[i] != want[i])
+                    logger.info(f"downloaded image differs from {self.reference.path} at {self.first_mismatch:#x}")
+                    return
+                self.compared += b - a
+            if address + len(ref) > hi:
+                return
+            self._current = None
+
+    def finish(self) -> dict:
+        # 传输结束: 参考镜像里还有没收到的数据时, 第一个缺失的地址也算不一致
+        missing = None
+        if self.first_mismatch is None:
+            current = self._current or next(self._chunks, None)
+            if current is not None:
+                missing = max(current[0], self.address)
+        first = self.first_mismatch if self.first_mismatch is not None else missing
+        if self.compared == 0:
+            # 下载范围和参考镜像不重叠(例如二进制参考没给基地址), 什么都没比较不能算通过
+            logger.warning(f"download [{self.start:#x}, {self.end:#x}) does not overlap {self.reference.path}")
+        return {"ok": first is None and self.compared > 0, "first_mismatch": first, "missing": missing is not None,
+                "compared": self.compared, "received": self.address - self.start}
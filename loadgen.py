@@ -0,0 +1,271 @@
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from compression import compress
+from did import DIDList
+from uds import UDSService, DiagnosticSessionType, RoutineControl
+from uds_response_code import UDSResponseCode
+
+_channels = itertools.count()
+
+
+def read_did(*dids: int) -> list:
+    req = [UDSService.ReadDataByIdentifier.value]
+    for d in dids:
+        req += [d >> 8, d & 0xff]
+    return req
+
+
+def tester_present(suppress: bool = False) -> list:
+    return [UDSService.TesterPresent.value, 0x80 if suppress else 0x00]
+
+
+def read_dtc(mask: int = 0xff) -> list:
+    return [UDSService.ReadDTCInformation.value, 0x02, mask]
+
+
+def session_control(session: DiagnosticSessionType) -> list:
+    return [UDSService.DiagnosticSessionControl.value, session.value]
+
+
+def download_sequence(size: int, block_size: int = 0x0fff - 2, address: int = 0, compression: int = 0,
+                      image: bytes = None) -> List[list]:
+    # compression为dataFormatIdentifier的压缩方法, 镜像整体压缩后再按块切分
+    erase = RoutineControl.RoutineIdentifier.EraseFlash.value
+    if image is None:
+        image = b"".join(bytes([offset & 0xff]) * min(block_size, size - offset) for offset in range(0, size, block_size))
+    size = len(image)
+    payload = compress(image, compression)
+    seq = [session_control(DiagnosticSessionType.ProgrammingSession),
+           [UDSService.RoutineControl.value, RoutineControl.RoutineControlType.StartRoutine.value, erase >> 8,
+            erase & 0xff] + list(address.to_bytes(4, "big")) + list(size.to_bytes(4, "big")),
+           [UDSService.RequestDownload.value, compression << 4, 0x44] + list(address.to_bytes(4, "big")) + list(
+               size.to_bytes(4, "big"))]
+    counter = 1
+    for offset in range(0, len(payload), block_size):
+        seq.append([UDSService.TransferData.value, counter] + list(payload[offset:offset + block_size]))
+        counter = (counter + 1) & 0xff
+    seq.append([UDSService.RequestTransferExit.value])
+    seq.append(session_control(DiagnosticSessionType.DefaultSession))
+    return seq
+
+
+# 负载组合里可以使用的操作, 每个操作是一条或一串请求
+OPERATIONS = {
+    "read_did": lambda: [read_did(0xf191)],
+    "read_did_10": lambda: [read_did(*(list(DIDList.dict) * 2)[:10])],
+    # 读不存在的DID, 每次都回NRC 0x31, 用来压否定响应的路径
+    "read_did_unsupported": lambda: [read_did(0xffff)],
+    "tester_present": lambda: [tester_present()],
+    "read_dtc": lambda: [read_dtc()],
+    "session_control": lambda: [session_control(DiagnosticSessionType.ExtendedDiagnosticSession)],
+    "download": lambda: download_sequence(64 * 1024),
+}
+
+DEFAULT_MIX = {"read_did": 60, "tester_present": 20, "read_dtc": 20}
+
+
+class Session:
+    # 一个诊断仪会话: request(data) 返回响应, 超时返回None
+    def __init__(self, request: Callable[[list], Optional[bytes]], close: Callable[[], None] = None):
+        self.request = request
+        self._close = close
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+def loopback_sessions(n: int, timeout: float = 2.0) -> List[Session]:
+    from main import ECUSim
+    from transport import LoopbackTransport
+
+    sessions = []
+    for i in range(n):
+        ecu = ECUSim(LoopbackTransport(), "load%d" % i)
+        ecu.start()
+        sessions.append(Session(lambda data, t=ecu.transport.tester: t.request(data, timeout), ecu.stop))
+    return sessions
+
+
+def virtual_can_sessions(n: int, channel: str = None, base_id: int = 0x700, timeout: float = 2.0,
+                         params: dict = None) -> List[Session]:
+    import can
+    import isotp
+    from main import ECUSim
+    from transport import IsoTpCanTransport
+
+    channel = channel or "loadgen_%d" % next(_channels)
+    sessions = []
+    for i in range(n):
+        rxid, txid = base_id + 2 * i, base_id + 2 * i + 1
+        ecu = ECUSim(IsoTpCanTransport("virtual", channel, rxid=rxid, txid=txid, params=params), "load%d" % i)
+        ecu.start()
+        bus = can.Bus(interface="virtual", channel=channel)
+        stack = isotp.CanStack(bus, address=isotp.Address(rxid=txid, txid=rxid),
+                               params=dict({'blocking_send': True}, **(params or {})))
+        stack.start()
+
+        def request(data, stack=stack):
+            stack.send(bytes(data), send_timeout=timeout)
+            return stack.recv(block=True, timeout=timeout)
+
+        def close(ecu=ecu, stack=stack, bus=bus):
+            stack.stop()
+            bus.shutdown()
+            ecu.stop()
+
+        sessions.append(Session(request, close))
+    return sessions
+
+
+def doip_sessions(n: int, timeout: float = 2.0, max_data_size: int = 0x4000) -> List[Session]:
+    from doip import DoIPClient, DoIPServer
+    from ecustate import ECUState
+    from uds import ServiceDispatcher
+
+    # 一个DoIP实体下挂n个ECU逻辑地址, 每个会话一条TCP连接
+    addresses = [0x0e80 + i for i in range(n)]
+    server = DoIPServer({a: lambda state=ECUState(): ServiceDispatcher(state) for a in addresses}, port=0,
+                        max_data_size=max_data_size)
+    server.start()
+    opened = [n]
+    sessions = []
+    for i, address in enumerate(addresses):
+        client = DoIPClient(port=server.port, source_address=0x0e00 + i, timeout=timeout)
+        client.connect()
+
+        def close(client=client):
+            # 最后一个会话关闭时停掉服务器
+            client.close()
+            opened[0] -= 1
+            if not opened[0]:
+                server.stop()
+
+        sessions.append(Session(lambda data, c=client, a=address: c.request(data, a), close))
+    return sessions
+
+
+class LoadGenerator:
+    def __init__(self, sessions: List[Session], mix: Dict[str, float] = None, seed: int = 0):
+        self.sessions = sessions
+        self.mix = dict(mix or DEFAULT_MIX)
+        for op in self.mix:
+            if op not in OPERATIONS:
+                raise ValueError(f"load operation {op} is not support.")
+        self.seed = seed
+        self._latencies = {}
+        self._nrc = {}
+        self._timeouts = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def _run_session(self, index: int, session: Session, deadline: float, count: Optional[int]):
+        rng = random.Random(self.seed + index)
+        ops = list(self.mix)
+        cum = list(itertools.accumulate(self.mix[op] for op in ops))
+        built = {op: OPERATIONS[op]() for op in ops}
+        latencies = {op: [] for op in ops}
+        nrc, timeouts, requests = {}, {}, {}
+        done = 0
+        while (count is None or done < count) and time.perf_counter() < deadline:
+            op = rng.choices(ops, cum_weights=cum)[0]
+            for req in built[op]:
+                t0 = time.perf_counter()
+                r = session.request(req)
+                latencies[op].append(time.perf_counter() - t0)
+                requests[op] = requests.get(op, 0) + 1
+                if r is None:
+                    if req[0] != UDSService.TesterPresent.value or not req[1] & 0x80:
+                        timeouts[op] = timeouts.get(op, 0) + 1
+                elif r[0] == 0x7f and len(r) > 2:
+                    nrc[(op, r[2])] = nrc.get((op, r[2]), 0) + 1
+            done += 1
+        with self._lock:
+            for op, lat in latencies.items():
+                self._latencies.setdefault(op, []).extend(lat)
+            for src, dst in ((nrc, self._nrc), (timeouts, self._timeouts), (requests, self._requests)):
+                for k, v in src.items():
+                    dst[k] = dst.get(k, 0) + v
+
+    def run(self, duration: float = 5.0, count: Optional[int] = None) -> dict:
+        # count为每个会话执行的操作数, 与duration先到者为准
+        deadline = time.perf_counter() + duration
+        threads = [threading.Thread(target=self._run_session, args=(i, s, deadline, count), daemon=True)
+                   for i, s in enumerate(self.sessions)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.report(time.perf_counter() - t0)
+
+    def report(self, elapsed: float) -> dict:
+        total = sum(self._requests.values())
+        operations = {}
+        for op, lat in self._latencies.items():
+            operations[op] = dict(_latency_stats(lat), requests=self._requests.get(op, 0),
+                                  timeouts=self._timeouts.get(op, 0))
+        nrc_total = {}
+        for (op, code), v in self._nrc.items():
+            nrc_total[code] = nrc_total.get(code, 0) + v
+        all_latencies = [x for lat in self._latencies.values() for x in lat]
+        return {
+            "sessions": len(self.sessions),
+            "elapsed": elapsed,
+            "requests": total,
+            "throughput": total / elapsed if elapsed else 0.0,
+            "latency": _latency_stats(all_latencies),
+            "operations": operations,
+            "nrc_rate": {UDSResponseCode.get_name(code): v / total for code, v in sorted(nrc_total.items())},
+            "timeout_rate": sum(self._timeouts.values()) / total if total else 0.0,
+        }
+
+
+def _latency_stats(lat: List[float]) -> dict:
+    if not lat:
+        return {"p50": None, "p99": None, "mean": None, "max": None}
+    s = sorted(lat)
+    return {
+        "p50": s[int(0.5 * (len(s) - 1))],
+        "p99": s[int(0.99 * (len(s) - 1))],
+        "mean": sum(s) / len(s),
+        "max": s[-1],
+    }
+
+
+def _mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        op, weight = item.split("=")
+        mix[op.strip()] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UDS load generator for ECUSim")
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--transport", choices=["loopback", "virtual", "doip"], default="loopback")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--mix", type=_mix, default=DEFAULT_MIX,
+                        help="weighted operations, e.g. read_did=60,tester_present=20,read_dtc=20")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    factory = {"loopback": loopback_sessions, "virtual": virtual_can_sessions, "doip": doip_sessions}[args.transport]
+    sessions = factory(args.sessions)
+    try:
+        report = LoadGenerator(sessions, args.mix, args.seed).run(args.duration)
+    finally:
+        for s in sessions:
+            s.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
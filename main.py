@@ -1,66 +1,319 @@
+import argparse
 import json
-import logging.config
+import logging
 import os
 import threading
+import time
 from datetime import datetime
-from pathlib import Path
-import can
-import isotp
+from typing import TYPE_CHECKING, Dict, Optional
 
 from did import DIDCoding, UCharLinearCoding, CharLinearCoding
+from profiler import Profiler
+from transport import IsoTpCanTransport, Transport, create_transport, open_can_bus
 from uds import *
 from uds_addtion import log_exception
 
-os.add_dll_directory(Path(r"D:\Program Files (x86)\Vector License Client"))
+# 只有用到对应功能时才导入, 大量短时启动的仿真实例不用为asyncio/http.server/multiprocessing付出导入时间
+if TYPE_CHECKING:
+    from metrics import MetricsRegistry
+    from sharding import ShardedSimulator
+
+logger = logging.getLogger("app")
 
 
 class ECUSim:
-    def __init__(self):
-        self.__stack = None
-        self.__lock = threading.RLock()
+    # 每个仿真ECU有自己的状态, 其它诊断仪(例如DoIP)用ServiceDispatcher(ecu.state)接入同一个ECU
+    def __init__(self, transport: Transport, name: str = "ecu", metrics: "MetricsRegistry" = None,
+                 state: ECUState = None):
+        self.name = name
+        self.metrics = metrics
+        # DoIP逻辑地址, 配置里没有指定时由main按--doip-address依次分配
+        self.doip_address = None
+        self.__transport = transport
+        self.__state = state or ECUState()
+        self.__dispatcher = ServiceDispatcher(self.__state, sink=self.__push)
+        self.__running = threading.Event()
+        self.__thread = None
+
+    @property
+    def transport(self) -> Transport:
+        return self.__transport
+
+    @property
+    def state(self) -> ECUState:
+        return self.__state
 
     @log_exception(logging.getLogger("app"))
-    def start(self, interface, channel, bitrate, app_name, address_mode: isotp.AddressingMode, rxid, txid):
-        bus = can.Bus(interface=interface, channel=channel, bitrate=bitrate, app_name=app_name)
-        addr = isotp.Address(address_mode, rxid=rxid, txid=txid)
-        params = {
-            'blocking_send': True,
-            'rx_flowcontrol_timeout': 5000,
-            'rx_consecutive_frame_timeout': 5000,
-        }
-        self.__stack = isotp.CanStack(bus, address=addr, params=params)
-        self.__stack.start()
-        t1 = threading.Thread(target=self.__rev_thread, args=())  # 传个任务,和参数进来
-        t1.daemon = False
-        t1.start()
+    def start(self):
+        self.__transport.start()
+        self.__running.set()
+        self.__thread = threading.Thread(target=self.__rev_thread, args=(), name=self.name)
+        self.__thread.daemon = False
+        self.__thread.start()
+
+    def stop(self, timeout: float = 1.0):
+        self.__dispatcher.close()
+        self.__running.clear()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+        self.__transport.stop()
 
     def __rev_thread(self):
-        while 1:
-            if self.__stack.available():
-                recv_data = self.__stack.recv()
+        while self.__running.is_set():
+            recv_data = self.__transport.recv(timeout=0.1)
+            if recv_data:
                 self.__default_response(recv_data)
 
-    @log_exception(logging.getLogger("app"))
-    def __default_response(self, data: list):
-        obj = eval(UDSService.get_name(data[0]))()
-        if obj is not None:
-            r = obj.process(data)
-            if not r is None:
-                self.__stack.send(r, send_timeout=5000)
+    def __push(self, r):
+        # ResponseOnEvent主动发出的响应
+        if self.__running.is_set():
+            self.__transport.send(r, send_timeout=5000)
+
+    @property
+    def session(self) -> int:
+        return self.__dispatcher.session
+
+    def snapshot(self) -> StateSnapshot:
+        return self.__dispatcher.snapshot()
+
+    def restore(self, snapshot: StateSnapshot):
+        self.__dispatcher.restore(snapshot)
+
+    def process(self, data) -> Optional[list]:
+        return self.__dispatcher.handle(data)
+
+    @log_exception(logging.getLogger("app"), label=lambda self, data: UDSService.get_name(data[0]) or hex(data[0]))
+    def __default_response(self, data):
+        if self.metrics is None:
+            r = self.process(data)
         else:
-            logger.error("receive request SID:" + hex(data[0]) + " is not support.there not found class here.")
+            t0 = time.perf_counter()
+            r = self.process(data)
+            self.metrics.observe(self.name, data[0], r, time.perf_counter() - t0)
+        if not r is None:
+            self.__transport.send(r, send_timeout=5000)
+
+
+def snapshot_ecus(ecus: List[ECUSim]) -> Dict[str, StateSnapshot]:
+    # 测试用例之间用快照/恢复代替重启仿真器
+    return {ecu.name: ecu.snapshot() for ecu in ecus}
+
+
+def restore_ecus(ecus: List[ECUSim], snapshots: Dict[str, StateSnapshot]):
+    for ecu in ecus:
+        ecu.restore(snapshots[ecu.name])
 
 
 def setup_logging(default_path="logging.json", default_level=logging.INFO):
     if os.path.exists(default_path):
+        from logging.config import dictConfig
+
         with open(default_path, "r") as f:
             config = json.load(f)
-            config['handlers']['file_handler']['filename'] = datetime.now().strftime('log/log_%Y-%m-%d.log')
-            logging.config.dictConfig(config)
+            handler = config['handlers']['file_handler']
+            handler['filename'] = datetime.now().strftime('log/log_%Y-%m-%d.log')
+            # 日志文件和log/目录在第一条记录写入时才创建
+            handler['()'] = _lazy_file_handler(handler.pop('class'))
+            handler['delay'] = True
+            dictConfig(config)
+    else:
+        logging.basicConfig(level=default_level)
 
-if __name__ == '__main__':
-    setup_logging(default_path="logconfig.json")
-    logger = logging.getLogger("app")
+
+def _lazy_file_handler(class_name: str):
+    from logging.config import BaseConfigurator
+
+    base = BaseConfigurator({}).resolve(class_name)
+
+    class LazyFileHandler(base):
+        def _open(self):
+            os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+            return super()._open()
+
+    return LazyFileHandler
+
+
+def _int(value):
+    return int(value, 0) if isinstance(value, str) else value
+
+
+def _ecu_params(transport: dict, ecu: dict) -> dict:
+    # ISO-TP参数按ECU覆盖总线级的设置
+    return {**transport.get("params", {}), **ecu.get("params", {})}
+
+
+def load_config(path: str) -> dict:
+    with open(path, "r") as f:
+        config = json.load(f)
+    for ecu in config.get("ecus", []):
+        for key in ("rxid", "txid"):
+            if key in ecu:
+                ecu[key] = _int(ecu[key])
+    return config
+
+
+SHARD_UNSUPPORTED = ("--doip-port", "--data-config", "--metrics-port", "--reference-image", "--secure-key")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="UDS ECU simulator")
+    parser.add_argument("--config", help="simulator config json, overrides the transport options below")
+    parser.add_argument("--log-config", default="logconfig.json")
+    parser.add_argument("--interface", default="vector", choices=["loopback", "virtual", "socketcan", "vector"])
+    parser.add_argument("--channel", default="0")
+    parser.add_argument("--bitrate", type=int, default=500000)
+    parser.add_argument("--app-name", default="python")
+    parser.add_argument("--addressing-mode", default="Normal_11bits")
+    parser.add_argument("--rxid", type=_int, default=0x7e0)
+    parser.add_argument("--txid", type=_int, default=0x7e8)
+    parser.add_argument("--fd", action="store_true", help="use CAN FD (64 byte frames, bitrate switching)")
+    parser.add_argument("--data-bitrate", type=int, default=2000000, help="CAN FD data phase bitrate")
+    parser.add_argument("--blocksize", type=int, help="ISO-TP block size sent in flow control")
+    parser.add_argument("--stmin", type=int, help="ISO-TP STmin sent in flow control")
+    parser.add_argument("--tx-data-length", type=int, help="CAN frame data length, 8 for classic CAN")
+    parser.add_argument("--doip-port", type=int, nargs="?", const=13400,
+                        help="also serve DoIP (ISO 13400) on this TCP/UDP port, 13400 if no value given")
+    parser.add_argument("--doip-host", default="0.0.0.0")
+    parser.add_argument("--doip-address", type=_int, default=0x0e80, help="DoIP logical address of the first ECU, the others follow unless set in the config")
+    parser.add_argument("--data-config", help="DID/DTC json, reloaded while running when it changes or on SIGHUP")
+    parser.add_argument("--reload-interval", type=float, default=1.0, help="seconds between data config checks")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--profile-dir", default="profile", help="where on-demand profiles are written")
+    parser.add_argument("--reference-image", help="Intel HEX/S19/binary build, downloads are verified against it")
+    parser.add_argument("--reference-base", type=_int, default=0, help="load address of a binary reference image")
+    parser.add_argument("--secure-key", type=bytes.fromhex, help="AES key (hex) for SecuredDataTransmission (0x84)")
+    args = parser.parse_args(argv)
+    if args.config:
+        # 分片运行时ECU状态在工作进程里, 这些选项还没有接到工作进程, 不能静默忽略
+        unsupported = [option for option in SHARD_UNSUPPORTED
+                       if getattr(args, option[2:].replace("-", "_")) is not None]
+        if unsupported and "shard" in load_config(args.config):
+            parser.error(f"{', '.join(unsupported)} can not be used with a sharded config")
+    return args
+
+
+def build_ecus(args, metrics: "MetricsRegistry" = None) -> List[ECUSim]:
+    if args.config:
+        config = load_config(args.config)
+        ecus = []
+        for ecu in config["ecus"]:
+            ecu = dict(ecu)
+            name = ecu.pop("name", "ecu%d" % len(ecus))
+            reference = ecu.pop("reference_image", None)
+            reference_base = _int(ecu.pop("reference_base_address", 0))
+            secure_key = ecu.pop("secure_key", None)
+            secured_services = ecu.pop("secured_services", ())
+            doip_address = ecu.pop("doip_address", None)
+            transport = config.get("transport", {})
+            params = _ecu_params(transport, ecu)
+            ecus.append(ECUSim(create_transport({**transport, **ecu, "params": params}), name, metrics))
+            if doip_address is not None:
+                ecus[-1].doip_address = _int(doip_address)
+            if reference:
+                load_reference(ecus[-1], reference, reference_base)
+            if secure_key:
+                ecus[-1].state.secure_key = bytes.fromhex(secure_key)
+                ecus[-1].state.secured_services = frozenset(_int(sid) for sid in secured_services)
+        return ecus
+    if args.interface == "loopback":
+        return [ECUSim(create_transport({"interface": "loopback"}), metrics=metrics)]
+    channel = _int(args.channel) if args.channel.isdigit() else args.channel
+    params = {k: v for k, v in (("blocksize", args.blocksize), ("stmin", args.stmin),
+                                ("tx_data_length", args.tx_data_length)) if v is not None}
+    return [ECUSim(create_transport({"interface": args.interface, "channel": channel, "bitrate": args.bitrate,
+                                     "app_name": args.app_name, "addressing_mode": args.addressing_mode,
+                                     "rxid": args.rxid, "txid": args.txid, "fd": args.fd,
+                                     "data_bitrate": args.data_bitrate, "params": params}), metrics=metrics)]
+
+
+def load_reference(ecu: ECUSim, path: str, base_address: int = 0):
+    # 参考软件只建段表, 数据在比较时从文件流式读取; base_address只用于二进制文件, hex/s19自带地址
+    from flashimage import ReferenceImage
+
+    ecu.state.eol.reference = ReferenceImage(path, base_address=base_address)
+    logger.info(f"{ecu.name} verifies downloads against {path}")
+
+
+def doip_routes(ecus: List[ECUSim], first_address: int) -> dict:
+    # 每个ECU一个DoIP逻辑地址, 按诊断消息的目标地址路由; 每条TCP连接有自己的分发器(会话/0x84上下文),
+    # 和CAN上的诊断仪共用ECU状态
+    routes = {}
+    for i, ecu in enumerate(ecus):
+        address = ecu.doip_address if ecu.doip_address is not None else first_address + i
+        if address in routes:
+            raise ValueError(f"DoIP logical address {address:#06x} of {ecu.name} is already used.")
+        routes[address] = lambda state=ecu.state: ServiceDispatcher(state)
+    return routes
+
+
+def start_sharded(config: dict) -> "ShardedSimulator":
+    # 配置里有"shard"时,本进程只拥有总线,ECU分布到多个工作进程
+    from sharding import ShardedSimulator
+
+    transport = config.get("transport", {})
+    shard = config["shard"]
+    ecus = []
+    for ecu in config["ecus"]:
+        # 和build_ecus一样合并总线级参数; 工作进程里直接用isotp, CAN FD的缺省值(64字节帧)要在这里补上
+        params = _ecu_params(transport, ecu)
+        if ecu.get("fd", transport.get("fd", False)):
+            params = {**IsoTpCanTransport.default_fd_params, **params}
+        ecus.append({**ecu, "params": params})
+    sim = ShardedSimulator(ecus, shard.get("workers"), shard.get("assignment"), mode="can",
+                           ring_size=shard.get("ring_size", 1 << 20))
+    sim.start(open_can_bus(transport.get("interface", "virtual"), transport.get("channel"),
+                           transport.get("bitrate", 500000), transport.get("app_name"), transport.get("fd", False),
+                           transport.get("data_bitrate", 2000000)))
+    return sim
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(default_path=args.log_config)
     logger.info("app started!")
-    ecu = ECUSim();
-    ecu.start('vector', 0, 50000, 'python', isotp.AddressingMode.Normal_11bits, 0x7e0, 0x7e8)
+    profiler = Profiler(args.profile_dir)
+    profiler.install_signal_handler()
+    metrics = None
+    if args.metrics_port is not None:
+        from metrics import MetricsRegistry, MetricsServer
+
+        metrics = MetricsRegistry()
+        server = MetricsServer(metrics, port=args.metrics_port)
+        server.routes["/profile"] = profiler.http_route
+        server.start()
+        logger.info(f"metrics served on http://127.0.0.1:{server.port}/metrics")
+    if args.config:
+        config = load_config(args.config)
+        if "shard" in config:
+            return [start_sharded(config)]
+    ecus = build_ecus(args, metrics)
+    if args.reference_image:
+        for ecu in ecus:
+            if ecu.state.eol.reference is None:
+                load_reference(ecu, args.reference_image, args.reference_base)
+    if args.secure_key:
+        for ecu in ecus:
+            if ecu.state.secure_key is None:
+                ecu.state.secure_key = args.secure_key
+    if args.data_config:
+        from dataconfig import DataReloader
+
+        reloader = DataReloader(args.data_config, args.reload_interval, [ecu.state for ecu in ecus])
+        reloader.poll()
+        reloader.install_signal_handler()
+        reloader.start()
+    for ecu in ecus:
+        ecu.start()
+    if args.doip_port is not None:
+        from doip import DoIPServer
+
+        doip = DoIPServer(doip_routes(ecus, args.doip_address), host=args.doip_host, port=args.doip_port)
+        doip.start()
+        logger.info(f"DoIP served on {args.doip_host}:{doip.port}, logical addresses "
+                    f"{', '.join(f'{a:#06x}' for a in doip.ecus)}")
+    return ecus
+
+
+if __name__ == '__main__':
+    main()
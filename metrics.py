@@ -0,0 +1,167 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from uds import UDSService
+from uds_response_code import UDSResponseCode
+
+# 延时直方图的桶上限(秒),最后还有一个+Inf桶
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0)
+
+
+class _Shard:
+    # 每个线程只写自己的分片,读取时再汇总,记录路径上不需要加锁
+    __slots__ = "generation", "requests", "negative", "suppressed", "latency"
+
+    def __init__(self, generation: int = 0):
+        self.generation = generation
+        self.requests = {}
+        self.negative = {}
+        self.suppressed = {}
+        self.latency = {}
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._generation = 0
+
+    def _shard(self) -> _Shard:
+        # 在锁里按当前代号建分片, 不会和reset()交错成旧代号的分片挂在新列表上
+        with self._shards_lock:
+            shard = self._local.shard = _Shard(self._generation)
+            self._shards.append(shard)
+        return shard
+
+    def observe(self, ecu: str, sid: int, response, elapsed: float):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = None
+        if shard is None or shard.generation != self._generation:
+            # 第一次记录, 或者reset()之后换一个新分片
+            shard = self._shard()
+        key = (ecu, sid)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        if response is None:
+            shard.suppressed[key] = shard.suppressed.get(key, 0) + 1
+        elif response[0] == 0x7f and len(response) > 2:
+            nkey = (ecu, sid, response[2])
+            shard.negative[nkey] = shard.negative.get(nkey, 0) + 1
+        hist = shard.latency.get(key)
+        if hist is None:
+            hist = shard.latency[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect_left(self.buckets, elapsed)] += 1
+        hist[-1] += elapsed
+
+    def reset(self):
+        # 不去改别的线程正在写的分片: 换一代, 旧分片不再被读取, 各线程下次记录时自己换新分片
+        with self._shards_lock:
+            self._generation += 1
+            self._shards = []
+
+    def snapshot(self) -> dict:
+        requests, negative, suppressed, latency = {}, {}, {}, {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for src, dst in ((shard.requests, requests), (shard.negative, negative), (shard.suppressed, suppressed)):
+                for k, v in list(src.items()):
+                    dst[k] = dst.get(k, 0) + v
+            for k, hist in list(shard.latency.items()):
+                total = latency.setdefault(k, [0] * (len(self.buckets) + 1) + [0.0])
+                for i, v in enumerate(list(hist)):
+                    total[i] += v
+        return {
+            "requests": requests,
+            "negative_responses": negative,
+            "suppressed_responses": suppressed,
+            "latency": {k: {"buckets": dict(zip(self.buckets + (float("inf"),), v[:-1])), "count": sum(v[:-1]),
+                            "sum": v[-1]} for k, v in latency.items()},
+        }
+
+    def render_prometheus(self) -> str:
+        snap = self.snapshot()
+        lines = ["# HELP ecusim_requests_total UDS requests received.", "# TYPE ecusim_requests_total counter"]
+        for (ecu, sid), v in sorted(snap["requests"].items()):
+            lines.append(f'ecusim_requests_total{{{_labels(ecu, sid)}}} {v}')
+        lines += ["# HELP ecusim_suppressed_responses_total Requests answered without a response.",
+                  "# TYPE ecusim_suppressed_responses_total counter"]
+        for (ecu, sid), v in sorted(snap["suppressed_responses"].items()):
+            lines.append(f'ecusim_suppressed_responses_total{{{_labels(ecu, sid)}}} {v}')
+        lines += ["# HELP ecusim_negative_responses_total Negative responses by NRC.",
+                  "# TYPE ecusim_negative_responses_total counter"]
+        for (ecu, sid, nrc), v in sorted(snap["negative_responses"].items()):
+            lines.append(f'ecusim_negative_responses_total{{{_labels(ecu, sid)},nrc="0x{nrc:02X}",'
+                         f'nrc_name="{_escape(UDSResponseCode.get_name(nrc))}"}} {v}')
+        lines += ["# HELP ecusim_request_duration_seconds Request processing latency.",
+                  "# TYPE ecusim_request_duration_seconds histogram"]
+        for (ecu, sid), h in sorted(snap["latency"].items()):
+            cumulative = 0
+            for le, v in h["buckets"].items():
+                cumulative += v
+                le = "+Inf" if le == float("inf") else repr(le)
+                lines.append(f'ecusim_request_duration_seconds_bucket{{{_labels(ecu, sid)},le="{le}"}} {cumulative}')
+            lines.append(f'ecusim_request_duration_seconds_sum{{{_labels(ecu, sid)}}} {h["sum"]}')
+            lines.append(f'ecusim_request_duration_seconds_count{{{_labels(ecu, sid)}}} {h["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    # Prometheus文本格式的标签值: 反斜杠, 双引号和换行要转义
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(ecu: str, sid: int) -> str:
+    return f'ecu="{_escape(ecu)}",sid="0x{sid:02X}",service="{UDSService.get_name(sid) or "Unknown"}"'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = None
+    routes = {}
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = self.registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        elif path in self.routes:
+            code, body = self.routes[path](self.path)
+            body = body.encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+        else:
+            body = b"not found\n"
+            self.send_response(404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9108):
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry, "routes": {}})
+        self.routes = handler.routes
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
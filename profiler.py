@@ -0,0 +1,254 @@
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import uds_addtion
+
+logger = logging.getLogger("app")
+
+
+class ProfileSession:
+    # 通过uds_addtion.log_exception的钩子采集,只覆盖接收/分发/服务处理路径
+    def __init__(self, mode: str = "deterministic", interval: float = 0.001):
+        if mode not in ("deterministic", "sampling"):
+            raise ValueError(f"profile mode {mode} is not support.")
+        self.mode = mode
+        self.interval = interval
+        self.handlers = {}
+        self.started = None
+        self.duration = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+        # 3.12起cProfile基于sys.monitoring, 全进程只能有一个启用的profiler: 所有线程共用一个, 按引用计数启用/停用
+        self._shared = sys.version_info >= (3, 12)
+        self._enabled = 0
+        self._unavailable = False
+        self._active_threads = set()
+        self._samples = {}
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def __call__(self, func, label, args, kwargs):
+        local = self._local
+        if getattr(local, "busy", False):
+            return func(*args, **kwargs)
+        local.busy = True
+        prof = None
+        if self.mode == "deterministic":
+            prof = self._enable()
+        else:
+            self._active_threads.add(threading.get_ident())
+        w0 = time.perf_counter()
+        c0 = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if prof is not None:
+                self._disable(prof)
+            elif self.mode == "sampling":
+                self._active_threads.discard(threading.get_ident())
+            self._record(label, time.perf_counter() - w0, time.thread_time() - c0)
+            local.busy = False
+
+    def _enable(self):
+        # 返回启用的profiler; 启用失败(例如调试器/覆盖率工具占用了profiler)时只记录耗时, 不影响服务处理
+        import cProfile
+
+        try:
+            if not self._shared:
+                prof = getattr(self._local, "profile", None)
+                if prof is None:
+                    prof = self._local.profile = cProfile.Profile()
+                    with self._lock:
+                        self._profiles.append(prof)
+                prof.enable()
+                return prof
+            with self._lock:
+                if not self._profiles:
+                    self._profiles.append(cProfile.Profile())
+                prof = self._profiles[0]
+                if not self._enabled:
+                    prof.enable()
+                self._enabled += 1
+                return prof
+        except ValueError as e:
+            if not self._unavailable:
+                self._unavailable = True
+                logger.warning(f"deterministic profile is not available, only handler times are recorded: {e}")
+            return None
+
+    def _disable(self, prof):
+        if not self._shared:
+            prof.disable()
+            return
+        with self._lock:
+            self._enabled -= 1
+            if not self._enabled:
+                prof.disable()
+
+    def _record(self, label, wall, cpu):
+        with self._lock:
+            h = self.handlers.get(label)
+            if h is None:
+                h = self.handlers[label] = {"calls": 0, "wall": 0.0, "cpu": 0.0}
+            h["calls"] += 1
+            h["wall"] += wall
+            h["cpu"] += cpu
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.mode == "sampling":
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in list(self._active_threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_qualname, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stack = tuple(reversed(stack))
+                    self._samples[stack] = self._samples.get(stack, 0) + 1
+
+    def stats(self) -> Optional["pstats.Stats"]:
+        import pstats
+
+        profiles = [p for p in self._profiles if p.getstats()]
+        if not profiles:
+            return None
+        st = pstats.Stats(profiles[0])
+        for p in profiles[1:]:
+            st.add(p)
+        return st
+
+    def speedscope(self) -> dict:
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, count in self._samples.items():
+            ids = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                ids.append(index[frame])
+            samples.append(ids)
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{"type": "sampled", "name": "ECUSim dispatch", "unit": "seconds", "startValue": 0,
+                          "endValue": sum(weights), "samples": samples, "weights": weights}],
+            "name": "ECUSim dispatch",
+            "exporter": "ECUSim",
+        }
+
+    def write(self, path: str):
+        if self.mode == "deterministic":
+            st = self.stats()
+            if st is None:
+                open(path, "wb").close()
+            else:
+                st.dump_stats(path)
+        else:
+            with open(path, "w") as f:
+                json.dump(self.speedscope(), f)
+
+    def report(self) -> dict:
+        return {"mode": self.mode, "duration": self.duration, "handlers": dict(self.handlers)}
+
+
+class Profiler:
+    def __init__(self, directory: str = "profile"):
+        self.directory = directory
+        self.session: Optional[ProfileSession] = None
+        self.last_report = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.session is not None
+
+    def start(self, seconds: Optional[float] = None, mode: str = "deterministic", interval: float = 0.001):
+        with self._lock:
+            if self.session is not None:
+                raise RuntimeError("a profile session is already running.")
+            self.session = ProfileSession(mode, interval)
+            self.session.start()
+            uds_addtion.set_profile_hook(self.session)
+            if seconds:
+                self._timer = threading.Timer(seconds, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+        logger.info(f"profile started, mode {mode}, {seconds or 'unlimited'} s")
+
+    def stop(self, path: Optional[str] = None) -> Optional[dict]:
+        with self._lock:
+            session = self.session
+            if session is None:
+                return None
+            uds_addtion.set_profile_hook(None)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.session = None
+        session.stop()
+        if path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            ext = "pstats" if session.mode == "deterministic" else "speedscope.json"
+            path = os.path.join(self.directory, datetime.now().strftime(f"profile_%Y%m%d_%H%M%S_%f.{ext}"))
+        session.write(path)
+        report = session.report()
+        report["output"] = path
+        self.last_report = report
+        for label, h in sorted(report["handlers"].items(), key=lambda i: -i[1]["wall"]):
+            logger.info(f"profile {label}: calls {h['calls']} wall {h['wall'] * 1e3:.3f} ms cpu {h['cpu'] * 1e3:.3f} ms")
+        logger.info(f"profile written to {path}")
+        return report
+
+    def install_signal_handler(self, signum=getattr(signal, "SIGUSR1", None), seconds: float = 10,
+                               mode: str = "deterministic"):
+        # 收到信号时开始采集N秒,再次收到则提前结束
+        if signum is None:
+            return False
+
+        def handler(sig, frame):
+            if self.active:
+                threading.Thread(target=self.stop, daemon=True).start()
+            else:
+                self.start(seconds, mode)
+
+        signal.signal(signum, handler)
+        return True
+
+    def http_route(self, path: str):
+        # 给MetricsServer用: /profile?seconds=10&mode=sampling
+        from urllib.parse import parse_qs, urlsplit
+
+        query = parse_qs(urlsplit(path).query)
+        if query.get("action", ["start"])[0] == "stop":
+            report = self.stop()
+            return (200, json.dumps(report) + "\n") if report else (409, "no profile session running\n")
+        try:
+            self.start(float(query.get("seconds", ["10"])[0]), query.get("mode", ["deterministic"])[0])
+        except (RuntimeError, ValueError) as e:
+            return 409, f"{e}\n"
+        return 202, "profile started\n"
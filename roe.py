@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from ecustate import ECUState
+
+logger = logging.getLogger("app")
+
+ON_DTC_STATUS_CHANGE = 0x01
+ON_CHANGE_OF_DATA_IDENTIFIER = 0x03
+
+
+class Subscription:
+    # 一个ResponseOnEvent事件: 触发时执行service(例如 22 F1 91)并把响应推给诊断仪
+    __slots__ = "event_type", "window", "record", "service", "dirty", "last_sent", "changes"
+
+    def __init__(self, event_type: int, window: int, record: bytes, service: bytes):
+        self.event_type = event_type
+        self.window = window
+        self.record = record
+        self.service = service
+        self.dirty = False
+        self.last_sent = float("-inf")
+        self.changes = 0
+
+    def encode(self) -> list:
+        return [self.event_type, self.window] + list(self.record) + list(self.service)
+
+
+class EventEngine:
+    # 订阅按DID/DTC状态位建索引, 值变化只触及该键的订阅者;
+    # 两次发送之间的多次变化合并成一次(发送时读最新值), 每个订阅至少间隔min_interval秒
+    def __init__(self, state: ECUState, respond: Callable[[bytes], Optional[list]],
+                 sink: Callable[[list], None] = None, min_interval: float = 0.02):
+        self.state = state
+        self.respond = respond
+        self.sink = sink
+        self.min_interval = min_interval
+        self.subscriptions: List[Subscription] = []
+        self.active = False
+        self.stats = {"changes": 0, "sent": 0, "coalesced": 0}
+        self._did_index: Dict[int, List[Subscription]] = {}
+        self._dtc_index: List[List[Subscription]] = [[] for _ in range(8)]
+        self._listening = False
+        self._cond = threading.Condition()
+        self._pending = []
+        self._waiting = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def define(self, event_type: int, window: int, record: bytes, service: bytes) -> Subscription:
+        sub = Subscription(event_type, window, bytes(record), bytes(service))
+        with self._cond:
+            self.subscriptions.append(sub)
+            if event_type & 0x3f == ON_CHANGE_OF_DATA_IDENTIFIER:
+                did = (record[0] << 8) | record[1]
+                self._did_index[did] = self._did_index.get(did, []) + [sub]
+            else:
+                for bit in range(8):
+                    if record[0] >> bit & 1:
+                        self._dtc_index[bit] = self._dtc_index[bit] + [sub]
+        return sub
+
+    def start(self):
+        with self._cond:
+            self.active = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="roe", daemon=True)
+                self._thread.start()
+        self._listen(True)
+
+    def stop(self):
+        with self._cond:
+            self.active = False
+            for sub in self.subscriptions:
+                sub.dirty = False
+            self._pending.clear()
+            self._waiting.clear()
+        self._listen(False)
+
+    def clear(self):
+        self.stop()
+        with self._cond:
+            self.subscriptions = []
+            self._did_index = {}
+            self._dtc_index = [[] for _ in range(8)]
+
+    def close(self):
+        self.clear()
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._cond.notify()
+        if thread is not None:
+            thread.join(1.0)
+
+    def _listen(self, on: bool):
+        # 只有事件激活时才挂到本ECU的DID表/DTC缓冲区上, 否则写值没有任何额外开销
+        if on and not self._listening:
+            self.state.dids.add_listener(self.on_did)
+            self.state.dtcs.add_listener(self.on_dtc)
+        elif not on and self._listening:
+            self.state.dids.remove_listener(self.on_did)
+            self.state.dtcs.remove_listener(self.on_dtc)
+        self._listening = on
+
+    def on_did(self, did: int):
+        subs = self._did_index.get(did)
+        if subs is not None:
+            self._changed(subs)
+
+    def on_dtc(self, dtc: int, old: int, new: int):
+        changed = old ^ new
+        subs = []
+        while changed:
+            bit = (changed & -changed).bit_length() - 1
+            subs += self._dtc_index[bit]
+            changed &= changed - 1
+        if subs:
+            self._changed(subs)
+
+    def _changed(self, subs: List[Subscription]):
+        with self._cond:
+            if not self.active:
+                return
+            self.stats["changes"] += 1
+            wake = False
+            for sub in subs:
+                sub.changes += 1
+                if sub.dirty:
+                    # 还没发出去, 合并到待发的那一次
+                    self.stats["coalesced"] += 1
+                    continue
+                sub.dirty = True
+                self._pending.append(sub)
+                wake = True
+            if wake:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._thread is None:
+                        return
+                    now = time.monotonic()
+                    for sub in self._pending:
+                        heapq.heappush(self._waiting, (sub.last_sent + self.min_interval, next(self._seq), sub))
+                    self._pending.clear()
+                    if self._waiting and self._waiting[0][0] <= now:
+                        break
+                    self._cond.wait(self._waiting[0][0] - now if self._waiting else None)
+                ready = []
+                while self._waiting and self._waiting[0][0] <= now:
+                    sub = heapq.heappop(self._waiting)[2]
+                    # 先清标记, 发送期间的新变化会重新排队
+                    sub.dirty = False
+                    sub.last_sent = now
+                    ready.append(sub)
+            for sub in ready:
+                self._send(sub)
+
+    def _send(self, sub: Subscription):
+        try:
+            r = self.respond(sub.service)
+            if r is not None and self.sink is not None:
+                self.sink(r)
+                self.stats["sent"] += 1
+        except Exception:
+            logger.exception(f"ResponseOnEvent response {sub.service.hex()} failed.")
@@ -0,0 +1,122 @@
+import os
+import struct
+from hmac import compare_digest
+from typing import Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import cmac
+from cryptography.hazmat.primitives.ciphers import algorithms
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from ecustate import ReplayCounter
+from uds_response_code import UDSResponseCode
+
+# SecuredDataTransmission(0x84)的Administrative Parameter位
+ADMIN_REQUEST = 0x0001
+ADMIN_PRE_ESTABLISHED_KEY = 0x0008
+ADMIN_ENCRYPTED = 0x0010
+ADMIN_SIGNED = 0x0020
+ADMIN_SIGNED_RESPONSE = 0x0040
+
+# Signature/Encryption Calculation(厂商自定义): 0只签名(AES-CMAC), 1加密并认证(AES-GCM)
+ALGORITHM_CMAC = 0x00
+ALGORITHM_GCM = 0x01
+
+# SID之后的安全参数: Administrative Parameter, Signature/Encryption Calculation, Signature Length, Anti-replay Counter
+HEADER = struct.Struct(">HBHH")
+GCM_TAG_SIZE = 16
+GCM_NONCE_SIZE = 12
+# GCM的Signature/MAC字段: 认证标签 + 发送方每条消息随机生成的nonce; 标签紧跟密文, 解密时不用拼接
+GCM_SIGNATURE_SIZE = GCM_TAG_SIZE + GCM_NONCE_SIZE
+
+
+class SecurityError(ValueError):
+    def __init__(self, nrc: int, message: str):
+        super().__init__(message)
+        self.nrc = nrc
+
+
+class SecureChannel:
+    # 一个诊断仪连接的密钥上下文: AES密钥扩展和CMAC初始状态只在建立时做一次, 每条消息复制CMAC状态.
+    # GCM的nonce每条消息随机生成, 和计数器/连接/复位无关, 同一密钥下不会重复.
+    # replay: ECU的防重放计数器, 同一ECU的所有连接共用; 诊断仪一侧不用
+    def __init__(self, key: bytes, replay: ReplayCounter = None):
+        self.key = key
+        self.replay = ReplayCounter() if replay is None else replay
+        self._cmac = cmac.CMAC(algorithms.AES(key))
+        self._gcm = AESGCM(key)
+
+    def _mac(self, data) -> bytes:
+        c = self._cmac.copy()
+        c.update(data)
+        return c.finalize()
+
+    def seal(self, admin: int, algorithm: int, counter: int, message, sig_len: int = 16) -> bytes:
+        # 返回SID之后的部分: 安全参数 + 内部消息(GCM为密文) + 签名
+        if algorithm == ALGORITHM_GCM:
+            admin |= ADMIN_ENCRYPTED | ADMIN_SIGNED
+            header = HEADER.pack(admin, algorithm, GCM_SIGNATURE_SIZE, counter)
+            nonce = os.urandom(GCM_NONCE_SIZE)
+            return header + self._gcm.encrypt(nonce, bytes(message), header) + nonce
+        if not admin & ADMIN_SIGNED:
+            sig_len = 0
+        signed = HEADER.pack(admin, algorithm, sig_len, counter) + bytes(message)
+        return signed + self._mac(signed)[:sig_len] if sig_len else signed
+
+    def open(self, data, request: bool = True) -> Tuple[int, int, int, int, memoryview]:
+        # data: 完整的0x84请求(ECU一侧, request=True)/0xC4响应(诊断仪一侧); 返回(admin, 算法, 签名长度, 计数器, 内部消息).
+        # 只签名时内部消息是原缓冲区的切片, 大的TransferData不再复制
+        view = memoryview(data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data))
+        if len(view) < 1 + HEADER.size + 1:
+            raise SecurityError(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat, "message too short")
+        admin, algorithm, sig_len, counter = HEADER.unpack_from(view, 1)
+        if bool(admin & ADMIN_REQUEST) != request:
+            raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "wrong message direction")
+        if request and not admin & ADMIN_SIGNED:
+            # 请求必须签名(GCM也要置签名位), 不然不知道密钥也能绕过secured_services
+            raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "request is not signed")
+        end = len(view) - sig_len
+        if end < 1 + HEADER.size + 1:
+            raise SecurityError(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat, "signature too long")
+        if algorithm == ALGORITHM_GCM:
+            if sig_len != GCM_SIGNATURE_SIZE or not admin & ADMIN_ENCRYPTED:
+                raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "bad AES-GCM parameters")
+            nonce_at = len(view) - GCM_NONCE_SIZE
+            try:
+                inner = memoryview(self._gcm.decrypt(view[nonce_at:], view[1 + HEADER.size:nonce_at],
+                                                     view[1:1 + HEADER.size]))
+            except InvalidTag:
+                raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "AES-GCM tag mismatch")
+        elif algorithm == ALGORITHM_CMAC:
+            if admin & ADMIN_SIGNED:
+                if admin & ADMIN_ENCRYPTED or not 4 <= sig_len <= 16:
+                    raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "bad AES-CMAC parameters")
+                if not compare_digest(self._mac(view[1:end])[:sig_len], view[end:]):
+                    raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "AES-CMAC mismatch")
+            elif sig_len:
+                # 响应只在请求要求时才签名
+                raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, "unsigned message has a signature")
+            inner = view[1 + HEADER.size:end]
+        else:
+            raise SecurityError(UDSResponseCode.VersionNotSupported, f"algorithm {algorithm} is not support")
+        # 验证通过后才推进计数器, 伪造的消息不能把计数器往前推; 计数器的比较和回绕见ecustate.ReplayCounter
+        if request and not self.replay.accept(counter):
+            raise SecurityError(UDSResponseCode.SecureDataVerificationFailed, f"replayed counter {counter}")
+        return admin, algorithm, sig_len, counter, inner
+
+    def respond(self, admin: int, algorithm: int, sig_len: int, counter: int, response) -> bytes:
+        # 按请求的保护方式封装响应; 只签名时, 请求要求了响应签名才签
+        resp_admin = admin & ADMIN_PRE_ESTABLISHED_KEY
+        if algorithm == ALGORITHM_CMAC and admin & ADMIN_SIGNED_RESPONSE:
+            resp_admin |= ADMIN_SIGNED
+        return self.seal(resp_admin, algorithm, counter, response, sig_len)
+
+    # 诊断仪一侧
+    def protect(self, message, counter: int, algorithm: int = ALGORITHM_CMAC, sign_response: bool = True) -> bytes:
+        admin = ADMIN_REQUEST | ADMIN_PRE_ESTABLISHED_KEY | ADMIN_SIGNED
+        if sign_response:
+            admin |= ADMIN_SIGNED_RESPONSE
+        return b"\x84" + self.seal(admin, algorithm, counter, message)
+
+    def unprotect(self, response) -> bytes:
+        return bytes(self.open(response, request=False)[4])
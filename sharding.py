@@ -0,0 +1,386 @@
+import logging
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("app")
+
+# 头部按8字节字访问: head(写计数)在第0字, tail(读计数)在第8字, 各占一个cache line; 第12字为读方等待标志
+# 用本机字长整字读写(memoryview.cast), 避免'<Q'逐字节打包时另一进程读到撕裂的计数
+_HEAD = 0
+_TAIL = 8
+_WAITING = 12
+_DATA_OFFSET = 128
+_RECORD = struct.Struct("<II")  # 记录长度, 通道(ECU序号或CAN ID)
+_WRAP = 0xffffffff
+# can模式下通道高位携带CAN FD标志
+CHANNEL_FD = 1 << 31
+CHANNEL_BRS = 1 << 30
+CHANNEL_ID_MASK = 0x1fffffff
+
+
+class FrameRing:
+    # 单生产者单消费者的共享内存环形缓冲区,记录按8字节对齐
+    def __init__(self, name: Optional[str] = None, size: int = 1 << 20, create: bool = True, doorbell=None):
+        if create:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=_DATA_OFFSET + size)
+            self._shm.buf[:_DATA_OFFSET] = bytes(_DATA_OFFSET)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = create
+        self.size = self._shm.size - _DATA_OFFSET
+        self._buf = self._shm.buf
+        self._counters = self._buf[:_DATA_OFFSET].cast("Q")
+        self._data = self._buf[_DATA_OFFSET:_DATA_OFFSET + self.size]
+        self._pending = 0
+        self.doorbell = doorbell
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def _head(self) -> int:
+        return self._counters[_HEAD]
+
+    def _tail(self) -> int:
+        return self._counters[_TAIL]
+
+    def write(self, channel: int, data) -> bool:
+        if isinstance(data, list):
+            data = bytes(data)
+        n = len(data)
+        need = (_RECORD.size + n + 7) & ~7
+        if need > self.size // 2:
+            raise ValueError(f"frame of {n} bytes does not fit ring of {self.size} bytes")
+        head = self._head()
+        pos = head % self.size
+        free = self.size - (head - self._tail())
+        skip = 0
+        if pos + need > self.size:
+            skip = self.size - pos
+        if skip + need > free:
+            return False
+        if skip:
+            if skip >= _RECORD.size:
+                _RECORD.pack_into(self._data, pos, _WRAP, 0)
+            head += skip
+            pos = 0
+        _RECORD.pack_into(self._data, pos, n, channel)
+        self._data[pos + _RECORD.size:pos + _RECORD.size + n] = data
+        self._counters[_HEAD] = head + need
+        if self.doorbell is not None and self._counters[_WAITING]:
+            self.doorbell.release()
+        return True
+
+    def empty(self) -> bool:
+        return self._head() == self._tail()
+
+    def set_waiting(self, waiting: bool):
+        self._counters[_WAITING] = 1 if waiting else 0
+
+    def read(self) -> Optional[Tuple[int, memoryview]]:
+        # 返回的memoryview直接指向共享内存,调用release()之前有效
+        tail = self._tail()
+        head = self._head()
+        while tail != head:
+            pos = tail % self.size
+            if self.size - pos < _RECORD.size:
+                tail += self.size - pos
+                continue
+            n, channel = _RECORD.unpack_from(self._data, pos)
+            if n == _WRAP:
+                tail += self.size - pos
+                continue
+            self._pending = tail - self._tail() + ((_RECORD.size + n + 7) & ~7)
+            return channel, self._data[pos + _RECORD.size:pos + _RECORD.size + n]
+        if tail != self._tail():
+            self._counters[_TAIL] = tail
+        return None
+
+    def release(self):
+        self._counters[_TAIL] = self._tail() + self._pending
+        self._pending = 0
+
+    def close(self):
+        self._counters.release()
+        self._data.release()
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class Backoff:
+    # 轮询等待: 先让出CPU空转若干次,仍然没有数据就挂在门铃信号量上,由写方唤醒
+    def __init__(self, rings: List[FrameRing], doorbell, spins: int = 50):
+        self.rings = rings
+        self.doorbell = doorbell
+        self.spins = spins
+        self.idle = 0
+
+    def reset(self):
+        self.idle = 0
+
+    def wait(self, timeout: float = 0.05):
+        self.idle += 1
+        if self.idle < self.spins:
+            time.sleep(0)
+            return
+        for ring in self.rings:
+            ring.set_waiting(True)
+        # 置标志后再检查一次,避免写方在置标志之前写入而丢失唤醒
+        if all(ring.empty() for ring in self.rings):
+            self.doorbell.acquire(timeout=timeout)
+        for ring in self.rings:
+            ring.set_waiting(False)
+
+
+def _worker_main(inbound_name: str, outbound_name: str, ecus: List[dict], mode: str, stop, in_doorbell,
+                 out_doorbell):
+    from ecustate import ECUState
+    from uds import ServiceDispatcher
+
+    inbound = FrameRing(inbound_name, create=False, doorbell=in_doorbell)
+    outbound = FrameRing(outbound_name, create=False, doorbell=out_doorbell)
+    out_lock = threading.Lock()
+
+    def send(channel, data):
+        with out_lock:
+            while not outbound.write(channel, data):
+                time.sleep(0.00005)
+
+    stacks = {}
+    dispatchers = {}
+    if mode == "pdu":
+        for ecu in ecus:
+            dispatchers[ecu["index"]] = ServiceDispatcher(ECUState())
+    else:
+        for ecu in ecus:
+            stack = _IsoTpWorkerStack(ecu, send)
+            stacks[ecu["rxid"]] = stack
+    backoff = Backoff([inbound], in_doorbell)
+    try:
+        while not stop.is_set():
+            record = inbound.read()
+            if record is None:
+                backoff.wait()
+                continue
+            backoff.reset()
+            channel, view = record
+            if mode == "pdu":
+                try:
+                    r = dispatchers[channel].handle(view)
+                except Exception as e:
+                    logger.error(f"ECU {channel} failed to handle request: {e}")
+                    r = None
+                view.release()
+                inbound.release()
+                if r is not None:
+                    send(channel, r)
+            else:
+                stack = stacks.get(channel & CHANNEL_ID_MASK)
+                if stack is not None:
+                    stack.feed(channel, view)
+                view.release()
+                inbound.release()
+    finally:
+        for stack in stacks.values():
+            stack.stop()
+        inbound.close()
+        outbound.close()
+
+
+class _IsoTpWorkerStack:
+    # 工作进程里的ISO-TP栈,CAN帧来自共享内存环,而不是自己打开总线
+    def __init__(self, ecu: dict, send):
+        import isotp
+        from ecustate import ECUState
+        from uds import ServiceDispatcher
+
+        self._isotp = isotp
+        self.name = ecu.get("name")
+        self._send = send
+        self._rx = queue.SimpleQueue()
+        self.dispatcher = ServiceDispatcher(ECUState())
+        addr = isotp.Address(isotp.AddressingMode[ecu.get("addressing_mode", "Normal_11bits")],
+                             rxid=ecu["rxid"], txid=ecu["txid"])
+        self.layer = isotp.TransportLayer(self._rxfn, self._txfn, address=addr, params=ecu.get("params"))
+        self.layer.start()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def feed(self, channel: int, data):
+        self._rx.put(self._isotp.CanMessage(arbitration_id=channel & CHANNEL_ID_MASK, dlc=len(data), data=bytes(data),
+                                            extended_id=(channel & CHANNEL_ID_MASK) > 0x7ff,
+                                            is_fd=bool(channel & CHANNEL_FD),
+                                            bitrate_switch=bool(channel & CHANNEL_BRS)))
+
+    def _rxfn(self, timeout: float):
+        try:
+            return self._rx.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _txfn(self, msg):
+        self._send(msg.arbitration_id | (CHANNEL_FD if msg.is_fd else 0) | (CHANNEL_BRS if msg.bitrate_switch else 0),
+                   msg.data)
+
+    def _serve(self):
+        while self._running:
+            data = self.layer.recv(block=True, timeout=0.1)
+            if data:
+                # 和pdu模式一样, 一条请求出错不能让这个ECU停止服务
+                try:
+                    r = self.dispatcher.handle(data)
+                except Exception as e:
+                    logger.error(f"ECU {self.name} failed to handle request: {e}")
+                    r = None
+                if r is not None:
+                    self.layer.send(bytes(r))
+
+    def stop(self):
+        self._running = False
+        self.layer.stop()
+
+
+class ShardedSimulator:
+    # 在多个进程中运行ECU: 本进程拥有总线(或直接提交PDU),通过共享内存环与工作进程交换帧
+    # ecus: [{"name":..., "rxid":..., "txid":..., "params":{...}}], assignment: ECU名 -> 进程序号
+    # mode "pdu" 直接传递UDS请求, "can" 传递原始CAN帧并在工作进程中做ISO-TP
+
+    def __init__(self, ecus: List[dict], workers: int = None, assignment: Dict[str, int] = None,
+                 mode: str = "pdu", ring_size: int = 1 << 20):
+        if mode not in ("pdu", "can"):
+            raise ValueError(f"shard mode {mode} is not support.")
+        self.mode = mode
+        self.workers = workers or min(len(ecus), multiprocessing.cpu_count())
+        self.ecus = []
+        for i, ecu in enumerate(ecus):
+            ecu = dict(ecu, index=i)
+            ecu.setdefault("name", "ecu%d" % i)
+            ecu["worker"] = (assignment or {}).get(ecu["name"], i % self.workers)
+            if not 0 <= ecu["worker"] < self.workers:
+                raise ValueError(f"ECU {ecu['name']} is assigned to worker {ecu['worker']} out of range.")
+            self.ecus.append(ecu)
+        self.ring_size = ring_size
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stop = self._ctx.Event()
+        self._processes = []
+        self._inbound: List[FrameRing] = []
+        self._outbound: List[FrameRing] = []
+        self._in_locks = []
+        self._route = {}
+        self._responses = {}
+        self._collector = None
+        self._running = False
+        self._bus = None
+        self._bus_thread = None
+        self._out_doorbell = None
+
+    def start(self, bus=None):
+        # bus 为python-can总线对象,只在can模式下使用; 交给模拟器后由stop()关闭
+        self._bus = bus
+        self._running = True
+        self._out_doorbell = self._ctx.Semaphore(0)
+        for w in range(self.workers):
+            in_doorbell = self._ctx.Semaphore(0)
+            inbound = FrameRing(size=self.ring_size, doorbell=in_doorbell)
+            outbound = FrameRing(size=self.ring_size, doorbell=self._out_doorbell)
+            self._inbound.append(inbound)
+            self._outbound.append(outbound)
+            self._in_locks.append(threading.Lock())
+            ecus = [e for e in self.ecus if e["worker"] == w]
+            p = self._ctx.Process(target=_worker_main, args=(inbound.name, outbound.name, ecus, self.mode, self._stop,
+                                                             in_doorbell, self._out_doorbell),
+                                  name="ecusim-shard-%d" % w, daemon=True)
+            p.start()
+            self._processes.append(p)
+        for ecu in self.ecus:
+            self._responses[ecu["index"]] = queue.SimpleQueue()
+            if self.mode == "can":
+                self._route[ecu["rxid"]] = ecu["worker"]
+        self._collector = threading.Thread(target=self._collect, name="shard-collector", daemon=True)
+        self._collector.start()
+        if self.mode == "can" and bus is not None:
+            self._bus_thread = threading.Thread(target=self._bus_rx, name="shard-bus", daemon=True)
+            self._bus_thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        self._running = False
+        self._stop.set()
+        for p in self._processes:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        if self._collector is not None:
+            self._collector.join(timeout)
+        if self._bus_thread is not None:
+            self._bus_thread.join(timeout)
+            self._bus_thread = None
+        if self._bus is not None:
+            self._bus.shutdown()
+            self._bus = None
+        for ring in self._inbound + self._outbound:
+            ring.close()
+        self._processes, self._inbound, self._outbound, self._in_locks = [], [], [], []
+
+    def _push(self, worker: int, channel: int, data):
+        ring = self._inbound[worker]
+        with self._in_locks[worker]:
+            while not ring.write(channel, data):
+                time.sleep(0.00005)
+
+    def submit(self, ecu: int, data):
+        # pdu模式: 把一条UDS请求发给指定序号的ECU
+        self._push(self.ecus[ecu]["worker"], ecu, data)
+
+    def response(self, ecu: int, timeout: Optional[float] = 1.0) -> Optional[bytes]:
+        try:
+            return self._responses[ecu].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def request(self, ecu: int, data, timeout: Optional[float] = 1.0) -> Optional[bytes]:
+        self.submit(ecu, data)
+        return self.response(ecu, timeout)
+
+    def _bus_rx(self):
+        while self._running:
+            msg = self._bus.recv(timeout=0.1)
+            if msg is None:
+                continue
+            worker = self._route.get(msg.arbitration_id)
+            if worker is not None:
+                self._push(worker, msg.arbitration_id | (CHANNEL_FD if msg.is_fd else 0) |
+                           (CHANNEL_BRS if msg.bitrate_switch else 0), msg.data)
+
+    def _collect(self):
+        backoff = Backoff(self._outbound, self._out_doorbell)
+        if self.mode == "can":
+            import can
+        while self._running:
+            idle = True
+            for ring in self._outbound:
+                record = ring.read()
+                if record is None:
+                    continue
+                idle = False
+                channel, view = record
+                if self.mode == "pdu":
+                    self._responses[channel].put(bytes(view))
+                elif self._bus is not None:
+                    can_id = channel & CHANNEL_ID_MASK
+                    self._bus.send(can.Message(arbitration_id=can_id, data=bytes(view), is_extended_id=can_id > 0x7ff,
+                                               is_fd=bool(channel & CHANNEL_FD),
+                                               bitrate_switch=bool(channel & CHANNEL_BRS)))
+                view.release()
+                ring.release()
+            if idle:
+                backoff.wait()
+            else:
+                backoff.reset()
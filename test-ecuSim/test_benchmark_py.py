@@ -0,0 +1,13 @@
+import benchmark
+
+
+class TestBenchmark():
+    def test_run_save_compare(self, tmp_path):
+        results = benchmark.run("service.0x3E", rounds=2, min_time=0.0001, log=lambda *a: None)
+        assert list(results) == ["service.0x3E.TesterPresent"]
+        assert results["service.0x3E.TesterPresent"]["rounds"] == 2
+        path = str(tmp_path / "bench.json")
+        benchmark.save(results, path)
+        slower = {k: dict(v, median=v["median"] * 2) for k, v in results.items()}
+        assert benchmark.compare(path, results, log=lambda *a: None) == []
+        assert benchmark.compare(path, slower, log=lambda *a: None) == ["service.0x3E.TesterPresent"]
@@ -0,0 +1,104 @@
+import json
+import threading
+
+import pytest
+
+from dataconfig import DataReloader
+from did import DIDList, DIDSnapshot
+from ecustate import ECUState
+from uds import ReadDataByIdentifier, ReadDTCInformation, WriteDataByIdentifier
+
+
+@pytest.fixture
+def state():
+    state = ECUState.default()
+    dids = state.dids.snapshot
+    dtcs = state.dtcs.dtc_buffer
+    yield state
+    state.dids.swap(dids)
+    state.dtcs.swap(dtcs)
+
+
+def write_config(path, vin, speed, dtcs=()):
+    path.write_text(json.dumps({
+        "dids": {"0xF191": {"coding": "ascii", "length": 17, "value": vin},
+                 "0x0061": {"coding": "short", "factor": 0.01, "value": speed},
+                 "0x0100": {"coding": "uchar"}},
+        "dtcs": [{"pcode": p, "ftb": 1, "status": "0x09"} for p in dtcs]}))
+
+
+class TestDataReloader():
+    def test_reload(self, tmp_path, state):
+        path = tmp_path / "data.json"
+        write_config(path, "AAAAAAAAAAAAAAAAA", 1, ["0x0102"])
+        reloader = DataReloader(str(path))
+        assert reloader.poll() and not reloader.poll()
+        rdbi = ReadDataByIdentifier()
+        assert rdbi.process([0x22, 0xf1, 0x91], state) == [0x62, 0xf1, 0x91] + [0x41] * 17
+        assert rdbi.process([0x22, 0x00, 0x21], state) == [0x7f, 0x22, 0x31]
+        # 有编解码器但没有值的DID可以写, 写入后可读
+        assert rdbi.process([0x22, 0x01, 0x00], state) == [0x7f, 0x22, 0x31]
+        assert WriteDataByIdentifier().process([0x2e, 0x01, 0x00, 0x07], state) == [0x6e, 0x01, 0x00]
+        assert rdbi.process([0x22, 0x01, 0x00], state) == [0x62, 0x01, 0x00, 0x07]
+        assert ReadDTCInformation().process([0x19, 0x02, 0x09], state) == [0x59, 0x02, 0x01, 0x02, 0x01, 0x09]
+        assert reloader.stats["reloads"] == 1 and reloader.stats["swap"] < 0.01
+
+    def test_bad_config_keeps_current(self, tmp_path, state):
+        path = tmp_path / "data.json"
+        path.write_text(json.dumps({"dids": {"0x0021": {"coding": "float64"}}}))
+        snapshot = DIDList.snapshot
+        assert not DataReloader(str(path)).poll()
+        assert DIDList.snapshot is snapshot
+
+    def test_out_of_range_value_keeps_current(self, tmp_path, state):
+        path = tmp_path / "data.json"
+        path.write_text(json.dumps({"dids": {"0x0021": {"coding": "uchar", "value": 1000}}}))
+        snapshot = DIDList.snapshot
+        reloader = DataReloader(str(path))
+        assert not reloader.poll()
+        assert DIDList.snapshot is snapshot and reloader.stats["errors"] == 1
+
+    @pytest.mark.parametrize("config", [
+        {"dids": {"0x0021": {"coding": "uchar", "factor": 0, "value": 1}}},
+        {"dids": {"0x0021": {"coding": "ascii", "length": 0}}},
+        {"dids": {"0x10000": {"coding": "uchar"}}},
+        {"dids": ["x"]},
+        {"dids": {"0x0021": "x"}},
+        {"dtcs": [{"pcode": "0x1ffffff", "ftb": 1, "status": 9}]},
+        {"dtcs": [{"pcode": 1, "ftb": 256, "status": 9}]},
+        {"dtcs": [{"pcode": 1, "ftb": 1, "status": 300}]},
+        {"dtcs": {"pcode": 1}},
+        {"dtcs": ["x"]},
+        [{"dids": {}}],
+    ])
+    def test_invalid_config_keeps_current(self, tmp_path, state, config):
+        # 配置形状或字段范围不对时报错并保留当前配置, 不会让启动时的poll()或监视线程退出
+        path = tmp_path / "data.json"
+        path.write_text(json.dumps(config))
+        snapshot, dtcs = DIDList.snapshot, state.dtcs.dtc_buffer
+        reloader = DataReloader(str(path))
+        assert not reloader.poll()
+        assert DIDList.snapshot is snapshot and state.dtcs.dtc_buffer is dtcs and reloader.stats["errors"] == 1
+        assert ReadDTCInformation().process([0x19, 0x02, 0xff], state)[0] == 0x59
+
+    def test_reads_see_whole_snapshot(self, state):
+        # 读线程一直读两个DID, 换表线程在两套取值间切换, 读到的必须来自同一份表
+        a = DIDSnapshot(DIDList.dict, {**DIDList.value, 0xf191: "A" * 17, 0x0021: 10})
+        b = DIDSnapshot(DIDList.dict, {**DIDList.value, 0xf191: "B" * 17, 0x0021: 20})
+        done = threading.Event()
+
+        def swap():
+            while not done.is_set():
+                DIDList.swap(a)
+                DIDList.swap(b)
+
+        t = threading.Thread(target=swap)
+        t.start()
+        rdbi = ReadDataByIdentifier()
+        try:
+            for _ in range(2000):
+                r = rdbi.process([0x22, 0xf1, 0x91, 0x00, 0x21], state)
+                assert (r[3], r[-1]) in ((0x41, 20), (0x42, 40))
+        finally:
+            done.set()
+            t.join()
@@ -0,0 +1,105 @@
+import socket
+
+import pytest
+
+from doip import DoIPClient, DoIPServer, identify, pack_message, HEADER, GENERIC_NACK, DIAGNOSTIC_MESSAGE, \
+    DIAGNOSTIC_NACK, NACK_MESSAGE_TOO_LARGE
+from loadgen import download_sequence
+from main import ECUSim, doip_routes
+from transport import LoopbackTransport
+from ecustate import ECUState
+from uds import ServiceDispatcher
+
+
+@pytest.fixture
+def state():
+    return ECUState()
+
+
+@pytest.fixture
+def server(state):
+    server = DoIPServer({0x0e80: lambda: ServiceDispatcher(state)}, vin="WDB12345678901234", port=0,
+                        max_data_size=0x2000)
+    server.start()
+    yield server
+    server.stop()
+
+
+class TestDoIP():
+    def test_identification(self, server):
+        announcement = identify(port=server.udp_port)
+        assert announcement[:17] == b"WDB12345678901234"
+        assert announcement[17:19] == b"\x0e\x80"
+
+    def test_diagnostic_message(self, server):
+        client = DoIPClient(port=server.port)
+        try:
+            assert client.connect() == 0x0e80
+            assert client.request([0x3e, 0x00]) == bytes([0x7e, 0x00])
+            assert client.request([0x01]) == bytes([0x7f, 0x01, 0x11])
+            with pytest.raises(ConnectionError):
+                client.request([0x3e, 0x00], target=0x0e81)
+        finally:
+            client.close()
+
+    def test_download(self, server, state):
+        client = DoIPClient(port=server.port)
+        client.connect()
+        try:
+            sequence = download_sequence(20000)
+            for req in sequence[:-1]:
+                r = client.request(req)
+                assert r[0] != 0x7f
+            assert bytes(state.eol.rev_buffer) == bytes(b for req in sequence if req[0] == 0x36 for b in req[2:])
+            client.request(sequence[-1])
+        finally:
+            client.close()
+
+    def test_connections_have_own_session(self, server):
+        # 两个DoIP诊断仪连同一个ECU: 会话按连接分开, ECU状态共用
+        a, b = DoIPClient(port=server.port), DoIPClient(port=server.port, source_address=0x0e01)
+        a.connect()
+        b.connect()
+        try:
+            assert a.request([0x10, 0x03])[0] == 0x50
+            assert a.request([0x31, 0x01, 0x33, 0x44])[0] == 0x71
+            assert b.request([0x31, 0x01, 0x33, 0x44]) == bytes([0x7f, 0x31, 0x7f])
+            assert a.request([0x2e, 0x00, 0x21, 0x10]) == bytes([0x6e, 0x00, 0x21])
+            assert b.request([0x22, 0x00, 0x21]) == bytes([0x62, 0x00, 0x21, 0x10])
+        finally:
+            a.close()
+            b.close()
+
+    def test_routes(self):
+        # main的DoIP路由: 每个ECU一个逻辑地址, 目标地址决定访问哪个ECU的状态
+        ecus = [ECUSim(LoopbackTransport(), "a"), ECUSim(LoopbackTransport(), "b")]
+        ecus[1].doip_address = 0x0e90
+        server = DoIPServer(doip_routes(ecus, 0x0e80), port=0)
+        server.start()
+        client = DoIPClient(port=server.port)
+        try:
+            client.connect()
+            assert client.request([0x2e, 0x00, 0x21, 0x10], target=0x0e90) == bytes([0x6e, 0x00, 0x21])
+            assert ecus[1].state.dids.value[0x0021] == 8 and ecus[0].state.dids.value[0x0021] == 100
+        finally:
+            client.close()
+            server.stop()
+        ecus[1].doip_address = 0x0e80
+        with pytest.raises(ValueError):
+            doip_routes(ecus, 0x0e80)
+
+    def test_routing_required_and_too_large(self, server):
+        with socket.create_connection(("127.0.0.1", server.port), 2) as s:
+            s.sendall(pack_message(DIAGNOSTIC_MESSAGE, b"\x0e\x00\x0e\x80\x3e\x00"))
+            _, _, payload_type, _ = HEADER.unpack(s.recv(8))
+            assert payload_type == DIAGNOSTIC_NACK
+            s.recv(16)
+            s.sendall(pack_message(DIAGNOSTIC_MESSAGE, b"\x0e\x00\x0e\x80" + bytes(0x3000)))
+            _, _, payload_type, _ = HEADER.unpack(s.recv(8))
+            assert payload_type == GENERIC_NACK and s.recv(1)[0] == NACK_MESSAGE_TOO_LARGE
+        client = DoIPClient(port=server.port)
+        client.connect()
+        try:
+            assert client.request([0x3e, 0x00]) == bytes([0x7e, 0x00])
+        finally:
+            client.close()
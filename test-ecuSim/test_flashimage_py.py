@@ -0,0 +1,93 @@
+import pytest
+
+from ecustate import ECUState
+from flashimage import ReferenceImage, write_ihex, write_srec
+from loadgen import download_sequence
+from main import ECUSim, load_reference
+from transport import LoopbackTransport
+from uds import ServiceDispatcher
+
+IMAGE = bytes(range(256)) * 400
+CHECK_MEMORY = [0x31, 0x01, 0x33, 0x44]
+
+
+def _reference(tmp_path, fmt, segments):
+    path = tmp_path / ("ref." + fmt)
+    with open(path, "wb") as f:
+        if fmt == "hex":
+            write_ihex(f, segments)
+        elif fmt == "s19":
+            write_srec(f, segments)
+        else:
+            f.write(segments[0][1])
+    return ReferenceImage(str(path), base_address=segments[0][0] if fmt == "bin" else 0)
+
+
+def _download(d: ServiceDispatcher, image: bytes, address: int, compression: int = 0):
+    # 去掉最后回到默认会话的请求, 传输结束后还要执行CheckMemory
+    for req in download_sequence(len(image), address=address, compression=compression, image=image)[:-1]:
+        assert d.handle(req)[0] != 0x7f
+    return d.handle(CHECK_MEMORY)
+
+
+class TestFlashImage():
+    @pytest.mark.parametrize("fmt", ["hex", "s19", "bin"])
+    def test_segments(self, tmp_path, fmt):
+        segments = [(0x1fff0, IMAGE)] if fmt == "bin" else [(0x1fff0, IMAGE), (0x80000, b"\x01\x02")]
+        with _reference(tmp_path, fmt, segments) as ref:
+            assert [s[:2] for s in ref.segments] == [(a, a + len(data)) for a, data in segments]
+            assert b"".join(bytes(c) for _, c in ref.chunks()) == b"".join(data for _, data in segments)
+            assert b"".join(bytes(c) for _, c in ref.chunks(0x20000, 0x20010)) == IMAGE[0x10:0x20]
+
+    @pytest.mark.parametrize("fmt", ["hex", "s19", "bin"])
+    def test_first_mismatch(self, tmp_path, fmt):
+        ref = _reference(tmp_path, fmt, [(0x10000, IMAGE)])
+        v = ref.verifier(0x10000, len(IMAGE))
+        bad = bytearray(IMAGE)
+        bad[70000] ^= 0xff
+        bad[80000] ^= 0xff
+        for offset in range(0, len(bad), 4093):
+            v.feed(bad[offset:offset + 4093])
+        result = v.finish()
+        assert not result["ok"] and result["first_mismatch"] == 0x10000 + 70000 and not result["missing"]
+
+    def test_missing(self, tmp_path):
+        ref = _reference(tmp_path, "hex", [(0, IMAGE)])
+        v = ref.verifier(0, len(IMAGE))
+        v.feed(list(IMAGE[:5000]))
+        assert v.finish() == {"ok": False, "first_mismatch": 5000, "missing": True, "compared": 5000,
+                              "received": 5000}
+
+    def test_no_overlap(self, tmp_path):
+        # 二进制参考的基地址和下载地址对不上时, 没有比较任何数据, 不算通过
+        ref = _reference(tmp_path, "bin", [(0, IMAGE)])
+        v = ref.verifier(0x8000 + len(IMAGE), len(IMAGE))
+        v.feed(IMAGE)
+        assert v.finish()["ok"] is False and v.finish()["compared"] == 0
+
+    def test_reference_base(self, tmp_path):
+        path = tmp_path / "ref.bin"
+        path.write_bytes(IMAGE)
+        ecu = ECUSim(LoopbackTransport())
+        load_reference(ecu, str(path), 0x8000)
+        d = ServiceDispatcher(ecu.state)
+        assert _download(d, IMAGE, 0x8000) == [0x71, 0x01, 0x33, 0x44, 0x01]
+        assert ecu.state.eol.verify_result["compared"] == len(IMAGE)
+        ecu.state.eol.reference.close()
+
+    def test_bad_checksum(self, tmp_path):
+        path = tmp_path / "bad.hex"
+        path.write_bytes(b":0400000001020304F1\n:00000001FF\n")
+        with pytest.raises(ValueError):
+            ReferenceImage(str(path))
+
+    @pytest.mark.parametrize("compression", [0, 2])
+    def test_check_memory(self, tmp_path, compression):
+        state = ECUState()
+        state.eol.reference = _reference(tmp_path, "s19", [(0x8000, IMAGE)])
+        d = ServiceDispatcher(state)
+        assert _download(d, IMAGE, 0x8000, compression) == [0x71, 0x01, 0x33, 0x44, 0x01]
+        assert state.eol.verify_result["ok"] and state.eol.verify_result["compared"] == len(IMAGE)
+        bad = IMAGE[:100] + b"\x00" + IMAGE[101:]
+        assert _download(d, bad, 0x8000, compression) == [0x71, 0x01, 0x33, 0x44, 0xff]
+        assert state.eol.verify_result["first_mismatch"] == 0x8000 + 100
@@ -0,0 +1,43 @@
+import pytest
+
+from loadgen import LoadGenerator, loopback_sessions, read_did, download_sequence
+
+
+class TestLoadGenerator():
+    def test_builders(self):
+        assert read_did(0xf191, 0x0021) == [0x22, 0xf1, 0x91, 0x00, 0x21]
+        seq = download_sequence(5000)
+        assert [r[0] for r in seq] == [0x10, 0x31, 0x34, 0x36, 0x36, 0x37, 0x10]
+        assert sum(len(r) - 2 for r in seq if r[0] == 0x36) == 5000
+
+    def test_mix(self):
+        sessions = loopback_sessions(2)
+        try:
+            report = LoadGenerator(sessions, {"read_did": 3, "tester_present": 1, "read_dtc": 1}).run(10, count=50)
+        finally:
+            for s in sessions:
+                s.close()
+        assert report["requests"] == 100
+        assert set(report["operations"]) == {"read_did", "tester_present", "read_dtc"}
+        assert report["nrc_rate"] == {} and report["timeout_rate"] == 0
+        assert report["latency"]["p50"] <= report["latency"]["p99"]
+
+    def test_download_and_nrc(self):
+        sessions = loopback_sessions(1)
+        try:
+            report = LoadGenerator(sessions, {"download": 1}).run(10, count=2)
+            assert report["nrc_rate"] == {}
+            # 下载和必然回NRC的请求混在一起, 只有后者计入nrc_rate
+            report = LoadGenerator(sessions, {"download": 1, "read_did_unsupported": 1}).run(10, count=6)
+            nrc = report["operations"]["read_did_unsupported"]["requests"]
+            assert 0 < nrc < report["requests"]
+            assert report["nrc_rate"] == {"RequestOutOfRange": nrc / report["requests"]}
+            report = LoadGenerator(sessions, {"read_did": 1}).run(10, count=1)
+            assert report["requests"] == 1
+        finally:
+            for s in sessions:
+                s.close()
+
+    def test_unknown_operation(self):
+        with pytest.raises(ValueError):
+            LoadGenerator([], {"flash_everything": 1})
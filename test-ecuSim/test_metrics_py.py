@@ -0,0 +1,91 @@
+import threading
+import urllib.request
+
+from main import ECUSim
+from metrics import MetricsRegistry, MetricsServer
+from transport import LoopbackTransport
+
+
+class TestMetricsRegistry():
+    def test_observe(self):
+        m = MetricsRegistry()
+        m.observe("ecu", 0x22, [0x62, 0x00, 0x21, 0x10], 0.00003)
+        m.observe("ecu", 0x22, [0x7f, 0x22, 0x31], 2.0)
+        m.observe("ecu", 0x3e, None, 0.000001)
+        snap = m.snapshot()
+        assert snap["requests"] == {("ecu", 0x22): 2, ("ecu", 0x3e): 1}
+        assert snap["negative_responses"] == {("ecu", 0x22, 0x31): 1}
+        assert snap["suppressed_responses"] == {("ecu", 0x3e): 1}
+        h = snap["latency"][("ecu", 0x22)]
+        assert h["count"] == 2 and h["buckets"][0.00005] == 1 and h["buckets"][float("inf")] == 1
+
+    def test_threads(self):
+        m = MetricsRegistry()
+
+        def work():
+            for _ in range(1000):
+                m.observe("ecu", 0x10, [0x50, 0x01], 0.0001)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert m.snapshot()["requests"][("ecu", 0x10)] == 4000
+        m.reset()
+        assert m.snapshot()["requests"] == {}
+
+    def test_reset_while_observing(self):
+        # reset()时其他线程还在记录: 之后的记录都要算上, 不能丢也不能混进reset之前的
+        m = MetricsRegistry()
+        started = threading.Barrier(3)
+        resumed = threading.Event()
+
+        def work():
+            for _ in range(1000):
+                m.observe("ecu", 0x10, [0x50, 0x01], 0.0001)
+            started.wait()
+            resumed.wait()
+            for _ in range(500):
+                m.observe("ecu", 0x10, [0x50, 0x01], 0.0001)
+
+        threads = [threading.Thread(target=work) for _ in range(2)]
+        for t in threads:
+            t.start()
+        started.wait()
+        m.reset()
+        resumed.set()
+        for t in threads:
+            t.join()
+        snap = m.snapshot()
+        assert snap["requests"] == {("ecu", 0x10): 1000}
+        assert snap["latency"][("ecu", 0x10)]["count"] == 1000
+
+    def test_prometheus(self):
+        m = MetricsRegistry()
+        m.observe("ecu", 0x22, [0x7f, 0x22, 0x31], 0.0001)
+        text = m.render_prometheus()
+        assert 'ecusim_requests_total{ecu="ecu",sid="0x22",service="ReadDataByIdentifier"} 1' in text
+        assert 'nrc="0x31",nrc_name="RequestOutOfRange"} 1' in text
+        assert 'ecusim_request_duration_seconds_bucket{ecu="ecu",sid="0x22",service="ReadDataByIdentifier",le="+Inf"} 1' in text
+
+    def test_label_escape(self):
+        m = MetricsRegistry()
+        m.observe('a"b\\c\nd', 0x3e, [0x7e, 0x00], 0.0001)
+        assert 'ecusim_requests_total{ecu="a\\"b\\\\c\\nd",sid="0x3E",service="TesterPresent"} 1' in m.render_prometheus()
+
+
+class TestMetricsServer():
+    def test_endpoint(self):
+        m = MetricsRegistry()
+        ecu = ECUSim(LoopbackTransport(), "ecu7", m)
+        server = MetricsServer(m, port=0)
+        server.start()
+        ecu.start()
+        try:
+            assert ecu.transport.tester.request([0x22, 0x12, 0x34]) == bytes([0x7f, 0x22, 0x31])
+            body = urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics", timeout=2).read().decode()
+            assert 'ecusim_requests_total{ecu="ecu7",sid="0x22",service="ReadDataByIdentifier"} 1' in body
+        finally:
+            ecu.stop()
+            server.stop()
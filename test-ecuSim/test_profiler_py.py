@@ -0,0 +1,85 @@
+import json
+import logging
+import pstats
+import threading
+
+from ecustate import ECUState
+from main import ECUSim
+from profiler import Profiler
+from transport import LoopbackTransport
+from uds import ServiceDispatcher
+from uds_addtion import log_exception
+
+
+def run_requests(ecu, n=20):
+    for _ in range(n):
+        assert ecu.transport.tester.request([0x22, 0xf1, 0x91]) is not None
+        assert ecu.transport.tester.request([0x10, 0x03]) is not None
+
+
+class TestProfiler():
+    def test_deterministic(self, tmp_path):
+        ecu = ECUSim(LoopbackTransport())
+        profiler = Profiler(str(tmp_path))
+        ecu.start()
+        try:
+            profiler.start()
+            run_requests(ecu)
+            report = profiler.stop()
+        finally:
+            ecu.stop()
+        assert report["handlers"]["ReadDataByIdentifier"]["calls"] == 20
+        assert report["handlers"]["DiagnosticSessionControl"]["calls"] == 20
+        assert report["output"].endswith(".pstats")
+        functions = {f[2] for f in pstats.Stats(report["output"]).stats}
+        assert "process" in functions
+
+    def test_concurrent(self, tmp_path):
+        # 三个请求同时在处理中, 都要有响应(3.12起全进程只能启用一个profiler)
+        barrier = threading.Barrier(3, timeout=5)
+
+        @log_exception(logging.getLogger("app"), label=lambda d, data: "ReadDataByIdentifier")
+        def handle(d, data):
+            barrier.wait()
+            return d.handle(data)
+
+        results = []
+
+        def tester():
+            results.append(handle(ServiceDispatcher(ECUState()), [0x22, 0xf1, 0x91]))
+
+        threads = [threading.Thread(target=tester) for _ in range(3)]
+        profiler = Profiler(str(tmp_path))
+        profiler.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report = profiler.stop()
+        assert len(results) == 3 and all(r is not None and r[0] == 0x62 for r in results)
+        assert report["handlers"]["ReadDataByIdentifier"]["calls"] == 3
+        functions = {f[2] for f in pstats.Stats(report["output"]).stats}
+        assert "handle" in functions
+
+    def test_sampling(self, tmp_path):
+        ecu = ECUSim(LoopbackTransport())
+        profiler = Profiler(str(tmp_path))
+        ecu.start()
+        try:
+            profiler.start(mode="sampling", interval=0.0001)
+            run_requests(ecu, 200)
+            report = profiler.stop()
+        finally:
+            ecu.stop()
+        with open(report["output"]) as f:
+            profile = json.load(f)
+        assert profile["profiles"][0]["type"] == "sampled"
+        assert report["handlers"]["ReadDataByIdentifier"]["calls"] == 200
+
+    def test_http_route(self, tmp_path):
+        profiler = Profiler(str(tmp_path))
+        assert profiler.http_route("/profile?seconds=30")[0] == 202
+        assert profiler.http_route("/profile")[0] == 409
+        code, body = profiler.http_route("/profile?action=stop")
+        assert code == 200 and json.loads(body)["mode"] == "deterministic"
+        assert not profiler.active
@@ -0,0 +1,87 @@
+import queue
+import time
+
+import pytest
+
+from ecustate import ECUState
+from main import ECUSim
+from transport import LoopbackTransport
+from uds import ServiceDispatcher
+
+
+@pytest.fixture
+def dispatcher():
+    pushed = queue.SimpleQueue()
+    d = ServiceDispatcher(ECUState(), sink=pushed.put)
+    d.pushed = pushed
+    d.handle([0x10, 0x03])
+    yield d
+    d.close()
+
+
+class TestResponseOnEvent():
+    def test_change_of_did(self, dispatcher):
+        d = dispatcher
+        assert d.handle([0x86, 0x03, 0x02, 0x00, 0x61, 0x22, 0x00, 0x61]) == [0xc6, 0x03, 0, 0x02, 0x00, 0x61, 0x22,
+                                                                               0x00, 0x61]
+        # 启动前的变化不通知
+        d.handle([0x2e, 0x00, 0x61, 0x00, 0x01])
+        assert d.handle([0x86, 0x05, 0x02]) == [0xc6, 0x05, 0, 0x02]
+        assert d.handle([0x86, 0x04]) == [0xc6, 0x04, 1, 0x03, 0x02, 0x00, 0x61, 0x22, 0x00, 0x61]
+        d.handle([0x2e, 0x00, 0x21, 0x10])
+        d.handle([0x2e, 0x00, 0x61, 0x00, 0x02])
+        assert d.pushed.get(timeout=1) == [0x62, 0x00, 0x61, 0x00, 0x02]
+        # 写入相同的值不算变化
+        d.handle([0x2e, 0x00, 0x61, 0x00, 0x02])
+        assert d.handle([0x86, 0x00, 0x02]) == [0xc6, 0x00, 0, 0x02]
+        d.handle([0x2e, 0x00, 0x61, 0x00, 0x03])
+        time.sleep(0.05)
+        assert d.pushed.empty()
+
+    def test_coalescing(self, dispatcher):
+        d = dispatcher
+        d.events.min_interval = 0.2
+        d.handle([0x86, 0x03, 0x02, 0x00, 0x61, 0x22, 0x00, 0x61])
+        d.handle([0x86, 0x05, 0x02])
+        d.handle([0x2e, 0x00, 0x61, 0x00, 0x01])
+        assert d.pushed.get(timeout=1)[-1] == 0x01
+        for i in range(2, 12):
+            d.handle([0x2e, 0x00, 0x61, 0x00, i])
+        # 限速期间的10次变化合并成一次, 带最新值
+        assert d.pushed.get(timeout=1)[-1] == 11
+        time.sleep(0.3)
+        assert d.pushed.empty()
+        assert d.events.stats["coalesced"] == 9
+
+    def test_dtc_status_change(self, dispatcher):
+        d = dispatcher
+        d.state.dtcs.swap(())
+        d.handle([0x86, 0x01, 0x02, 0x01, 0x19, 0x02, 0x01])
+        d.handle([0x86, 0x05, 0x02])
+        d.state.dtcs.set_status(0x0102, 0x03, 0x08)
+        d.state.dtcs.set_status(0x0102, 0x03, 0x09)
+        assert d.pushed.get(timeout=1) == [0x59, 0x02, 0x01, 0x02, 0x03, 0x09]
+        assert d.handle([0x86, 0x06, 0x02]) == [0xc6, 0x06, 0, 0x02]
+        assert d.handle([0x86, 0x04]) == [0xc6, 0x04, 0]
+
+    @pytest.mark.parametrize("request_data,nrc", [
+        ([0x86, 0x03, 0x02, 0x12, 0x34, 0x22, 0x12, 0x34], 0x31),
+        ([0x86, 0x03, 0x02, 0x00, 0x61, 0x2e, 0x00, 0x61], 0x31),
+        ([0x86, 0x03, 0x02, 0x00, 0x61], 0x13),
+        ([0x86, 0x05, 0x02], 0x31),
+        ([0x86, 0x02, 0x02], 0x12),
+    ])
+    def test_nrc(self, dispatcher, request_data, nrc):
+        assert dispatcher.handle(request_data) == [0x7f, 0x86, nrc]
+
+    def test_pushed_over_transport(self):
+        ecu = ECUSim(LoopbackTransport())
+        ecu.start()
+        tester = ecu.transport.tester
+        try:
+            tester.request([0x86, 0x03, 0x02, 0x00, 0x21, 0x22, 0x00, 0x21])
+            tester.request([0x86, 0x05, 0x02])
+            assert tester.request([0x2e, 0x00, 0x21, 0x33]) == bytes([0x6e, 0x00, 0x21])
+            assert tester.recv(1) == bytes([0x62, 0x00, 0x21, 0x33])
+        finally:
+            ecu.stop()
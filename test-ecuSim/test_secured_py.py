@@ -0,0 +1,131 @@
+import pytest
+
+pytest.importorskip("cryptography")
+
+from ecustate import ECUState
+from loadgen import download_sequence
+from secured import ADMIN_PRE_ESTABLISHED_KEY, ADMIN_REQUEST, ALGORITHM_CMAC, ALGORITHM_GCM, HEADER, SecureChannel
+from uds import ServiceDispatcher
+
+KEY = bytes(range(16))
+READ_VIN = bytes([0x22, 0xf1, 0x91])
+
+
+@pytest.fixture
+def dispatcher():
+    return ServiceDispatcher(ECUState(secure_key=KEY, secured_services=[0x2e, 0x36]))
+
+
+class TestSecuredDataTransmission():
+    @pytest.mark.parametrize("algorithm", [ALGORITHM_CMAC, ALGORITHM_GCM])
+    def test_protected_request(self, dispatcher, algorithm):
+        tester = SecureChannel(KEY)
+        r = dispatcher.handle(tester.protect(READ_VIN, 1, algorithm))
+        assert r[0] == 0xc4
+        assert tester.unprotect(r) == bytes(dispatcher.handle(list(READ_VIN)))
+        # 内部的否定响应也在0xC4里
+        assert tester.unprotect(dispatcher.handle(tester.protect(b"\x2e\x00", 2, algorithm))) == b"\x7f\x2e\x13"
+
+    def test_unsigned_response(self, dispatcher):
+        tester = SecureChannel(KEY)
+        r = dispatcher.handle(tester.protect(READ_VIN, 1, sign_response=False))
+        assert r[1:8] == [0x00, 0x08, ALGORITHM_CMAC, 0, 0, 0, 1]
+        assert tester.unprotect(r) == bytes(dispatcher.handle(list(READ_VIN)))
+
+    def test_verification(self, dispatcher):
+        tester = SecureChannel(KEY)
+        request = bytearray(tester.protect(READ_VIN, 5))
+        request[-1] ^= 1
+        assert dispatcher.handle(request) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle(SecureChannel(bytes(16)).protect(READ_VIN, 5, ALGORITHM_GCM)) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle(tester.protect(READ_VIN, 5))[0] == 0xc4
+        # 重放和计数器回退都拒绝, ECUReset后重新开始
+        assert dispatcher.handle(tester.protect(READ_VIN, 5)) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle(tester.protect(READ_VIN, 4)) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle(tester.protect(READ_VIN, 6, 0x7f)) == [0x7f, 0x84, 0x3d]
+
+    def test_replay_after_reset(self, dispatcher):
+        # ECUReset, 恢复快照和新的连接都不会让计数器回退, 截获的请求不能重放
+        tester = SecureChannel(KEY)
+        snapshot = dispatcher.snapshot()
+        captured = tester.protect(READ_VIN, 1, ALGORITHM_GCM)
+        assert dispatcher.handle(captured)[0] == 0xc4
+        dispatcher.handle([0x11, 0x01])
+        assert dispatcher.handle(captured) == [0x7f, 0x84, 0x3a]
+        dispatcher.restore(snapshot)
+        assert dispatcher.handle(captured) == [0x7f, 0x84, 0x3a]
+        assert ServiceDispatcher(dispatcher.state).handle(captured) == [0x7f, 0x84, 0x3a]
+        # 换密钥后计数器才重新开始
+        dispatcher.state.secure_key = bytes(KEY)
+        assert dispatcher.handle(captured)[0] == 0xc4
+
+    def test_counter_wrap(self, dispatcher):
+        # 16位计数器到0xffff后从0接着数, 回绕后旧计数器的请求仍然被拒
+        tester = SecureChannel(KEY)
+        for counter in (0xfffe, 0xffff, 0, 1):
+            assert dispatcher.handle(tester.protect(READ_VIN, counter))[0] == 0xc4, counter
+        assert dispatcher.handle(tester.protect(READ_VIN, 0xffff)) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle(tester.protect(READ_VIN, 1)) == [0x7f, 0x84, 0x3a]
+        # 往前跳0x8000及以上算回退, 窗口内可以跳过
+        assert dispatcher.handle(tester.protect(READ_VIN, 0x8001)) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle(tester.protect(READ_VIN, 0x8000))[0] == 0xc4
+
+    def test_long_download(self):
+        # 256MB的刷写要约6.6万个TransferData, 超过一圈计数器
+        replay = ECUState(secure_key=KEY).replay
+        assert all(replay.accept(i & 0xffff) for i in range(1, 70000))
+        assert not replay.accept((70000 - 1) & 0xffff)
+
+    def test_resync(self):
+        # 诊断仪不知道ECU的计数器: 依次试c, c+0x4000, c+0x8000, c+0xC000
+        for last in (0x1234, 0x5234, 0x9234, 0xd234, 0x1233, 0xffff, 0x0000):
+            d = ServiceDispatcher(ECUState(secure_key=KEY))
+            assert d.handle(SecureChannel(KEY).protect(READ_VIN, last))[0] == 0xc4
+            tester = SecureChannel(KEY)
+            for step in range(4):
+                if d.handle(tester.protect(READ_VIN, (0x1234 + step * 0x4000) & 0xffff))[0] == 0xc4:
+                    break
+            else:
+                pytest.fail(f"can not resync with ECU counter {last:#x}")
+
+    def test_gcm_nonce(self, dispatcher):
+        # nonce每条消息随机生成, 相同计数器和内容的响应密文也不同
+        tester = SecureChannel(KEY)
+        first = dispatcher.handle(tester.protect(READ_VIN, 1, ALGORITHM_GCM))
+        dispatcher.state.secure_key = bytes(KEY)
+        second = dispatcher.handle(tester.protect(READ_VIN, 1, ALGORITHM_GCM))
+        assert first[:8] == second[:8] and first[8:] != second[8:]
+        assert tester.unprotect(first) == tester.unprotect(second)
+
+    def test_secured_services(self, dispatcher):
+        tester = SecureChannel(KEY)
+        dispatcher.handle([0x10, 0x03])
+        assert dispatcher.handle([0x2e, 0x00, 0x21, 0x10]) == [0x7f, 0x2e, 0x38]
+        assert tester.unprotect(dispatcher.handle(tester.protect(b"\x2e\x00\x21\x10", 1))) == b"\x6e\x00\x21"
+        assert dispatcher.handle([0x22, 0x00, 0x21]) == [0x62, 0x00, 0x21, 0x10]
+
+    @pytest.mark.parametrize("admin", [ADMIN_PRE_ESTABLISHED_KEY, ADMIN_PRE_ESTABLISHED_KEY | ADMIN_REQUEST])
+    def test_unsigned_request(self, dispatcher, admin):
+        # 不带签名的请求(包括没有置请求位的)不能绕过secured_services
+        dispatcher.handle([0x10, 0x03])
+        request = b"\x84" + HEADER.pack(admin, ALGORITHM_CMAC, 0, 5) + b"\x2e\x00\x21\x10"
+        assert dispatcher.handle(request) == [0x7f, 0x84, 0x3a]
+        assert dispatcher.handle([0x22, 0x00, 0x21]) != [0x62, 0x00, 0x21, 0x10]
+        # 计数器没有被推进
+        assert SecureChannel(KEY).unprotect(dispatcher.handle(SecureChannel(KEY).protect(READ_VIN, 1)))[0] == 0x62
+
+    def test_no_key(self):
+        d = ServiceDispatcher(ECUState())
+        assert d.handle(SecureChannel(KEY).protect(READ_VIN, 1)) == [0x7f, 0x84, 0x3e]
+
+    @pytest.mark.parametrize("algorithm", [ALGORITHM_CMAC, ALGORITHM_GCM])
+    def test_protected_download(self, dispatcher, algorithm):
+        tester = SecureChannel(KEY)
+        image = bytes(range(256)) * 64
+        for counter, req in enumerate(download_sequence(len(image), image=image), 1):
+            if req[0] == 0x36:
+                r = tester.unprotect(dispatcher.handle(tester.protect(bytes(req), counter, algorithm)))
+                assert r == bytes([0x76, req[1]])
+            else:
+                assert dispatcher.handle(req)[0] != 0x7f
+        assert dispatcher.state.eol.rev_buffer == image
@@ -0,0 +1,156 @@
+import json
+import time
+
+import pytest
+
+from sharding import FrameRing, ShardedSimulator
+
+
+class TestFrameRing():
+    def test_wrap_around(self):
+        ring = FrameRing(size=256)
+        try:
+            for i in range(200):
+                data = bytes([i & 0xff]) * (1 + i % 40)
+                assert ring.write(i, data)
+                channel, view = ring.read()
+                assert channel == i and bytes(view) == data
+                view.release()
+                ring.release()
+            assert ring.read() is None
+        finally:
+            ring.close()
+
+    def test_full(self):
+        ring = FrameRing(size=256)
+        try:
+            assert ring.write(1, bytes(100))
+            assert ring.write(2, bytes(100))
+            assert not ring.write(3, bytes(100))
+            with pytest.raises(ValueError):
+                ring.write(4, bytes(200))
+            channel, view = ring.read()
+            assert channel == 1
+            view.release()
+            ring.release()
+            assert ring.write(3, bytes(100))
+            for expected in (2, 3):
+                channel, view = ring.read()
+                assert channel == expected and len(view) == 100
+                view.release()
+                ring.release()
+        finally:
+            ring.close()
+
+
+class TestShardedSimulator():
+    def test_assignment(self):
+        with pytest.raises(ValueError):
+            ShardedSimulator([{"name": "a"}], workers=1, assignment={"a": 3})
+        sim = ShardedSimulator([{"name": "a"}, {"name": "b"}, {"name": "c"}], workers=2, assignment={"c": 0})
+        assert [e["worker"] for e in sim.ecus] == [0, 1, 0]
+
+    def test_request(self):
+        sim = ShardedSimulator([{"name": "a"}, {"name": "b"}, {"name": "c"}], workers=2)
+        sim.start()
+        try:
+            assert sim.request(0, [0x3e, 0x00], timeout=30) == bytes([0x7e, 0x00])
+            assert sim.request(1, [0x10, 0x03], timeout=5) == bytes([0x50, 0x03, 0x13, 0x88, 0x00, 0xc8])
+            assert sim.request(2, [0x31, 0x01], timeout=5) == bytes([0x7f, 0x31, 0x7f])
+            # 会话是每个ECU各自的
+            assert sim.request(1, [0x31, 0x01], timeout=5) == bytes([0x7f, 0x31, 0x13])
+        finally:
+            sim.stop()
+
+    def test_can_mode(self):
+        # main.start_sharded用的路径: 原始CAN帧经共享内存环到工作进程, ISO-TP在工作进程里做
+        can = pytest.importorskip("can")
+        isotp = pytest.importorskip("isotp")
+        sim = ShardedSimulator([{"name": "a", "rxid": 0x7e0, "txid": 0x7e8},
+                                {"name": "b", "rxid": 0x7e1, "txid": 0x7e9}], workers=2, mode="can")
+        sim.start(can.Bus(interface="virtual", channel="test_shard_can", receive_own_messages=False))
+        # 每个诊断仪一个总线对象, 两个栈不共用接收队列
+        buses = [can.Bus(interface="virtual", channel="test_shard_can") for _ in range(2)]
+        stacks = [isotp.CanStack(bus, address=isotp.Address(rxid=rxid, txid=txid), params={"blocking_send": True})
+                  for bus, (rxid, txid) in zip(buses, ((0x7e8, 0x7e0), (0x7e9, 0x7e1)))]
+        for stack in stacks:
+            stack.start()
+        try:
+            # 多帧响应(流控由诊断仪发回工作进程), 会话是每个ECU各自的
+            stacks[0].send(bytes([0x22, 0xf1, 0x91]), send_timeout=30)
+            r = stacks[0].recv(block=True, timeout=30)
+            assert r[:3] == bytes([0x62, 0xf1, 0x91]) and r[3:].decode() == "FVB30FKA034ALDFA0"
+            stacks[1].send(bytes([0x10, 0x03]), send_timeout=5)
+            assert stacks[1].recv(block=True, timeout=30) == bytes([0x50, 0x03, 0x13, 0x88, 0x00, 0xc8])
+            stacks[0].send(bytes([0x31, 0x01, 0x02, 0x03]), send_timeout=5)
+            assert stacks[0].recv(block=True, timeout=5) == bytes([0x7f, 0x31, 0x7f])
+        finally:
+            for stack, bus in zip(stacks, buses):
+                stack.stop()
+                bus.shutdown()
+            sim.stop()
+
+    def test_start_sharded_fd(self):
+        # main.start_sharded: 总线级参数合并进每个ECU, CAN FD总线缺省用64字节帧; stop()关闭总线
+        can = pytest.importorskip("can")
+        pytest.importorskip("isotp")
+        from main import start_sharded
+
+        config = {"transport": {"interface": "virtual", "channel": "test_shard_fd", "fd": True,
+                                "params": {"stmin": 1}},
+                  "ecus": [{"name": "a", "rxid": 0x7e0, "txid": 0x7e8, "params": {"stmin": 0}}],
+                  "shard": {"workers": 1}}
+        sim = start_sharded(config)
+        bus = can.Bus(interface="virtual", channel="test_shard_fd")
+        try:
+            assert sim.ecus[0]["params"]["tx_data_length"] == 64 and sim.ecus[0]["params"]["stmin"] == 0
+            bus.send(can.Message(arbitration_id=0x7e0, data=[0x03, 0x22, 0xf1, 0x91], is_extended_id=False,
+                                 is_fd=True))
+            deadline = time.monotonic() + 30
+            msg = None
+            while msg is None and time.monotonic() < deadline:
+                msg = bus.recv(timeout=0.5)
+            # 20字节的响应在CAN FD上是一个单帧, 经典CAN上才会分段
+            assert msg is not None and msg.is_fd and bytes(msg.data[:5]) == bytes([0x00, 20, 0x62, 0xf1, 0x91])
+        finally:
+            bus.shutdown()
+            sim.stop()
+        assert sim._bus is None
+
+    def test_worker_survives_exception(self):
+        # 一条请求处理出错只丢这一条响应, 工作进程里的ISO-TP栈继续服务
+        pytest.importorskip("isotp")
+        from sharding import _IsoTpWorkerStack
+
+        sent = []
+        stack = _IsoTpWorkerStack({"name": "a", "rxid": 0x7e0, "txid": 0x7e8}, lambda channel, data: sent.append(data))
+        handle = stack.dispatcher.handle
+
+        def odd(data):
+            if data[0] == 0x3e:
+                raise IndexError("odd request")
+            return handle(data)
+
+        stack.dispatcher.handle = odd
+        try:
+            stack.feed(0x7e0, bytes([0x02, 0x3e, 0x00]))
+            stack.feed(0x7e0, bytes([0x02, 0x10, 0x03]))
+            deadline = time.monotonic() + 5
+            while not sent and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert sent and bytes(sent[0][:3]) == bytes([0x06, 0x50, 0x03])
+        finally:
+            stack.stop()
+
+    @pytest.mark.parametrize("option", [["--secure-key", "00" * 16], ["--metrics-port", "0"], ["--doip-port"],
+                                        ["--data-config", "data.json"], ["--reference-image", "ref.hex"]])
+    def test_unsupported_options(self, tmp_path, capsys, option):
+        # 分片配置还不支持的选项报参数错误, 而不是静默忽略
+        from main import parse_args
+
+        path = tmp_path / "sim.json"
+        path.write_text(json.dumps({"ecus": [{"name": "a", "rxid": 0x7e0, "txid": 0x7e8}], "shard": {}}))
+        with pytest.raises(SystemExit):
+            parse_args(["--config", str(path)] + option)
+        assert "sharded config" in capsys.readouterr().err
+        assert parse_args(["--config", str(path)]).config == str(path)
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import main 的累计导入时间预算(微秒), 本机实测约60ms, 留出CI机器的余量
+IMPORT_BUDGET_US = 200000
+# 只在用到对应功能时才允许导入的模块
+LAZY_MODULES = ("asyncio", "can", "isotp", "http.server", "multiprocessing", "logging.config", "lzma", "inspect",
+                "cProfile")
+
+
+def run(code, *flags):
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+class TestStartup():
+    def test_import_budget(self):
+        lines = run("import main", "-X", "importtime").stderr.splitlines()
+        cumulative = [int(line.split("|")[1]) for line in lines if line.rstrip().endswith("| main")]
+        assert cumulative and cumulative[0] < IMPORT_BUDGET_US
+
+    def test_lazy_modules(self):
+        out = run("import sys, main; print(' '.join(m for m in %r if m in sys.modules))" % (LAZY_MODULES,)).stdout
+        assert out.strip() == ""
+
+    def test_first_response(self, tmp_path):
+        code = ("import main; ecus = main.main(['--interface', 'loopback', '--log-config', 'none']); "
+                "print(ecus[0].transport.tester.request([0x3e, 0x00]).hex()); ecus[0].stop(0)")
+        out = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, capture_output=True, text=True, check=True,
+                             env=dict(os.environ, PYTHONPATH=ROOT)).stdout
+        assert out.split() == ["7e00"]
+        assert not (tmp_path / "log").exists()
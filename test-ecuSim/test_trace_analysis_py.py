@@ -0,0 +1,70 @@
+import ast
+import math
+import struct
+from array import array
+
+import pytest
+
+from trace_analysis import TraceDecoder, NpyWriter, decode_file, parse_asc, KIND_REQUEST, KIND_NEGATIVE, KIND_POSITIVE
+
+TRACE = """(100.000000) vcan0 7E0#0322F19100000000
+(100.001000) vcan0 7E8#101462F191465642
+(100.001500) vcan0 7E0#3000000000000000
+(100.002000) vcan0 7E8#2133304B41303334
+(100.003000) vcan0 7E8#22414C4446413000
+(100.010000) vcan0 7E0#0322123400000000
+(100.012000) vcan0 7E8#037F223100000000
+(100.020000) vcan0 7DF#023E000000000000
+(100.021000) vcan0 7E8#027E000000000000
+(100.030000) vcan0 123#0102030405060708
+"""
+
+
+def read_npy(path):
+    with open(path, "rb") as f:
+        assert f.read(6) == b"\x93NUMPY"
+        f.read(2)
+        (hlen,) = struct.unpack("<H", f.read(2))
+        assert (10 + hlen) % 64 == 0
+        header = ast.literal_eval(f.read(hlen).decode("latin1"))
+        return header, f.read()
+
+
+class TestTraceDecoder():
+    def test_decode(self, tmp_path):
+        path = tmp_path / "trace.log"
+        path.write_text(TRACE)
+        writer = NpyWriter(str(tmp_path / "out"))
+        decoder = decode_file(str(path), writer)
+        writer.close()
+        assert decoder.frames == 10 and decoder.pdus == 6
+        header, raw = read_npy(tmp_path / "out" / "sid.npy")
+        assert header["shape"] == (6,) and header["descr"] == "|u1"
+        assert list(raw) == [0x22, 0x22, 0x22, 0x22, 0x3e, 0x3e]
+        header, raw = read_npy(tmp_path / "out" / "kind.npy")
+        assert list(raw) == [KIND_REQUEST, KIND_POSITIVE, KIND_REQUEST, KIND_NEGATIVE, KIND_REQUEST, KIND_POSITIVE]
+        header, raw = read_npy(tmp_path / "out" / "did.npy")
+        assert list(array("i", raw))[:4] == [0xf191, 0xf191, 0x1234, -1]
+        header, raw = read_npy(tmp_path / "out" / "nrc.npy")
+        assert list(array("h", raw))[3] == 0x31
+        stats = decoder.latency_stats()
+        assert stats["ReadDataByIdentifier"]["count"] == 2
+        assert math.isclose(stats["ReadDataByIdentifier"]["max"], 0.003)
+        assert math.isclose(stats["TesterPresent"]["p50"], 0.001)
+
+    def test_numpy_load(self, tmp_path):
+        numpy = pytest.importorskip("numpy")
+        path = tmp_path / "trace.log"
+        path.write_text(TRACE)
+        writer = NpyWriter(str(tmp_path / "out"))
+        decode_file(str(path), writer)
+        writer.close()
+        assert numpy.load(tmp_path / "out" / "sid.npy").tolist() == [0x22, 0x22, 0x22, 0x22, 0x3e, 0x3e]
+        assert numpy.load(tmp_path / "out" / "did.npy").tolist()[:4] == [0xf191, 0xf191, 0x1234, -1]
+
+    def test_asc(self):
+        decoder = TraceDecoder()
+        parse_asc(["   1.000000 1  7E0             Rx   d 8 02 10 03 00 00 00 00 00",
+                   "   1.002000 1  7E8             Rx   d 8 06 50 03 13 88 00 C8 00"], decoder.feed)
+        c = decoder.take_columns()
+        assert list(c["subfunction"]) == [3, 3] and math.isclose(c["latency"][1], 0.002)
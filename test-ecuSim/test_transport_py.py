@@ -0,0 +1,70 @@
+import pytest
+
+from main import ECUSim, build_ecus, parse_args
+from transport import LoopbackTransport, IsoTpCanTransport, create_transport
+
+
+class TestLoopbackTransport():
+    def test_request(self):
+        ecu = ECUSim(LoopbackTransport())
+        ecu.start()
+        try:
+            assert list(ecu.transport.tester.request([0x3e, 0x00])) == [0x7e, 0x00]
+            assert list(ecu.transport.tester.request([0x22, 0x00, 0x21])) == [0x62, 0x00, 0x21, 200]
+        finally:
+            ecu.stop()
+
+    def test_unsupported_sid(self):
+        ecu = ECUSim(LoopbackTransport())
+        assert ecu.process([0x01]) == [0x7f, 0x01, 0x11]
+
+    def test_create_transport(self):
+        assert isinstance(create_transport({"interface": "loopback"}), LoopbackTransport)
+        assert isinstance(create_transport({"interface": "socketcan", "channel": "vcan0", "rxid": 1, "txid": 2}),
+                          IsoTpCanTransport)
+        with pytest.raises(ValueError):
+            create_transport({"interface": "serial"})
+
+    def test_cli(self):
+        ecus = build_ecus(parse_args(["--interface", "loopback"]))
+        assert len(ecus) == 1 and isinstance(ecus[0].transport, LoopbackTransport)
+
+
+class TestVirtualCanTransport():
+    def test_request(self):
+        can = pytest.importorskip("can")
+        isotp = pytest.importorskip("isotp")
+        ecu = ECUSim(IsoTpCanTransport("virtual", "test_transport", rxid=0x7e0, txid=0x7e8))
+        ecu.start()
+        bus = can.Bus(interface="virtual", channel="test_transport")
+        stack = isotp.CanStack(bus, address=isotp.Address(rxid=0x7e8, txid=0x7e0), params={'blocking_send': True})
+        stack.start()
+        try:
+            stack.send(bytes([0x22, 0xf1, 0x91]), send_timeout=1)
+            r = stack.recv(block=True, timeout=2)
+            assert r[:3] == bytes([0x62, 0xf1, 0x91]) and r[3:].decode() == "FVB30FKA034ALDFA0"
+        finally:
+            stack.stop()
+            bus.shutdown()
+            ecu.stop()
+
+    def test_can_fd(self):
+        pytest.importorskip("can")
+        pytest.importorskip("isotp")
+        from loadgen import download_sequence, virtual_can_sessions
+        params = {"can_fd": True, "tx_data_length": 64, "blocksize": 4, "stmin": 0}
+        session = virtual_can_sessions(1, params=params)[0]
+        try:
+            for req in download_sequence(3000):
+                r = session.request(req)
+                assert r is not None and r[0] == req[0] + 0x40
+        finally:
+            session.close()
+
+    def test_params(self):
+        t = IsoTpCanTransport("virtual", "x", rxid=1, txid=2, fd=True, params={"stmin": 2})
+        assert t.params["tx_data_length"] == 64 and t.params["stmin"] == 2 and t.params["can_fd"]
+        with pytest.raises(ValueError):
+            IsoTpCanTransport("virtual", "x", rxid=1, txid=2, params={"tx_data_length": 64})
+        with pytest.raises(ValueError):
+            IsoTpCanTransport("virtual", "x", rxid=1, txid=2, fd=True, params={"tx_data_length": 40})
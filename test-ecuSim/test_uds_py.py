@@ -0,0 +1,204 @@
+import threading
+
+import pytest
+
+from loadgen import download_sequence
+from ecustate import ECUState, PagedMemory
+from uds import ServiceDispatcher, ServiceTable, RoutineControl
+
+
+class TestServiceTable():
+    @pytest.mark.parametrize("request_data,nrc", [
+        ([0x10], 0x13),
+        ([0x10, 0x03, 0x00], 0x13),
+        ([0x10, 0x05], 0x12),
+        ([0x10, 0x00], 0x12),
+        ([0x3e, 0x01], 0x12),
+        ([0x22, 0xf1], 0x13),
+        ([0x22, 0xf1, 0x91, 0x00], 0x13),
+        ([0x14, 0xff, 0xff], 0x13),
+        ([0x19, 0x02], 0x13),
+        ([0x19, 0x04, 0xff], 0x12),
+        ([0x34, 0x00, 0x44, 0, 0, 0, 0, 0, 0, 0x10, 0], 0x7f),
+        ([0x31, 0x01, 0x11, 0x22], 0x7f),
+        ([0x01], 0x11),
+    ])
+    def test_malformed(self, request_data, nrc):
+        assert ServiceDispatcher(ECUState()).handle(request_data) == [0x7f, request_data[0], nrc]
+
+    def test_short_routine_control(self):
+        d = ServiceDispatcher(ECUState())
+        d.handle([0x10, 0x03])
+        assert d.handle([0x31, 0x01]) == [0x7f, 0x31, 0x13]
+        assert d.handle([0x31, 0x01, 0x55, 0x66]) == [0x7f, 0x31, 0x31]
+
+    def test_nrc_sets(self):
+        assert RoutineControl().is_valid_negative_response(0x13)
+        assert RoutineControl().is_valid_negative_response(0x12)
+        assert not RoutineControl().is_valid_negative_response(0x73)
+        assert ServiceTable().specs[0x10].sub_functions == 0b11110
+
+
+class TestServiceDispatcher():
+    def test_suppress_pos_response(self):
+        d = ServiceDispatcher(ECUState())
+        assert d.handle([0x3e, 0x80]) is None
+        assert d.handle([0x10, 0x83]) is None
+        assert d.session == 3
+        assert d.handle([0x10, 0x85]) == [0x7f, 0x10, 0x12]
+
+    def test_session(self):
+        d = ServiceDispatcher(ECUState())
+        assert d.handle([0x10, 0x02]) == [0x50, 0x02, 0x13, 0x88, 0x00, 0xc8]
+        assert d.session == 2
+        assert d.handle([0x11, 0x01]) == [0x51, 0x01]
+        assert d.session == 1
+
+    def test_download(self):
+        d = ServiceDispatcher(ECUState())
+        d.handle([0x10, 0x02])
+        assert d.handle([0x31, 0x01, 0x11, 0x22, 0, 0, 0, 0]) == [0x7f, 0x31, 0x13]
+        assert d.handle([0x31, 0x01, 0x11, 0x22, 0, 0, 0, 0, 0, 0, 0x10, 0]) == [0x71, 0x01, 0x11, 0x22, 0x01]
+        assert d.handle([0x34, 0x00, 0x44, 0, 0, 0, 0, 0, 0, 0x00, 4]) == [0x74, 0x20, 0x0f, 0xff]
+        assert d.handle([0x36, 0x01, 1, 2, 3, 4]) == [0x76, 0x01]
+        assert d.handle([0x37]) == [0x77]
+        assert d.state.eol.rev_buffer == bytes([1, 2, 3, 4])
+
+
+class TestECUState():
+    def test_ecus_are_isolated(self):
+        a, b = ServiceDispatcher(ECUState()), ServiceDispatcher(ECUState())
+        a.handle([0x10, 0x03])
+        assert a.handle([0x2e, 0x00, 0x21, 0x10]) == [0x6e, 0x00, 0x21]
+        assert a.handle([0x22, 0x00, 0x21]) == [0x62, 0x00, 0x21, 0x10]
+        assert b.handle([0x22, 0x00, 0x21]) == [0x62, 0x00, 0x21, 0xc8]
+        a.handle([0x14, 0xff, 0xff, 0xff])
+        assert a.handle([0x19, 0x02, 0xff]) == [0x59, 0x02]
+        assert len(b.handle([0x19, 0x02, 0xff])) == 14
+
+    def test_read_not_blocked_by_download(self):
+        # 两个诊断仪共用一个ECU: 刷写方占着下载锁时, 另一个诊断仪仍然可以读DID和DTC
+        state = ECUState()
+        flasher, reader = ServiceDispatcher(state), ServiceDispatcher(state)
+        flasher.handle([0x10, 0x02])
+        assert reader.session == 1
+        responses = []
+        with state.eol.lock:
+            t = threading.Thread(target=lambda: responses.extend(
+                [reader.handle([0x22, 0xf1, 0x91]), reader.handle([0x19, 0x02, 0xff])]))
+            t.start()
+            t.join(1)
+        assert [r[0] for r in responses] == [0x62, 0x59]
+
+    def test_snapshot_restore(self):
+        d = ServiceDispatcher(ECUState())
+        d.handle([0x10, 0x02])
+        for req in download_sequence(200000, block_size=1000)[:-1]:
+            d.handle(req)
+        snapshot = d.snapshot()
+        image = bytes(d.state.eol.rev_buffer)
+        # 测试用例改了DID, DTC, 动态DID, 会话和镜像
+        d.handle([0x2e, 0x00, 0x21, 0x10])
+        d.handle([0x14, 0xff, 0xff, 0xff])
+        d.handle([0x2c, 0x01, 0xf2, 0x00, 0xf1, 0x91, 1, 3])
+        d.state.eol.rev_buffer[10] ^= 0xff
+        d.state.eol.rev_buffer += b"tail"
+        d.handle([0x11, 0x01])
+        d.restore(snapshot)
+        assert d.session == 2
+        assert d.handle([0x22, 0x00, 0x21]) == [0x62, 0x00, 0x21, 0xc8]
+        assert len(d.handle([0x19, 0x02, 0xff])) == 14
+        assert d.handle([0x22, 0xf2, 0x00]) == [0x7f, 0x22, 0x31]
+        assert d.state.eol.rev_buffer == image
+        # 恢复后可以继续这次下载
+        assert d.handle([0x37]) == [0x77]
+        d.restore(snapshot)
+        assert d.state.eol.rev_buffer == image
+
+    def test_paged_memory_copy_on_write(self):
+        data = bytes(range(256)) * 1024
+        a = PagedMemory(data)
+        b = a.copy()
+        assert a._pages[0] is b._pages[0]
+        b[5] = 0
+        b += b"xyz"
+        assert a == data and bytes(a) == data
+        assert b[:8] == data[:5] + b"\x00" + data[6:8] and b[-3:] == b"xyz" and b[-1] == ord("z")
+        assert a[PagedMemory.PAGE_SIZE - 2:PagedMemory.PAGE_SIZE + 2] == data[PagedMemory.PAGE_SIZE - 2:
+                                                                              PagedMemory.PAGE_SIZE + 2]
+        assert a._pages[1] is b._pages[1]
+
+
+class TestDynamicallyDefineDataIdentifier():
+    def test_define_by_identifier(self):
+        d = ServiceDispatcher(ECUState())
+        # F200 = VIN第1~3字节 + 车速2字节 + VIN第4字节(与第一段相接, 合并成一次切片)
+        assert d.handle([0x2c, 0x01, 0xf2, 0x00, 0xf1, 0x91, 1, 3, 0x00, 0x61, 1, 2]) == [0x6c, 0x01, 0xf2, 0x00]
+        assert d.handle([0x2c, 0x01, 0xf2, 0x00, 0xf1, 0x91, 4, 1]) == [0x6c, 0x01, 0xf2, 0x00]
+        assert d.handle([0x22, 0xf2, 0x00]) == [0x62, 0xf2, 0x00] + list(b"FVB") + [0x55, 0xf0] + list(b"3")
+        d.handle([0x10, 0x03])
+        assert d.handle([0x2e, 0x00, 0x61, 0x00, 0x64]) == [0x6e, 0x00, 0x61]
+        assert d.handle([0x22, 0xf2, 0x00])[6:8] == [0x00, 0x64]
+        assert d.handle([0x2c, 0x03, 0xf2, 0x00]) == [0x6c, 0x03, 0xf2, 0x00]
+        assert d.handle([0x22, 0xf2, 0x00]) == [0x7f, 0x22, 0x31]
+
+    @pytest.mark.parametrize("request_data,nrc", [
+        ([0x2c, 0x01, 0xf2, 0x00, 0xf1, 0x91, 1], 0x13),
+        ([0x2c, 0x01, 0xf2, 0x00, 0x12, 0x34, 1, 1], 0x31),
+        ([0x2c, 0x01, 0xf2, 0x00, 0xf1, 0x91, 17, 2], 0x31),
+        ([0x2c, 0x01, 0x00, 0x21, 0xf1, 0x91, 1, 1], 0x31),
+        ([0x2c, 0x02, 0xf2, 0x01, 0x12, 0xff, 0xff, 0x10], 0x31),
+        ([0x2c, 0x04, 0xf2, 0x00], 0x12),
+    ])
+    def test_define_nrc(self, request_data, nrc):
+        assert ServiceDispatcher(ECUState()).handle(request_data) == [0x7f, 0x2c, nrc]
+
+    def test_define_by_memory_address(self):
+        d = ServiceDispatcher(ECUState())
+        eol = d.state.eol
+        eol.eol_start_address = 0x1000
+        eol.rev_buffer = PagedMemory(range(16))
+        assert d.handle([0x2c, 0x02, 0xf3, 0x00, 0x12, 0x10, 0x04, 2, 0x10, 0x0e, 1]) == [0x6c, 0x02, 0xf3, 0x00]
+        assert d.handle([0x22, 0xf3, 0x00]) == [0x62, 0xf3, 0x00, 4, 5, 14]
+        eol.rev_buffer[4] = 0x55
+        assert d.handle([0x22, 0xf3, 0x00]) == [0x62, 0xf3, 0x00, 0x55, 5, 14]
+
+
+class TestCompressedDownload():
+    IMAGE = bytes(range(256)) * 40
+
+    def download(self, sequence):
+        # 每次下载用一个新的ECU, 不碰缺省状态
+        self.dispatcher = ServiceDispatcher(ECUState())
+        return [self.dispatcher.handle(req) for req in sequence]
+
+    @pytest.mark.parametrize("compression", [1, 2])
+    def test_download(self, compression):
+        sequence = download_sequence(len(self.IMAGE), block_size=100, compression=compression, image=self.IMAGE)
+        responses = self.download(sequence[:-1])
+        assert all(r[0] != 0x7f for r in responses)
+        assert sum(len(r) - 2 for r in sequence if r[0] == 0x36) < len(self.IMAGE) // 4
+        assert self.dispatcher.state.eol.rev_buffer == self.IMAGE
+
+    def test_errors(self):
+        # 不支持的压缩/加密方法
+        for dfi in (0xf0, 0x01):
+            assert self.download([[0x10, 0x02], [0x34, dfi, 0x44, 0, 0, 0, 0, 0, 0, 0x10, 0]])[1] == [0x7f, 0x34, 0x31]
+        # 解压后超出RequestDownload声明的长度
+        sequence = download_sequence(len(self.IMAGE), compression=1, image=self.IMAGE)
+        sequence[2][-4:] = list((len(self.IMAGE) - 1).to_bytes(4, "big"))
+        assert self.download(sequence)[3] == [0x7f, 0x36, 0x71]
+        # 压缩流不完整时退出传输
+        sequence = download_sequence(len(self.IMAGE), compression=1, image=self.IMAGE)
+        sequence[3] = sequence[3][:-4]
+        assert self.download(sequence)[4] == [0x7f, 0x37, 0x24]
+
+    @pytest.mark.parametrize("compression", [1, 2])
+    def test_data_after_end_of_stream(self, compression):
+        # 压缩流结束后又来一个数据块, 或者最后一块里流结束后还有数据
+        sequence = download_sequence(len(self.IMAGE), compression=compression, image=self.IMAGE)
+        exit_at = next(i for i, req in enumerate(sequence) if req[0] == 0x37)
+        extra = [0x36, (sequence[exit_at - 1][1] + 1) & 0xff, 0x00]
+        assert self.download(sequence[:exit_at] + [extra])[-1] == [0x7f, 0x36, 0x71]
+        sequence[exit_at - 1] = sequence[exit_at - 1] + [0x00]
+        assert self.download(sequence[:exit_at])[-1] == [0x7f, 0x36, 0x71]
@@ -0,0 +1,336 @@
+import argparse
+import json
+import math
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, Iterable, Optional
+
+from uds import UDSService
+from uds_response_code import UDSResponseCode
+
+NEGATIVE_RESPONSE = 0x7f
+RESPONSE_PENDING = UDSResponseCode.RequestCorrectlyReceived_ResponsePending
+
+KIND_REQUEST = 0
+KIND_POSITIVE = 1
+KIND_NEGATIVE = 2
+
+# 查找表:按SID下标,避免逐帧做枚举/反射查询
+SERVICE_NAMES = [UDSService.get_name(i) or "" for i in range(256)]
+IS_REQUEST_SID = [SERVICE_NAMES[i] != "" for i in range(256)]
+IS_RESPONSE_SID = [i >= 0x40 and SERVICE_NAMES[i - 0x40] != "" for i in range(256)]
+HAS_SUBFUNCTION = [False] * 256
+for _sid in (0x10, 0x11, 0x19, 0x27, 0x28, 0x29, 0x2c, 0x31, 0x3e, 0x83, 0x85, 0x86, 0x87):
+    HAS_SUBFUNCTION[_sid] = True
+# 请求里DID在第1字节开始的服务;正响应同理
+HAS_DID = [False] * 256
+for _sid in (0x22, 0x24, 0x2e, 0x2f):
+    HAS_DID[_sid] = True
+
+# 列名 -> array类型码,与numpy dtype一一对应
+COLUMNS = {
+    "timestamp": ("d", "<f8"),
+    "can_id": ("I", "<u4"),
+    "kind": ("B", "|u1"),
+    "sid": ("B", "|u1"),
+    "subfunction": ("h", "<i2"),
+    "did": ("i", "<i4"),
+    "dtc": ("i", "<i4"),
+    "nrc": ("h", "<i2"),
+    "length": ("I", "<u4"),
+    "latency": ("d", "<f8"),
+}
+
+
+def new_columns() -> Dict[str, array]:
+    return {name: array(code) for name, (code, _) in COLUMNS.items()}
+
+
+class TraceDecoder:
+    # pairs: 诊断仪请求ID -> ECU响应ID; functional_ids 为功能寻址ID
+    def __init__(self, pairs: Dict[int, int] = None, functional_ids: Iterable[int] = (0x7df,)):
+        self.pairs = dict(pairs or {0x7e0: 0x7e8})
+        self.requests = set(self.pairs) | set(functional_ids)
+        self.responses = {rx: tx for tx, rx in self.pairs.items()}
+        self.functional_ids = set(functional_ids)
+        self.columns = new_columns()
+        self.frames = 0
+        self.pdus = 0
+        self.latencies = {}
+        self._rx = {}
+        self._pending = {}
+
+    def feed(self, ts: float, can_id: int, data: bytes):
+        self.frames += 1
+        if can_id not in self.requests and can_id not in self.responses:
+            return
+        pci = data[0] >> 4
+        if pci == 0:
+            length = data[0] & 0xf
+            if length == 0 and len(data) > 8:
+                length = data[1]
+                self._pdu(ts, can_id, data[2:2 + length])
+            else:
+                self._pdu(ts, can_id, data[1:1 + length])
+        elif pci == 1:
+            length = ((data[0] & 0xf) << 8) | data[1]
+            if length == 0:
+                length = int.from_bytes(data[2:6], "big")
+                payload = bytearray(data[6:])
+            else:
+                payload = bytearray(data[2:])
+            self._rx[can_id] = [ts, length, payload, 1]
+        elif pci == 2:
+            rx = self._rx.get(can_id)
+            if rx is None or data[0] & 0xf != rx[3]:
+                self._rx.pop(can_id, None)
+                return
+            rx[3] = (rx[3] + 1) & 0xf
+            payload = rx[2]
+            payload += data[1:]
+            if len(payload) >= rx[1]:
+                del self._rx[can_id]
+                self._pdu(ts, can_id, bytes(payload[:rx[1]]))
+
+    def _pdu(self, ts: float, can_id: int, pdu: bytes):
+        if not pdu:
+            return
+        self.pdus += 1
+        c = self.columns
+        first = pdu[0]
+        n = len(pdu)
+        subfunction = did = dtc = nrc = -1
+        latency = math.nan
+        if can_id in self.requests and IS_REQUEST_SID[first]:
+            kind = KIND_REQUEST
+            sid = first
+            if HAS_SUBFUNCTION[sid] and n > 1:
+                subfunction = pdu[1] & 0x7f
+            elif HAS_DID[sid] and n > 2:
+                did = (pdu[1] << 8) | pdu[2]
+            elif sid == 0x14 and n > 3:
+                dtc = (pdu[1] << 16) | (pdu[2] << 8) | pdu[3]
+            if sid == 0x31 and n > 3:
+                did = (pdu[2] << 8) | pdu[3]
+            if can_id in self.functional_ids:
+                for tx in self.pairs:
+                    self._pending[self.pairs[tx]] = (sid, ts)
+            else:
+                self._pending[self.pairs[can_id]] = (sid, ts)
+        elif first == NEGATIVE_RESPONSE and n > 2:
+            kind = KIND_NEGATIVE
+            sid = pdu[1]
+            nrc = pdu[2]
+            if nrc != RESPONSE_PENDING:
+                latency = self._latency(can_id, sid, ts)
+        elif IS_RESPONSE_SID[first]:
+            kind = KIND_POSITIVE
+            sid = first - 0x40
+            if HAS_SUBFUNCTION[sid] and n > 1:
+                subfunction = pdu[1] & 0x7f
+                if sid == 0x19 and n > 5 and subfunction in (0x02, 0x0a, 0x0f, 0x13, 0x15):
+                    dtc = (pdu[3] << 16) | (pdu[4] << 8) | pdu[5]
+            elif HAS_DID[sid] and n > 2:
+                did = (pdu[1] << 8) | pdu[2]
+            if sid == 0x31 and n > 3:
+                did = (pdu[2] << 8) | pdu[3]
+            latency = self._latency(can_id, sid, ts)
+        else:
+            return
+        c["timestamp"].append(ts)
+        c["can_id"].append(can_id)
+        c["kind"].append(kind)
+        c["sid"].append(sid)
+        c["subfunction"].append(subfunction)
+        c["did"].append(did)
+        c["dtc"].append(dtc)
+        c["nrc"].append(nrc)
+        c["length"].append(n)
+        c["latency"].append(latency)
+
+    def _latency(self, can_id: int, sid: int, ts: float) -> float:
+        pending = self._pending.get(can_id)
+        if pending is None or pending[0] != sid:
+            return math.nan
+        del self._pending[can_id]
+        latency = ts - pending[1]
+        lat = self.latencies.get(sid)
+        if lat is None:
+            lat = self.latencies[sid] = array("d")
+        lat.append(latency)
+        return latency
+
+    def take_columns(self) -> Dict[str, array]:
+        c = self.columns
+        self.columns = new_columns()
+        return c
+
+    def latency_stats(self) -> dict:
+        stats = {}
+        for sid, lat in sorted(self.latencies.items()):
+            s = sorted(lat)
+            stats[SERVICE_NAMES[sid] or hex(sid)] = {
+                "count": len(s),
+                "mean": sum(s) / len(s),
+                "min": s[0],
+                "p50": _percentile(s, 0.5),
+                "p90": _percentile(s, 0.9),
+                "p99": _percentile(s, 0.99),
+                "max": s[-1],
+            }
+        return stats
+
+
+def _percentile(s, q: float) -> float:
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+def parse_candump(lines: Iterable[str], feed):
+    # (1436509052.249713) can0 7E0#0322F19100000000
+    fromhex = bytes.fromhex
+    for line in lines:
+        try:
+            ts, _, frame = line.split(None, 2)
+            can_id, data = frame.rstrip().split("#", 1)
+            if data[:1] == "#":
+                data = data[2:]
+            feed(float(ts[1:-1]), int(can_id, 16), fromhex(data))
+        except (ValueError, IndexError):
+            continue
+
+
+def parse_asc(lines: Iterable[str], feed):
+    # Vector ASC:   1.234567 1  7E0             Rx   d 8 03 22 F1 91 00 00 00 00
+    fromhex = bytes.fromhex
+    for line in lines:
+        parts = line.split()
+        try:
+            if len(parts) < 6 or parts[4] != "d":
+                continue
+            dlc = int(parts[5], 16)
+            feed(float(parts[0]), int(parts[2].rstrip("xX"), 16), fromhex("".join(parts[6:6 + dlc])))
+        except (ValueError, IndexError):
+            continue
+
+
+PARSERS = {"candump": parse_candump, "asc": parse_asc}
+
+
+def detect_format(path: str) -> str:
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("("):
+                return "candump"
+            if line and line[0].isdigit():
+                return "asc"
+    return "candump"
+
+
+class NpyWriter:
+    # 每列写一个.npy文件,流式追加,关闭时回填长度,不需要安装numpy
+    HEADER_SIZE = 128
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.count = 0
+        self._files = {}
+        for name in COLUMNS:
+            f = open(os.path.join(directory, name + ".npy"), "wb")
+            f.write(self._header(name, 0))
+            self._files[name] = f
+
+    @staticmethod
+    def _header(name: str, count: int) -> bytes:
+        header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (COLUMNS[name][1], count)
+        # NPY v1: 魔数/版本/长度10字节 + 头部 + 换行, 总长必须是64的倍数; 固定长度, close()重写行数时数据不动
+        header = header.ljust(NpyWriter.HEADER_SIZE - 10 - 1) + "\n"
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+    def write(self, columns: Dict[str, array]):
+        for name, f in self._files.items():
+            col = columns[name]
+            if sys.byteorder != "little":
+                col = array(col.typecode, col)
+                col.byteswap()
+            col.tofile(f)
+        self.count += len(columns["timestamp"])
+
+    def close(self):
+        for name, f in self._files.items():
+            f.seek(0)
+            f.write(self._header(name, self.count))
+            f.close()
+
+
+class ParquetWriter:
+    def __init__(self, path: str):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pa = pyarrow
+        self.count = 0
+        types = {"d": pyarrow.float64(), "I": pyarrow.uint32(), "B": pyarrow.uint8(), "h": pyarrow.int16(),
+                 "i": pyarrow.int32()}
+        self._schema = pyarrow.schema([(name, types[code]) for name, (code, _) in COLUMNS.items()])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, columns: Dict[str, array]):
+        pa = self._pa
+        arrays = [pa.array(columns[f.name], type=f.type) for f in self._schema]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self.count += len(columns["timestamp"])
+
+    def close(self):
+        self._writer.close()
+
+
+def decode_file(path: str, writer=None, decoder: TraceDecoder = None, fmt: Optional[str] = None,
+                chunk_size: int = 1 << 22) -> TraceDecoder:
+    decoder = decoder or TraceDecoder()
+    parser = PARSERS[fmt or detect_format(path)]
+    with open(path, "r", errors="replace", buffering=1 << 20) as f:
+        while True:
+            lines = f.readlines(chunk_size)
+            if not lines:
+                break
+            parser(lines, decoder.feed)
+            columns = decoder.take_columns()
+            if writer is not None:
+                writer.write(columns)
+    return decoder
+
+
+def _pair(value: str):
+    tx, rx = value.split(":")
+    return int(tx, 16), int(rx, 16)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="decode UDS traces into columnar tables")
+    parser.add_argument("trace")
+    parser.add_argument("-o", "--output", help="output directory of .npy columns, or a .parquet file")
+    parser.add_argument("--format", choices=sorted(PARSERS))
+    parser.add_argument("--pair", type=_pair, action="append", help="tester:ecu CAN ids in hex, e.g. 7E0:7E8")
+    parser.add_argument("--functional", type=lambda v: int(v, 16), action="append")
+    args = parser.parse_args(argv)
+
+    decoder = TraceDecoder(dict(args.pair or [(0x7e0, 0x7e8)]),
+                           args.functional if args.functional is not None else (0x7df,))
+    writer = None
+    if args.output:
+        writer = ParquetWriter(args.output) if args.output.endswith(".parquet") else NpyWriter(args.output)
+    try:
+        decode_file(args.trace, writer, decoder, args.format)
+    finally:
+        if writer is not None:
+            writer.close()
+    print(json.dumps({"frames": decoder.frames, "pdus": decoder.pdus, "latency": decoder.latency_stats()},
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
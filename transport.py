@@ -0,0 +1,162 @@
+import logging
+import os
+import queue
+import sys
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("app")
+
+VECTOR_DLL_DIRECTORY = Path(r"D:\Program Files (x86)\Vector License Client")
+
+
+class Transport(ABC):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @abstractmethod
+    def recv(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def send(self, data, send_timeout: Optional[float] = None):
+        pass
+
+
+class LoopbackTransport(Transport):
+    # 进程内回环,不经过CAN/ISO-TP分帧,只用于测量服务处理能力
+    def __init__(self):
+        self._rx = queue.SimpleQueue()
+        self._tx = queue.SimpleQueue()
+        self.tester = LoopbackTester(self._tx, self._rx)
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        try:
+            return self._rx.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def send(self, data, send_timeout: Optional[float] = None):
+        self._tx.put(bytes(data))
+
+
+class LoopbackTester:
+    def __init__(self, rx: queue.SimpleQueue, tx: queue.SimpleQueue):
+        self._rx = rx
+        self._tx = tx
+
+    def send(self, data):
+        self._tx.put(bytes(data))
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        try:
+            return self._rx.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def request(self, data, timeout: Optional[float] = 1.0) -> Optional[bytes]:
+        self.send(data)
+        return self.recv(timeout)
+
+
+class IsoTpCanTransport(Transport):
+    default_params = {
+        'blocking_send': True,
+        'rx_flowcontrol_timeout': 5000,
+        'rx_consecutive_frame_timeout': 5000,
+    }
+    # CAN FD时的缺省值: 64字节帧并开启波特率切换
+    default_fd_params = {
+        'can_fd': True,
+        'tx_data_length': 64,
+        'bitrate_switch': True,
+    }
+    fd_data_lengths = (8, 12, 16, 20, 24, 32, 48, 64)
+
+    # params 直接传给isotp, 常用的有 blocksize, stmin, tx_data_length, tx_padding, max_frame_size
+    def __init__(self, interface: str, channel, rxid: int, txid: int, bitrate: int = 500000,
+                 app_name: Optional[str] = None, addressing_mode: str = "Normal_11bits", params: dict = None,
+                 fd: bool = False, data_bitrate: int = 2000000):
+        self.interface = interface
+        self.channel = channel
+        self.bitrate = bitrate
+        self.data_bitrate = data_bitrate
+        self.fd = fd
+        self.app_name = app_name
+        self.addressing_mode = addressing_mode
+        self.rxid = rxid
+        self.txid = txid
+        self.params = dict(self.default_params)
+        if fd:
+            self.params.update(self.default_fd_params)
+        if params:
+            self.params.update(params)
+        tx_data_length = self.params.get('tx_data_length', 8)
+        if not self.params.get('can_fd') and tx_data_length != 8:
+            raise ValueError("tx_data_length other than 8 requires CAN FD.")
+        if tx_data_length not in self.fd_data_lengths:
+            raise ValueError(f"tx_data_length {tx_data_length} is not a valid CAN FD data length.")
+        self._bus = None
+        self._stack = None
+
+    def start(self):
+        import isotp
+
+        self._bus = open_can_bus(self.interface, self.channel, self.bitrate, self.app_name, self.fd,
+                                 self.data_bitrate)
+        addr = isotp.Address(isotp.AddressingMode[self.addressing_mode], rxid=self.rxid, txid=self.txid)
+        self._stack = isotp.CanStack(self._bus, address=addr, params=self.params)
+        self._stack.start()
+
+    def stop(self):
+        if self._stack is not None:
+            self._stack.stop()
+            self._stack = None
+        if self._bus is not None:
+            self._bus.shutdown()
+            self._bus = None
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        return self._stack.recv(block=True, timeout=timeout)
+
+    def send(self, data, send_timeout: Optional[float] = None):
+        self._stack.send(bytes(data), send_timeout=send_timeout)
+
+
+def open_can_bus(interface: str, channel, bitrate: int = 500000, app_name: Optional[str] = None, fd: bool = False,
+                 data_bitrate: int = 2000000):
+    import can
+
+    kwargs = {'interface': interface, 'channel': channel}
+    if interface == 'vector':
+        add_vector_dll_directory()
+        kwargs['bitrate'] = bitrate
+        kwargs['app_name'] = app_name
+        if fd:
+            kwargs['fd'] = True
+            kwargs['data_bitrate'] = data_bitrate
+    elif interface == 'socketcan':
+        kwargs['fd'] = fd
+    elif interface == 'virtual':
+        kwargs['receive_own_messages'] = False
+    return can.Bus(**kwargs)
+
+
+def add_vector_dll_directory(path: Path = VECTOR_DLL_DIRECTORY):
+    # Vector驱动只在Windows上需要,其它平台直接跳过
+    if sys.platform == "win32" and path.exists():
+        os.add_dll_directory(path)
+
+
+def create_transport(config: dict) -> Transport:
+    config = dict(config)
+    kind = config.pop("interface", "loopback")
+    if kind == "loopback":
+        return LoopbackTransport()
+    if kind in ("virtual", "socketcan", "vector"):
+        return IsoTpCanTransport(kind, **config)
+    raise ValueError(f"transport interface {kind} is not support.")
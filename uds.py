@@ -2,11 +2,11 @@ import logging
 import struct
 from abc import ABC
 from enum import Enum
-from typing import List
+from typing import Callable, Iterable, List, Optional
 
-from did import DIDList
-from dtc import DTCBuffer
-from uds_addtion import Singleton
+from compression import StreamDecompressor, is_supported
+from did import DYNAMIC_DID_RANGE, did_source
+from ecustate import ECUState, EOL, StateSnapshot
 from uds_response_code import UDSResponseCode
 
 logger = logging.getLogger("app")
@@ -69,6 +69,21 @@ class BaseService(ABC):
     _sub_func: bool = False
     supported_negative_response: List[int]
 
+    # 服务规格声明,由ServiceTable编译成查找表,在调用process之前统一校验
+    _min_len: int = 1  # 含SID的最小请求长度
+    _max_len: Optional[int] = None  # 含SID的最大请求长度,None为不限
+    _len_multiple: int = 1  # SID之后的数据长度必须是它的整数倍
+    _sub_functions: Optional[Iterable[int]] = None  # 支持的子功能,None表示服务不带子功能
+    _sessions: Optional[Iterable[int]] = None  # 支持的会话,None表示所有会话
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        nrc = set(cls.always_valid_negative_response) | set(getattr(cls, "supported_negative_response", []))
+        nrc.add(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+        if cls._sub_functions is not None:
+            nrc.add(UDSResponseCode.SubFunctionNotSupported)
+        cls._negative_responses = frozenset(nrc)
+
     def request_id(self) -> int:
         return self._sid
 
@@ -76,12 +91,7 @@ class BaseService(ABC):
         return self._sid + 0x40
 
     def is_valid_negative_response(self, negative_code: UDSResponseCode):
-        if negative_code in self.always_valid_negative_response:
-            return True
-        elif negative_code in self.supported_negative_response:
-            return True
-        else:
-            return False
+        return negative_code in self._negative_responses
 
     def make_neg_response(self, negative_code: UDSResponseCode) -> List:
         if not self.is_valid_negative_response(negative_code):
@@ -91,24 +101,31 @@ class BaseService(ABC):
     def make_pos_response(self, *args, **kwargs) -> List:
         pass
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState = None):
+        # state: 本ECU的状态(DID表, DTC缓冲区, 下载状态), 由分发器传入; 不用状态的服务忽略它
         pass
 
-    def is_suppressPosRspMsgIndicationBit(self, val):
-        return (((val & 0xff) >> 7) == 0)
+
+class DiagnosticSessionType(Enum):
+    ISOSAEReserved = 0
+    DefaultSession = 1
+    ProgrammingSession = 2
+    ExtendedDiagnosticSession = 3
+    SafetySystemDiagnosticSession = 4
+
+
+NON_DEFAULT_SESSIONS = (DiagnosticSessionType.ProgrammingSession.value,
+                        DiagnosticSessionType.ExtendedDiagnosticSession.value,
+                        DiagnosticSessionType.SafetySystemDiagnosticSession.value)
 
 
 class DiagnosticSessionControl(BaseService):
     _sid = 0x10
     _sub_func = True
-    supported_negative_response = [UDSResponseCode.RequestOutOfRange]
-
-    class DiagnosticSessionType(Enum):
-        ISOSAEReserved = 0
-        DefaultSession = 1
-        ProgrammingSession = 2
-        ExtendedDiagnosticSession = 3
-        SafetySystemDiagnosticSession = 4
+    _min_len = 2
+    _max_len = 2
+    _sub_functions = (1, 2, 3, 4)
+    DiagnosticSessionType = DiagnosticSessionType
 
     supported_negative_response = [UDSResponseCode.SubFunctionNotSupported,
                                    UDSResponseCode.IncorrectMessageLengthOrInvalidFormat,
@@ -121,27 +138,22 @@ class DiagnosticSessionControl(BaseService):
         res = struct.pack('>HH', int(p2_server_max), int(p2_star_server_max / 10))
         return [self.response_id(), session] + list(res)
 
-    def process(self, data: list) -> list:
+    def process(self, data: list, state: ECUState = None) -> list:
         req_sid, session_type, *reserved = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ECUReset.")
-        if not session_type in self.DiagnosticSessionType._value2member_map_:
-            logger.info(f"the diag session type {session_type} of DiagnosticSessionControl is not define.")
-            r = self.make_neg_response(UDSResponseCode.RequestOutOfRange)
-            logger.info(f'DiagnosticSessionControl make neg respnse {r}')
-            return r
-        if self.is_suppressPosRspMsgIndicationBit(session_type):
-            r = self.make_pos_response(session_type, 5000, 2000)
-            logger.info(f'DiagnosticSessionControl make pos respnse {r}')
-            return r
-        else:
-            return None
+        r = self.make_pos_response(session_type, 5000, 2000)
+        logger.info(f'DiagnosticSessionControl make pos respnse {r}')
+        return r
 
 
 class ECUReset(BaseService):
     _sid = 0x11
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
     _sub_func = True
+    _min_len = 2
+    _max_len = 2
+    _sub_functions = (1, 2, 3, 4, 5)
 
     class ResetType(Enum):
         ISOSAEReserved = 0
@@ -157,31 +169,26 @@ class ECUReset(BaseService):
         else:
             return [self.response_id(), type]
 
-    def process(self, data: list) -> list:
+    def process(self, data: list, state: ECUState = None) -> list:
         req_sid, reset_type, *reserved = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ECUReset.")
 
-        if not reset_type in self.ResetType._value2member_map_:
-            logger.info(f"the reset type {reset_type} of ECUReset is not define.")
-
-        if self.is_suppressPosRspMsgIndicationBit(reset_type):
-            if reset_type == self.ResetType.enableRapidPowerShutDown.value:
-                r = self.make_pos_response(reset_type, 0x3b)
-                logger.info(f'ECUReset make pos respnse {r}')
-                return r
-            else:
-                r = self.make_pos_response(reset_type)
-                logger.info(f'ECUReset make pos respnse {r}')
-                return r
+        if reset_type == self.ResetType.enableRapidPowerShutDown.value:
+            r = self.make_pos_response(reset_type, 0x3b)
         else:
-            return None
+            r = self.make_pos_response(reset_type)
+        logger.info(f'ECUReset make pos respnse {r}')
+        return r
 
 
 class SecurityAccess(BaseService):
     _sid = 0x27
     _sub_func = True
     _unlock_level = 0
+    _min_len = 2
+    _sub_functions = (1, 2, 3, 4, 5, 6, 7, 8)
+    _sessions = NON_DEFAULT_SESSIONS
 
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
@@ -207,35 +214,25 @@ class SecurityAccess(BaseService):
     def unlock(self,security_access_type) -> bool:
         return [self.response_id(), security_access_type]
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState = None):
         req_sid, security_access_type, *reserved = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ECUReset.")
 
-        if security_access_type in self.SeedSYm._value2member_map_:
+        if security_access_type % 2 == 1:
             r = self.get_seed(security_access_type)
-            logger.info(f'DiagnosticSessionControl make pos respnse {r}')
-            if self.is_suppressPosRspMsgIndicationBit(security_access_type):
-                return r
-            else:
-                return None
-        elif security_access_type in self.KeySym._value2member_map_:
-            r = self.unlock(security_access_type)
-            logger.info(f'DiagnosticSessionControl make pos respnse {r}')
-            if self.is_suppressPosRspMsgIndicationBit(security_access_type):
-                return r
-            else:
-                return None
         else:
-            logger.info(f"the diag session type {security_access_type} of DiagnosticSessionControl is not define.")
-            r = self.make_neg_response(UDSResponseCode.RequestOutOfRange)
-            logger.info(f'DiagnosticSessionControl make neg respnse {r}')
-            return r
+            r = self.unlock(security_access_type)
+        logger.info(f'SecurityAccess make pos respnse {r}')
+        return r
 
 
 class CommunicationControl(BaseService):
     _sid = 0x28
     _sub_func = True
+    _min_len = 3
+    _sub_functions = (0, 1, 2, 3)
+    _sessions = NON_DEFAULT_SESSIONS
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     class ControlType(Enum):
@@ -247,43 +244,37 @@ class CommunicationControl(BaseService):
     def make_pos_response(self, control_type) -> List:
         return [self.response_id(), control_type]
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState = None):
         req_sid, control_type, communication_type, *reserved = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ECUReset.")
-        if not control_type in self.ControlType._value2member_map_:
-            logger.info(f"the diag session type {control_type} of DiagnosticSessionControl is not define.")
-            r = self.make_neg_response(UDSResponseCode.RequestOutOfRange)
-            logger.info(f'DiagnosticSessionControl make neg respnse {r}')
-            return r
-
-        if self.is_suppressPosRspMsgIndicationBit(control_type):
-            return self.make_pos_response(control_type)
-        else:
-            return None
+        return self.make_pos_response(control_type)
 
 
 class TesterPresent(BaseService):
     _sid = 0x3E
     _sub_func = True
+    _min_len = 2
+    _max_len = 2
+    _sub_functions = (0,)
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     def make_pos_response(self, *args, **kwargs) -> List:
         return [self.response_id(), 0x00]
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState = None):
         req_sid, zeroSubFunction, *servered = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ECUReset.")
-        if self.is_suppressPosRspMsgIndicationBit(zeroSubFunction):
-            return self.make_pos_response()
-        else:
-            return None
+        return self.make_pos_response()
 
 
 class ControlDTCSetting(BaseService):
     _sid = 0x85
     _sub_func = True
+    _min_len = 2
+    _sub_functions = (1, 2)
+    _sessions = NON_DEFAULT_SESSIONS
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     class DTCSettingType(Enum):
@@ -294,57 +285,46 @@ class ControlDTCSetting(BaseService):
     def make_pos_response(self, dtc_setting_type) -> List:
         return [self.response_id(), dtc_setting_type]
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState = None):
         req_sid, dtc_setting_type, *servered = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ECUReset.")
-        if not dtc_setting_type in self.DTCSettingType._value2member_map_:
-            r = self.make_neg_response(UDSResponseCode.RequestOutOfRange)
-            logger.info(f'ControlDTCSetting make neg respnse {r}')
-            return r
-        if self.is_suppressPosRspMsgIndicationBit(dtc_setting_type):
-            return self.make_pos_response(dtc_setting_type)
-        else:
-            return None
+        return self.make_pos_response(dtc_setting_type)
 
 
 class ReadDataByIdentifier(BaseService):
     _sid = 0x22
     _sub_func = False
+    _min_len = 3
+    _len_multiple = 2
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     def make_pos_response(self, res: list) -> List:
         return [self.response_id()] + res
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState):
         req_sid, *did_list = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ReadDataByIdentifier.")
 
         r = self.make_neg_response(UDSResponseCode.RequestOutOfRange)
-        if not len(did_list) % 2 == 0:
-            logger.info(f'ReadDataByIdentifier make neg respnse 1{r}')
-            return r
-        if not len(did_list) >= 2:
-            logger.info(f'ReadDataByIdentifier make neg respnse {r}')
-            return r
-
         did_num = int(len(did_list) / 2)
         did_li = struct.unpack((">" + "H" * did_num), bytes(did_list))
 
-        for d in did_li:
-            if not d in DIDList.dict.keys():
-                logger.info(f'ControlDTCSetting make neg respnse 2{r}')
-                return r
-        for d in did_li:
-            if not d in DIDList.value.keys():
-                logger.info(f'ControlDTCSetting make neg respnse 3{r}')
-                return r
+        # 只取一次快照, 重载配置时本次请求仍然读到完整的旧表
+        snapshot = state.dids.snapshot
+        encoded = snapshot.encoded
         res = []
         for d in did_li:
-            if not d is None:
-                res += [(d >> 8) & 0xff, d & 0xff]
-                res = res + list(DIDList.dict[d].encode(DIDList.value[d]))
+            e = encoded.get(d)
+            if e is None:
+                dynamic = state.dids.dynamic.get(d)
+                if dynamic is not None:
+                    e = dynamic.read(snapshot, state.eol.read_memory)
+            if e is None:
+                logger.info(f'ReadDataByIdentifier make neg respnse {r}')
+                return r
+            res += e
 
         return self.make_pos_response(res)
 
@@ -352,51 +332,49 @@ class ReadDataByIdentifier(BaseService):
 class WriteDataByIdentifier(BaseService):
     _sid = 0x2E
     _sub_func = False
+    _min_len = 4
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     def make_pos_response(self, res: list) -> List:
         return [self.response_id()] + res
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState):
         req_sid, *did_list = data
         r = self.make_neg_response(UDSResponseCode.RequestOutOfRange)
         if not req_sid == self._sid:
             raise Exception("the data is not belong WriteDataByIdentifier.")
-        if not len(did_list) > 2:
-            logger.info(f'WriteDataByIdentifier make neg respnse {r}')
-            return r
-
         did_w = (did_list[0] << 8) + did_list[1]
-        if not did_w in DIDList.dict.keys():
+        codec = state.dids.snapshot.codecs.get(did_w)
+        if codec is None:
             logger.info(f'WriteDataByIdentifier make neg respnse 1 {r}')
             return r
         else:
-            did_len = DIDList.dict[did_w].did_len
-            if len(did_list) < (did_len + 2):
+            did_len = codec.did_len
+            if len(did_list) != (did_len + 2):
+                r = self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
                 logger.info(f'WriteDataByIdentifier make neg respnse 2 {r}')
                 return r
             else:
-                DIDList.value[did_w] = DIDList.dict[did_w].decode((did_list[2:2 + did_len]))
+                state.dids.write(did_w, codec.decode((did_list[2:2 + did_len])))
         return self.make_pos_response(did_list[0:2])
 
 
 class ClearDiagnosticInformation(BaseService):
     _sid = 0x14
     _sub_func = False
+    _min_len = 4
+    _max_len = 5
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     def make_pos_response(self, *args, **kwargs) -> List:
         return [self.response_id()]
 
-    def process(self, data: list):
-        if len(data) < 4:
-            return self.make_neg_response(UDSResponseCode.GeneralReject)
+    def process(self, data: list, state: ECUState):
         req_sid, GODTC_HB, GODTC_MB, GODTC_LB, *reseved = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ClearDiagnosticInformation.")
         if GODTC_HB == 0xff and GODTC_LB == 0xff and GODTC_MB == 0xff:
-            d = DTCBuffer()
-            d.clear_alldtc()
+            state.dtcs.clear_alldtc()
         return self.make_pos_response()
 
 
@@ -404,6 +382,8 @@ class ReadDTCInformation(BaseService):
     _sid = 0x19
     _sub_func = True
     _DTCStatusAvailabilityMask = 0xff
+    _min_len = 3
+    _sub_functions = (0x02,)
     supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     class SubFun(Enum):
@@ -432,54 +412,169 @@ class ReadDTCInformation(BaseService):
     def make_pos_response(self, el) -> List:
         return [self.response_id()]+el
 
-    def process(self, data: list):
-        if len(data) < 3:
-            return self.make_neg_response(UDSResponseCode.GeneralReject)
-        req_sid, subfunc, *reseved = data
+    def process(self, data: list, state: ECUState):
+        # 只支持reportDTCByStatusMask, 其它子功能已经被ServiceTable.validate拒绝
+        req_sid, subfunc, dtc_msk, *notused = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ReadDTCInformation.")
-        if subfunc == self.SubFun.reportDTCByStatusMask.value:
-            dtc_msk, *notused = reseved
-            d = DTCBuffer()
-            res = d.get_dtc_by_msk(dtc_msk)
-            ll=[subfunc]
-            for ee in res:
-                ll += ee.dtc_val.encode()+ee.dtc_st.encode()
-            return self.make_pos_response(ll)
+        res = state.dtcs.get_dtc_by_msk(dtc_msk)
+        ll=[subfunc]
+        for ee in res:
+            ll += ee.dtc_val.encode()+ee.dtc_st.encode()
+        return self.make_pos_response(ll)
+
+
+class DynamicallyDefineDataIdentifier(BaseService):
+    _sid = 0x2C
+    _sub_func = True
+    _min_len = 2
+    _sub_functions = (1, 2, 3)
+    supported_negative_response = [UDSResponseCode.RequestOutOfRange]
+
+    class DefinitionType(Enum):
+        DefineByIdentifier = 1
+        DefineByMemoryAddress = 2
+        ClearDynamicallyDefinedDataIdentifier = 3
+
+    def make_pos_response(self, subfunc: int, did: list) -> List:
+        return [self.response_id(), subfunc] + did
+
+    def process(self, data: list, state: ECUState):
+        req_sid, subfunc, *record = data
+        if not req_sid == self._sid:
+            raise Exception("the data is not belong DynamicallyDefineDataIdentifier.")
+        dids = state.dids
+        if subfunc == self.DefinitionType.ClearDynamicallyDefinedDataIdentifier.value:
+            if len(record) == 0:
+                dids.clear_dynamic()
+                return self.make_pos_response(subfunc, [])
+            if len(record) != 2:
+                return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+            did = (record[0] << 8) + record[1]
+            if did not in DYNAMIC_DID_RANGE:
+                return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+            dids.clear_dynamic(did)
+            return self.make_pos_response(subfunc, list(record))
+        if len(record) < 2:
+            return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+        did = (record[0] << 8) + record[1]
+        if subfunc == self.DefinitionType.DefineByIdentifier.value:
+            sources = self._by_identifier(record[2:], dids.snapshot)
         else:
+            sources = self._by_memory_address(record[2:], state.eol)
+        if not isinstance(sources, list):
+            return self.make_neg_response(sources)
+        if did not in DYNAMIC_DID_RANGE:
             return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+        dids.define(did, sources)
+        return self.make_pos_response(subfunc, list(record[0:2]))
+
+    def _by_identifier(self, record, snapshot):
+        # 源DID(2) + 位置(1) + 长度(1), 可重复
+        if len(record) == 0 or len(record) % 4:
+            return UDSResponseCode.IncorrectMessageLengthOrInvalidFormat
+        sources = []
+        for i in range(0, len(record), 4):
+            src = did_source(snapshot, (record[i] << 8) + record[i + 1], record[i + 2], record[i + 3])
+            if src is None:
+                return UDSResponseCode.RequestOutOfRange
+            sources.append(src)
+        return sources
+
+    def _by_memory_address(self, record, eol: EOL):
+        # addressAndLengthFormatIdentifier + (地址, 长度)重复
+        if len(record) == 0:
+            return UDSResponseCode.IncorrectMessageLengthOrInvalidFormat
+        address_size = record[0] & 0xf
+        length_size = record[0] >> 4
+        if not 1 <= address_size <= 4 or not 1 <= length_size <= 4:
+            return UDSResponseCode.RequestOutOfRange
+        step = address_size + length_size
+        items = record[1:]
+        if len(items) == 0 or len(items) % step:
+            return UDSResponseCode.IncorrectMessageLengthOrInvalidFormat
+        sources = []
+        for i in range(0, len(items), step):
+            address = int.from_bytes(bytes(items[i:i + address_size]), "big")
+            size = int.from_bytes(bytes(items[i + address_size:i + step]), "big")
+            if size == 0 or eol.read_memory(address, size) is None:
+                return UDSResponseCode.RequestOutOfRange
+            sources.append(("mem", address, size))
+        return sources
+
+
+class ResponseOnEvent(BaseService):
+    _sid = 0x86
+    _sub_func = True
+    _min_len = 2
+    # 低6位是事件类型, bit6为storageState; 支持onDTCStatusChange与onChangeOfDataIdentifier
+    _sub_functions = (0x00, 0x01, 0x03, 0x04, 0x05, 0x06, 0x41, 0x43)
+    supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
+    class EventType(Enum):
+        StopResponseOnEvent = 0x00
+        OnDTCStatusChange = 0x01
+        OnChangeOfDataIdentifier = 0x03
+        ReportActivatedEvents = 0x04
+        StartResponseOnEvent = 0x05
+        ClearResponseOnEvent = 0x06
 
-@Singleton
-class EOL():
-    eol_active_status = False
-    eol_start_address = 0
-    eol_transferred_size = 0
-    eol_rev_count = 0
-    eol_rev_block_count = 0
-    maxNumberOfBlockLength = 0x0fff
-    rev_buffer = []
-    erase_flash_start_address = 0
-    erase_flash_size = 0
-
-    def reset(self):
-        self.eol_active_status = False
-        self.eol_start_address = 0
-        self.eol_size_of_data = 0
-        self.eol_transferred_size = 0
-        self.eol_rev_count = 0
-        self.eol_rev_block_count = 0
-        self.maxNumberOfBlockLength = 0x0fff
-        self.rev_buffer = []
-        self.erase_flash_start_address = 0
-        self.erase_flash_size = 0
+    def make_pos_response(self, eventType: int, addition: list) -> List:
+        return [self.response_id(), eventType] + addition
+
+    def process(self, data: list, state: ECUState, events=None):
+        req_sid, eventType, *record = data
+        if not req_sid == self._sid:
+            raise Exception("the data is not belong ResponseOnEvent.")
+        if events is None:
+            return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+        event = eventType & 0x3f
+        if event == self.EventType.ReportActivatedEvents.value:
+            if record:
+                return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+            subs = events.subscriptions if events.active else []
+            res = [len(subs)]
+            for sub in subs:
+                res += sub.encode()
+            return self.make_pos_response(eventType, res)
+        if len(record) < 1:
+            return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+        window = record[0]
+        if event in (self.EventType.StopResponseOnEvent.value, self.EventType.StartResponseOnEvent.value,
+                     self.EventType.ClearResponseOnEvent.value):
+            if len(record) != 1:
+                return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+            if event == self.EventType.StartResponseOnEvent.value:
+                if not events.subscriptions:
+                    return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+                events.start()
+            elif event == self.EventType.StopResponseOnEvent.value:
+                events.stop()
+            else:
+                events.clear()
+            return self.make_pos_response(eventType, [0, window])
+        # 事件定义: eventTypeRecord + serviceToRespondToRecord
+        size = 2 if event == self.EventType.OnChangeOfDataIdentifier.value else 1
+        event_record, service = bytes(record[1:1 + size]), bytes(record[1 + size:])
+        if len(event_record) != size or not service:
+            return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+        if event == self.EventType.OnChangeOfDataIdentifier.value:
+            did = (event_record[0] << 8) + event_record[1]
+            if did not in state.dids.snapshot.codecs or service[0] != ReadDataByIdentifier._sid:
+                return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+        elif service[0] != ReadDTCInformation._sid:
+            return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+        events.define(eventType, window, event_record, service)
+        return self.make_pos_response(eventType, [0, window] + list(event_record) + list(service))
 
 
 class RoutineControl(BaseService):
     _sid = 0x31
     _sub_func = True
-    supported_negative_response = []
-    eol = EOL()
+    _min_len = 4
+    _sub_functions = (1, 2, 3)
+    _sessions = NON_DEFAULT_SESSIONS
+    supported_negative_response = [UDSResponseCode.RequestOutOfRange]
 
     class RoutineStatus(Enum):
         Succeed = 0x1
@@ -497,114 +592,340 @@ class RoutineControl(BaseService):
     def make_pos_response(self, addition: list) -> List:
         return [self.response_id()] + addition
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState):
+        # 下载状态只在本ECU的EOL锁里修改, 其它诊断仪读DID/DTC不受影响
+        with state.eol.lock:
+            return self._process(data, state.eol)
+
+    def _process(self, data: list, eol: EOL):
         req_sid, subfunc, routineIdHB, routineIdLB, *routineControlOptionRecord = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong ReadDTCInformation.")
         if subfunc == self.RoutineControlType.StartRoutine.value:
             if ((routineIdHB << 8) + routineIdLB) == self.RoutineIdentifier.EraseFlash.value:
-                self.eol.reset()
-                self.eol.erase_flash_start_address = (routineControlOptionRecord[0] << 24) + (
+                if len(routineControlOptionRecord) < 8:
+                    return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+                eol.reset()
+                eol.erase_flash_start_address = (routineControlOptionRecord[0] << 24) + (
                             routineControlOptionRecord[1] << 16) + (routineControlOptionRecord[2] << 8) + (
                                                      routineControlOptionRecord[3])
-                self.eol.erase_flash_size = (routineControlOptionRecord[4] << 24) + (
+                eol.erase_flash_size = (routineControlOptionRecord[4] << 24) + (
                             routineControlOptionRecord[5] << 16) + (routineControlOptionRecord[6] << 8) + (
                                             routineControlOptionRecord[7])
                 return self.make_pos_response([self.RoutineControlType.StartRoutine.value, routineIdHB, routineIdLB,
                                                self.RoutineStatus.Succeed.value])
             elif ((routineIdHB << 8) + routineIdLB) == self.RoutineIdentifier.CheckMemory.value:
+                # 配置了参考软件时, 用上一次传输结束时的比较结果
+                status = self.RoutineStatus.Succeed
+                if eol.verify_result is not None and not eol.verify_result["ok"]:
+                    status = self.RoutineStatus.Failed
                 return self.make_pos_response([self.RoutineControlType.StartRoutine.value, routineIdHB, routineIdLB,
-                                               self.RoutineStatus.Succeed.value])
-            else:
-                pass
+                                               status.value])
+        return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
 
 
 class RequestDownload(BaseService):
     _sid = 0x34
     _sub_func = False
-    memoryAddressSize = 0
-    memorySize = 0
     lengthFormatIdentifier = 0x20
-    e = EOL()
-    supported_negative_response = [UDSResponseCode.RequestSequenceError, UDSResponseCode.TransferDataSuspended]
+    _min_len = 5
+    _sessions = (DiagnosticSessionType.ProgrammingSession.value,)
+    supported_negative_response = [UDSResponseCode.RequestSequenceError, UDSResponseCode.TransferDataSuspended,
+                                   UDSResponseCode.RequestOutOfRange]
+
+    def make_pos_response(self, dataFormatIdentifier, eol: EOL) -> List:
+        return [self.response_id(), self.lengthFormatIdentifier, eol.maxNumberOfBlockLength >> 8,
+                eol.maxNumberOfBlockLength & 0xff]
 
-    def make_pos_response(self, dataFormatIdentifier) -> List:
-        return [self.response_id(), self.lengthFormatIdentifier, self.e.maxNumberOfBlockLength >> 8,
-                self.e.maxNumberOfBlockLength & 0xff]
+    def process(self, data: list, state: ECUState):
+        with state.eol.lock:
+            return self._process(data, state.eol)
 
-    def process(self, data: list):
-        if len(data) < 3:
-            self.eol.reset()
-            return self.make_neg_response(UDSResponseCode.GeneralReject)
+    def _process(self, data: list, eol: EOL):
         req_sid, dataFormatIdentifier, addressAndLengthFormatIdentifier, *reseved = data
-        self.memoryAddressSize = (addressAndLengthFormatIdentifier & 0xf)
-        self.memorySize = ((addressAndLengthFormatIdentifier & 0xff) >> 4)
-        if len(data) < (3 + self.memoryAddressSize + self.memorySize):
-            self.eol.reset()
-            return self.make_neg_response(UDSResponseCode.GeneralReject)
+        # 服务对象被所有ECU共用, 解析结果只放在局部变量里
+        memoryAddressSize = (addressAndLengthFormatIdentifier & 0xf)
+        memorySize = ((addressAndLengthFormatIdentifier & 0xff) >> 4)
+        if len(data) != (3 + memoryAddressSize + memorySize):
+            eol.reset()
+            return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
         n = 0
         m = 0
-        for i in range(self.memoryAddressSize):
-            n = n + (reseved[i] << ((self.memoryAddressSize - i - 1) * 8))
-        for i in range(self.memorySize):
-            m = m + (reseved[i + self.memoryAddressSize] << ((self.memorySize - i - 1) * 8))
-        self.e.eol_active_status = True
-        self.e.eol_start_address = n
-        self.e.eol_transferred_size = m
-        return self.make_pos_response(dataFormatIdentifier)
+        for i in range(memoryAddressSize):
+            n = n + (reseved[i] << ((memoryAddressSize - i - 1) * 8))
+        for i in range(memorySize):
+            m = m + (reseved[i + memoryAddressSize] << ((memorySize - i - 1) * 8))
+        # dataFormatIdentifier: 高4位压缩方法, 低4位加密方法(不支持)
+        compression = dataFormatIdentifier >> 4
+        if dataFormatIdentifier & 0xf or not is_supported(compression):
+            eol.reset()
+            return self.make_neg_response(UDSResponseCode.RequestOutOfRange)
+        eol.eol_active_status = True
+        eol.eol_start_address = n
+        eol.eol_transferred_size = m
+        eol.decompressor = StreamDecompressor(compression, m) if compression else None
+        eol.verifier = eol.reference.verifier(n, m) if eol.reference is not None else None
+        eol.verify_result = None
+        return self.make_pos_response(dataFormatIdentifier, eol)
 
 
 class RequestUpload(BaseService):
     _sid = 0x35
-    _sub_func = True
+    _sub_func = False
+    _min_len = 5
+    _sessions = (DiagnosticSessionType.ProgrammingSession.value,)
     supported_negative_response = [UDSResponseCode.RequestSequenceError, UDSResponseCode.TransferDataSuspended]
 
     def make_pos_response(self, *args, **kwargs) -> List:
         pass
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState = None):
         return self.make_neg_response(UDSResponseCode.GeneralReject)
 
 
 class TransferData(BaseService):
     _sid = 0x36
-    _sub_func = True
+    _sub_func = False
+    _min_len = 2
+    _sessions = (DiagnosticSessionType.ProgrammingSession.value,)
     blockSequenceCounter = 0
-    eol = EOL()
     supported_negative_response = [UDSResponseCode.RequestSequenceError, UDSResponseCode.TransferDataSuspended]
 
     def make_pos_response(self, blockCount) -> List:
         return [self.response_id(), blockCount]
 
-    def process(self, data: list):
-        req_sid, blockSequenceCounter, *reversed = data
+    def process(self, data: list, state: ECUState):
+        with state.eol.lock:
+            return self._process(data, state.eol)
+
+    def _process(self, data: list, eol: EOL):
+        # data 可以是list/bytes/memoryview, 数据块只用切片取出, 直接追加到下载缓冲区
+        req_sid = data[0]
+        blockSequenceCounter = data[1]
+        reversed = data[2:]
         if not req_sid == self._sid:
             raise Exception("the data is not belong TransferData.")
-        if self.eol.eol_active_status:
-            if not ((self.eol.eol_rev_block_count + 1) == blockSequenceCounter):
-                self.eol.reset()
+        if eol.eol_active_status:
+            if not ((eol.eol_rev_block_count + 1) == blockSequenceCounter):
+                eol.reset()
                 return self.make_neg_response(UDSResponseCode.RequestSequenceError)
 
-        if (2 + len(reversed)) <= self.eol.maxNumberOfBlockLength:
-            self.eol.rev_buffer.extend(reversed)
-            self.eol.eol_rev_count = self.eol.eol_rev_count + len(reversed)
-            self.eol.eol_rev_block_count += 1
-            if self.eol.eol_rev_block_count == 0xff:
-                self.eol.eol_rev_block_count = -1  # why this value will be start with zero after catch 0xff。
+        if (2 + len(reversed)) <= eol.maxNumberOfBlockLength:
+            if eol.decompressor is not None:
+                # 压缩下载: 逐块解压后写入镜像, 只保留解压器自身的窗口
+                try:
+                    block = eol.decompressor.feed(reversed)
+                except ValueError as e:
+                    logger.info(f'TransferData {e}')
+                    eol.reset()
+                    return self.make_neg_response(UDSResponseCode.TransferDataSuspended)
+            else:
+                block = reversed
+            eol.rev_buffer += block
+            if eol.verifier is not None:
+                eol.verifier.feed(block)
+            eol.eol_rev_count = eol.eol_rev_count + len(reversed)
+            eol.eol_rev_block_count += 1
+            if eol.eol_rev_block_count == 0xff:
+                eol.eol_rev_block_count = -1  # why this value will be start with zero after catch 0xff。
             return self.make_pos_response(blockSequenceCounter)
+        return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
 
 
 class RequestTransferExit(BaseService):
     _sid = 0x37
     _sub_func = False
-    eol = EOL()
-    supported_negative_response = [UDSResponseCode.IncorrectMessageLengthOrInvalidFormat]
+    _sessions = (DiagnosticSessionType.ProgrammingSession.value,)
+    supported_negative_response = [UDSResponseCode.IncorrectMessageLengthOrInvalidFormat,
+                                   UDSResponseCode.RequestSequenceError]
 
     def make_pos_response(self, *args, **kwargs) -> List:
         return [self.response_id()]
 
-    def process(self, data: list):
+    def process(self, data: list, state: ECUState):
+        with state.eol.lock:
+            return self._process(data, state.eol)
+
+    def _process(self, data: list, eol: EOL):
         req_sid, *reserved = data
         if not req_sid == self._sid:
             raise Exception("the data is not belong RequestTransferExit.")
+        if eol.decompressor is not None and not eol.decompressor.eof:
+            # 压缩流还没有结束, 数据不完整
+            return self.make_neg_response(UDSResponseCode.RequestSequenceError)
+        if eol.verifier is not None:
+            eol.verify_result = eol.verifier.finish()
+            logger.info(f'RequestTransferExit verify {eol.verify_result}')
         return self.make_pos_response()
+
+
+class SecuredDataTransmission(BaseService):
+    _sid = 0x84
+    _sub_func = False
+    _min_len = 9  # SID + 7字节安全参数 + 内部消息的SID
+    supported_negative_response = [UDSResponseCode.SecureDataVerificationFailed, UDSResponseCode.VersionNotSupported,
+                                   UDSResponseCode.SecuredLinkNotSupported]
+
+    def make_pos_response(self, record: bytes) -> List:
+        return [self.response_id()] + list(record)
+
+    def process(self, data: list, state: ECUState, channel=None, handle: Callable = None):
+        # channel: 本连接的密钥上下文(secured.SecureChannel), 验证后的内部请求交给handle, 和直接收到的请求走同一套处理
+        if channel is None or handle is None:
+            return self.make_neg_response(UDSResponseCode.SecuredLinkNotSupported)
+        from secured import SecurityError
+
+        try:
+            admin, algorithm, sig_len, counter, inner = channel.open(data)
+        except SecurityError as e:
+            logger.info(f'SecuredDataTransmission {e}')
+            return self.make_neg_response(e.nrc)
+        if inner[0] == self._sid:
+            return self.make_neg_response(UDSResponseCode.IncorrectMessageLengthOrInvalidFormat)
+        # 内部的否定响应也放在0xC4里返回; 抑制了肯定响应时整条不响应
+        r = handle(inner, secured=True)
+        if r is None:
+            return None
+        return self.make_pos_response(channel.respond(admin, algorithm, sig_len, counter, r))
+
+
+class ServiceSpec:
+    __slots__ = "sid", "handler", "min_len", "max_len", "len_multiple", "sub_functions", "sessions"
+
+    def __init__(self, service: BaseService):
+        cls = type(service)
+        self.sid = cls._sid
+        self.handler = service
+        self.min_len = cls._min_len
+        self.max_len = cls._max_len
+        self.len_multiple = cls._len_multiple
+        # 子功能与会话都编译成位图,校验时一次移位即可
+        self.sub_functions = None if cls._sub_functions is None else _bitmask(cls._sub_functions)
+        self.sessions = -1 if cls._sessions is None else _bitmask(cls._sessions)
+
+
+def _bitmask(values: Iterable[int]) -> int:
+    mask = 0
+    for v in values:
+        mask |= 1 << v
+    return mask
+
+
+class ServiceTable:
+    def __init__(self, services: Iterable[type] = None):
+        if services is None:
+            services = BaseService.__subclasses__()
+        self.specs: List[Optional[ServiceSpec]] = [None] * 256
+        for cls in services:
+            self.specs[cls._sid] = ServiceSpec(cls())
+
+    @classmethod
+    def default(cls) -> "ServiceTable":
+        # 服务对象不保存会话状态, 所有ECU共用一张缺省表, 第一次用到时才创建
+        global _default_table
+        if _default_table is None:
+            _default_table = cls()
+        return _default_table
+
+    def validate(self, data, session: int) -> int:
+        # 按ISO 14229-1 图5~7的顺序选出NRC, 返回0表示通过
+        spec = self.specs[data[0]]
+        if spec is None:
+            return UDSResponseCode.ServiceNotSupported
+        if not (spec.sessions >> session) & 1:
+            return UDSResponseCode.ServiceNotSupportedInActiveSession
+        n = len(data)
+        if n < spec.min_len:
+            return UDSResponseCode.IncorrectMessageLengthOrInvalidFormat
+        if spec.sub_functions is not None and not (spec.sub_functions >> (data[1] & 0x7f)) & 1:
+            return UDSResponseCode.SubFunctionNotSupported
+        if (spec.max_len is not None and n > spec.max_len) or (n - 1) % spec.len_multiple:
+            return UDSResponseCode.IncorrectMessageLengthOrInvalidFormat
+        return UDSResponseCode.PositiveResponse
+
+
+_default_table: Optional[ServiceTable] = None
+
+
+class ServiceDispatcher:
+    # 一个诊断仪连接: 会话是连接自己的, ECU状态可以由多个连接共用
+    # sink: 主动发送响应(ResponseOnEvent)用, 一般是transport.send
+    def __init__(self, state: ECUState = None, table: ServiceTable = None, sink: Callable[[list], None] = None):
+        self.state = state or ECUState.default()
+        self.table = table or ServiceTable.default()
+        self.session = DiagnosticSessionType.DefaultSession.value
+        self.sink = sink
+        self._events = None
+        self._channel = None
+
+    @property
+    def events(self):
+        # 第一次收到0x86时才创建事件引擎
+        if self._events is None:
+            from roe import EventEngine
+
+            self._events = EventEngine(self.state, self.handle, lambda r: self.sink is not None and self.sink(r))
+        return self._events
+
+    @property
+    def channel(self):
+        # 0x84的密钥上下文按连接缓存, ECU换了密钥(例如重新加载配置)才重建; 没有密钥或没装cryptography时为None
+        key = self.state.secure_key
+        if key is None:
+            return None
+        if self._channel is None or self._channel.replay is not self.state.replay:
+            try:
+                from secured import SecureChannel
+            except ImportError:
+                logger.info("SecuredDataTransmission needs the cryptography package")
+                return None
+            self._channel = SecureChannel(key, self.state.replay)
+        return self._channel
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+
+    def snapshot(self) -> StateSnapshot:
+        snapshot = self.state.snapshot()
+        snapshot.session = self.session
+        return snapshot
+
+    def restore(self, snapshot: StateSnapshot):
+        # 和ECUReset一样清掉ResponseOnEvent的定义, 测试用例之间不会互相推送
+        if self._events is not None:
+            self._events.clear()
+        self.state.restore(snapshot)
+        if snapshot.session is not None:
+            self.session = snapshot.session
+
+    def handle(self, data, secured: bool = False) -> Optional[list]:
+        # secured: 请求是从0x84里解出来的, 已经验证过签名
+        nrc = self.table.validate(data, self.session)
+        if nrc:
+            return [BaseService._neg_response, data[0], nrc]
+        if not secured and data[0] in self.state.secured_services:
+            return [BaseService._neg_response, data[0], UDSResponseCode.SecureDataTransmissionRequired]
+        spec = self.table.specs[data[0]]
+        suppress = False
+        if spec.sub_functions is not None and data[1] & 0x80:
+            # 只有要清掉抑制位时才复制请求, 其余情况把原缓冲区(可能是memoryview)直接交给服务
+            suppress = True
+            data = list(data)
+            data[1] &= 0x7f
+        if spec.sid == ResponseOnEvent._sid:
+            r = spec.handler.process(data, self.state, self.events)
+        elif spec.sid == SecuredDataTransmission._sid:
+            r = spec.handler.process(data, self.state, self.channel, self.handle)
+        else:
+            r = spec.handler.process(data, self.state)
+        if r is not None and r[0] != BaseService._neg_response:
+            if spec.sid == DiagnosticSessionControl._sid:
+                self.session = data[1]
+            elif spec.sid == ECUReset._sid:
+                self.session = DiagnosticSessionType.DefaultSession.value
+                if self._events is not None:
+                    self._events.clear()
+            if suppress:
+                return None
+        return r
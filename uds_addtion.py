@@ -1,28 +1,23 @@
 import functools
 import traceback
-from threading import RLock
 
-single_lock = RLock()
+# 由profiler模块在采集期间设置,为None时log_exception不做任何额外的事
+_profile_hook = None
 
 
-def Singleton(cls):
-    instance = {}
+def set_profile_hook(hook):
+    global _profile_hook
+    _profile_hook = hook
 
-    def _singleton_wrapper(*args, **kargs):
-        with single_lock:
-            if cls not in instance:
-                instance[cls] = cls(*args, **kargs)
-        return instance[cls]
 
-    return _singleton_wrapper
-
-
-def log_exception(logger):
+def log_exception(logger, label=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             try:
-                return func(*args, **kwargs)
+                if _profile_hook is None:
+                    return func(*args, **kwargs)
+                return _profile_hook(func, label(*args) if label else func.__qualname__, args, kwargs)
             except Exception as e:
                 logger.error(f"An error occurred in function {func.__name__}: {e}")
                 logger.error(traceback.format_exc())
@@ -1,6 +1,3 @@
-import inspect
-
-
 class UDSResponseCode:
     PositiveResponse = 0
     GeneralReject = 0x10
@@ -79,21 +76,17 @@ class UDSResponseCode:
     def get_name(cls, given_id: int) -> str:
         if given_id is None:
             return ""
-
-        for member in inspect.getmembers(cls):
-            if isinstance(member[1], int):
-                if member[1] == given_id:
-                    return member[0]
-        return str(given_id)
+        return _code_names.get(given_id, str(given_id))
 
     # Tells if a code is a negative code
     @classmethod
     def is_negative(cls, given_id: int) -> bool:
         if given_id in [None, cls.PositiveResponse]:
             return False
+        return given_id in _code_names
+
 
-        for member in inspect.getmembers(cls):
-            if isinstance(member[1], int):
-                if member[1] == given_id:
-                    return True
-        return False
+# 预先建好码值到名字的表,有别名的码值取按名字排序的第一个(与原来inspect.getmembers的结果一致)
+# 不用inspect, 启动时少导入一个较重的模块
+_code_names = {value: name for name, value in sorted(vars(UDSResponseCode).items(), reverse=True)
+               if isinstance(value, int)}